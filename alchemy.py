@@ -1,34 +1,81 @@
 #!/usr/bin/env python3
 # -------------------------------------------------------------------
-# Parsing 'live' json files.
+# Parsing 'live' json files (or the daily zip archives).
 # -------------------------------------------------------------------
 
 import os, sys
-import json
+import io
 import re
 from bikedb import *
+import bikejson
+from bikecolumns import ColumnWriter
 import datetime as dt
 from argparse import ArgumentParser
-from itertools import islice
+from contextlib import nullcontext
 
 from bikeconfig import bikeconfig
+from bikemetrics import metrics, SlowProfiler
 
 import logging
 logging.basicConfig(stream = sys.stdout, level = logging.WARNING)
 
-# Slicing required for python 3.6 as the sqlalchemy inserts
-# must be under 999 values.
-def chunked(iterable, chunk_size):
-    it = iter(iterable)
-    while True:
-        chunk = list(islice(it, chunk_size))
-        if not chunk:
-            break
-        yield chunk
+def _get_subdirs(dir, digits):
+    """_get_subdirs(dir, digits)
 
+    Params
+    ======
+    dir : str
+        Parent directory.
+    digits : int
+        Number of digits of the subdirectory names (4 for years,
+        2 for months and days).
+
+    Return
+    ======
+    list : Sorted list of names of the subdirectories consisting
+    of exactly `digits` digits.
+    """
+    pat = re.compile(f"^[0-9]{{{digits}}}$")
+    with os.scandir(dir) as it:
+        res = [x.name for x in it if x.is_dir() and pat.match(x.name)]
+    return sorted(res)
+
+
+def is_heartbeats(file):
+    """is_heartbeats(file)
+
+    Return
+    ======
+    bool : True if `file` is a heartbeat file (see `downloader.write_heartbeat()`),
+    listed by `get_json_files()` and `get_zip_members()` once per heartbeat.
+    """
+    return re.match(r"^heartbeats_.+\.txt$", os.path.basename(file)) is not None
+
+
+def _add_heartbeats(res, file, content, since = None):
+    """_add_heartbeats(res, file, content, since = None)
+
+    Adds the timestamps of a heartbeat file as tuples (timestamp, file)
+    to `res` (list of tuples). Timestamps already in `res` are skipped
+    (json file preferred), as well as those not newer than `since`.
+    """
+    known = set([x[0] for x in res])
+    for x in content.split():
+        if not x.isdigit() or int(x) in known: continue
+        if not since is None and int(x) <= since: continue
+        res.append((int(x), file))
+        known.add(int(x))
+
+
+def get_json_files(dir, domain, since = None):
+    """get_json_files(dir, domain, since = None)
 
-def get_json_files(dir, domain):
-    """get_json_files(dir, domain)
+    Scans the date partitioned live folder (`<dir>/YYYY/mm/dd`, see
+    `downloader.get_dir_today()`). Days before `since` are skipped
+    without listing their content. Heartbeats (snapshots identical to
+    the previous one, not stored, see `downloader.write_heartbeat()`)
+    are returned as well; the heartbeat file is listed once per
+    heartbeat (see `is_heartbeats()`).
 
     Params
     ======
@@ -36,36 +83,540 @@ def get_json_files(dir, domain):
         Directory containing the json files.
     domain : str
         Domain used for file names.
+    since : None, int
+        If set, only files with a timestamp newer than `since`
+        are returned (e.g., latest processed timestamp in the database).
+
+    Return
+    ======
+    list : List of length two with the json files and the
+    corresponding timestamps, sorted by timestamp.
     """
     if not isinstance(dir, str): raise TypeError("'dir' must be string")
     if not os.path.isdir(dir):   raise NotADirectoryError(f"\"{dir}\" does not exist")
     if not isinstance(domain, str): raise TypeError("'domain' must be string")
+    if not since is None and not isinstance(since, int):
+        raise TypeError("'since' must be None or int")
 
-    from re import compile
-    pat = compile(f".*\\/([0-9]+)_{domain}\\.json$")
+    # Pattern the files must follow
+    pat = re.compile(f"^([0-9]+)_{domain}\\.json$")
+
+    # Day of 'since' as YYYYmmdd used to skip older directories
+    sday = "" if since is None else \
+           dt.datetime.fromtimestamp(since, dt.timezone.utc).strftime("%Y%m%d")
 
-    from glob import glob
     files      = []
     timestamps = []
+    for year in _get_subdirs(dir, 4):
+        if year < sday[:4]: continue
+        for month in _get_subdirs(os.path.join(dir, year), 2):
+            if year + month < sday[:6]: continue
+            for day in _get_subdirs(os.path.join(dir, year, month), 2):
+                if year + month + day < sday: continue
+                daydir = os.path.join(dir, year, month, day)
+                res    = []
+                for file in os.listdir(daydir):
+                    tmp = pat.match(file)
+                    if not tmp: continue
+                    if not since is None and int(tmp.group(1)) <= since: continue
+                    res.append((int(tmp.group(1)), os.path.join(daydir, file)))
+                heartbeats = os.path.join(daydir, f"heartbeats_{domain}.txt")
+                if os.path.isfile(heartbeats):
+                    with open(heartbeats, "r") as fid:
+                        _add_heartbeats(res, heartbeats, fid.read(), since)
+                res.sort()
+                files      += [x[1] for x in res]
+                timestamps += [x[0] for x in res]
 
-    # Pattern the files must follow
-    tmp = glob(os.path.join(dir, "**"), recursive = True)
-    tmp.sort()
-    for file in tmp:
-        tmp = pat.search(file)
+    return [files, timestamps]
+
+
+def get_zip_files(dir, domain, start = None, end = None):
+    """get_zip_files(dir, domain, start = None, end = None)
+
+    Params
+    ======
+    dir : str
+        Directory containing the daily zip archives
+        (see `downloader.archive_yesterday()`).
+    domain : str
+        Domain used for file names.
+    start : None, datetime.date
+        If set, only archives on or after this date are returned.
+    end : None, datetime.date
+        If set, only archives on or before this date are returned.
+
+    Return
+    ======
+    list : List of length two with the zip files and the
+    corresponding dates (datetime.date), sorted by date.
+    """
+    if not isinstance(dir, str): raise TypeError("'dir' must be string")
+    if not os.path.isdir(dir):   raise NotADirectoryError(f"\"{dir}\" does not exist")
+    if not isinstance(domain, str): raise TypeError("'domain' must be string")
+    if not start is None and not isinstance(start, dt.date):
+        raise TypeError("'start' must be None or datetime.date")
+    if not end is None and not isinstance(end, dt.date):
+        raise TypeError("'end' must be None or datetime.date")
+
+    pat = re.compile(f"^([0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}})_{domain}\\.zip$")
+
+    files = []
+    dates = []
+    for file in sorted(os.listdir(dir)):
+        tmp = pat.match(file)
         if not tmp: continue
-        files.append(file)
-        timestamps.append(int(tmp.group(1)))
+        date = dt.date.fromisoformat(tmp.group(1))
+        if not start is None and date < start: continue
+        if not end is None and date > end: continue
+        files.append(os.path.join(dir, file))
+        dates.append(date)
 
-    return [files, timestamps]
+    return [files, dates]
 
 
+def get_zip_members(archive, domain):
+    """get_zip_members(archive, domain)
 
+    Params
+    ======
+    archive : zipfile.ZipFile
+        Opened zip archive.
+    domain : str
+        Domain used for file names.
+
+    Return
+    ======
+    list : List of length two with the names of the json files in the
+    archive and the corresponding timestamps, sorted by timestamp. Includes
+    the heartbeats as `get_json_files()`.
+    """
+    from zipfile import ZipFile
+    if not isinstance(archive, ZipFile): raise TypeError("'archive' must be a ZipFile")
+    if not isinstance(domain, str): raise TypeError("'domain' must be string")
+
+    pat = re.compile(f"^([0-9]+)_{domain}\\.json$")
+
+    res = []
+    heartbeats = []
+    for member in archive.namelist():
+        if os.path.basename(member) == f"heartbeats_{domain}.txt":
+            heartbeats.append(member)
+        tmp = pat.match(os.path.basename(member))
+        if not tmp: continue
+        res.append((int(tmp.group(1)), member))
+    for member in heartbeats:
+        _add_heartbeats(res, member, archive.read(member).decode())
+    res.sort()
+
+    return [[x[1] for x in res], [x[0] for x in res]]
+
+
+def iter_json_files(files, timestamps, stream = False, jobs = 1):
+    """iter_json_files(files, timestamps, stream = False, jobs = 1)
+
+    Params
+    ======
+    files : list of str
+        Paths to the json files (see `get_json_files()`).
+    timestamps : list of int
+        Corresponding timestamps.
+    stream : bool
+        Forwarded to `read_json()`.
+    jobs : int
+        Number of processes reading/decoding the files (see `iter_parallel()`).
+
+    Return
+    ======
+    generator : Yields tuples with the name of the file, the timestamp,
+    and the parsed json data (None for heartbeats, see `is_heartbeats()`).
+    """
+    if jobs > 1:
+        tasks = ((file, timestamp, None if is_heartbeats(file) else (file, None, stream)) \
+                 for file, timestamp in zip(files, timestamps))
+        yield from iter_parallel(tasks, jobs)
+        return
+    for file, timestamp in zip(files, timestamps):
+        yield file, timestamp, None if is_heartbeats(file) else read_json(file, stream = stream)
+
+
+def iter_zip_files(files, domain, stream = False, jobs = 1):
+    """iter_zip_files(files, domain, stream = False, jobs = 1)
+
+    Streams the json files out of the zip archives without
+    extracting them to disk.
+
+    Params
+    ======
+    files : list of str
+        Paths to the zip archives (see `get_zip_files()`), must be
+        sorted by date.
+    domain : str
+        Domain used for file names.
+    stream : bool
+        Forwarded to `read_json()`.
+    jobs : int
+        Number of processes reading/decoding the files (see `iter_parallel()`).
+
+    Return
+    ======
+    generator : Yields tuples with the name of the archive member, the
+    timestamp, and the parsed json data (None for heartbeats, see
+    `is_heartbeats()`); ordered by timestamp.
+    """
+    from zipfile import ZipFile
+    if jobs > 1:
+        def tasks():
+            for file in files:
+                with ZipFile(file, "r") as archive:
+                    members, timestamps = get_zip_members(archive, domain)
+                for member, timestamp in zip(members, timestamps):
+                    yield f"{file}:{member}", timestamp, \
+                          None if is_heartbeats(member) else (file, member, stream)
+        yield from iter_parallel(tasks(), jobs)
+        return
+    for file in files:
+        with ZipFile(file, "r") as archive:
+            members, timestamps = get_zip_members(archive, domain)
+            for member, timestamp in zip(members, timestamps):
+                yield f"{file}:{member}", timestamp, \
+                      None if is_heartbeats(member) else read_json(member, archive, stream)
 
 
 # -------------------------------------------------------------------
-# Main part
+# Parallel reading/decoding; the files are decoded by a pool of
+# processes while the results are yielded in the original order
+# (timestamp) such that they can be processed by one single writer.
 # -------------------------------------------------------------------
+# Zip archive currently opened by the worker process
+_archive = None
+
+def _read_task(file, member, stream):
+    """_read_task(file, member, stream)
+
+    Worker; reads and decodes one json file, or one member of the zip
+    archive `file` if `member` is set (archive kept open for the next task).
+
+    Return
+    ======
+    bikejson.Snapshot : Parsed json data.
+    """
+    global _archive
+    if member is None:
+        return read_json(file, stream = stream)
+    from zipfile import ZipFile
+    if _archive is None or not _archive.filename == file:
+        if _archive is not None: _archive.close()
+        _archive = ZipFile(file, "r")
+    return read_json(member, _archive, stream)
+
+
+def iter_parallel(tasks, jobs, queue_size = None):
+    """iter_parallel(tasks, jobs, queue_size = None)
+
+    Params
+    ======
+    tasks : iterable
+        Tuples with name, timestamp, and the arguments for `_read_task()`
+        (None: nothing to read, yields None), in the order the results are needed.
+    jobs : int
+        Number of worker processes.
+    queue_size : None, int
+        Maximum number of files read ahead (backpressure); defaults to `4 * jobs`.
+
+    Return
+    ======
+    generator : Yields tuples with name, timestamp, and the parsed json data
+    in the order of `tasks`.
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    if not isinstance(jobs, int) or jobs <= 0:
+        raise ValueError("'jobs' must be a positive int")
+    if queue_size is None: queue_size = 4 * jobs
+
+    pending = deque()
+    with ProcessPoolExecutor(jobs) as pool:
+        try:
+            for name, timestamp, args in tasks:
+                pending.append((name, timestamp, None if args is None else pool.submit(_read_task, *args)))
+                if len(pending) >= queue_size:
+                    name, timestamp, future = pending.popleft()
+                    yield name, timestamp, None if future is None else future.result()
+            while len(pending) > 0:
+                name, timestamp, future = pending.popleft()
+                yield name, timestamp, None if future is None else future.result()
+        finally:
+            for x in pending:
+                if x[2] is not None: x[2].cancel()
+
+
+def read_json(file, archive = None, stream = False):
+    """read_json(file, archive = None, stream = False)
+
+    Params
+    ======
+    file : str
+        Path to the json file to be read, or name of the
+        member if `archive` is set.
+    archive : None, zipfile.ZipFile
+        If set, `file` is read from this (opened) zip archive.
+    stream : bool
+        If True the file is parsed record by record (see
+        `bikejson.stream()`; the raw document is not held in memory,
+        the records are), else decoded at once (see `bikejson.decode()`).
+
+    Return
+    ======
+    bikejson.Snapshot : Parsed json data; 'places' and 'bikes'.
+    """
+    if not isinstance(file, str):   raise TypeError("'file' must be string")
+    if not isinstance(stream, bool): raise TypeError("'stream' must be bool")
+    if stream:
+        with metrics.timer("decode"):
+            if archive is not None:
+                with io.TextIOWrapper(archive.open(file, "r"), encoding = "utf-8") as fid:
+                    return bikejson.stream(fid)
+            with open(file, "r") as fid: return bikejson.stream(fid)
+
+    if archive is not None:
+        x = archive.read(file)
+    else:
+        with open(file, "rb") as fid: x = fid.read()
+    metrics.count("json_bytes_total", len(x))
+    with metrics.timer("decode"):
+        return parse_json(x)
+
+
+def parse_json(x):
+    """parse_json(x)
+
+    Params
+    ======
+    x : str, bytes
+        Content of a json file (e.g., the API response).
+
+    Return
+    ======
+    bikejson.Snapshot : Parsed json data; 'places' and 'bikes'.
+    """
+    return bikejson.decode(x)
+
+
+def read_latest_stored(cnf, snapshots):
+    """read_latest_stored(cnf, snapshots)
+
+    Reads the latest snapshot stored (see `Snapshots.latest_stored()`)
+    from the live folder or, if already archived, from the archive of
+    the day (see `bikearchive.read_snapshot()`).
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config (live folder, archive, domain).
+    snapshots : Snapshots
+        Database handler for snapshots.
+
+    Return
+    ======
+    None, bikejson.Snapshot : Parsed json data; None if not found or
+    not matching the fingerprint.
+    """
+    import zipfile
+    import bikearchive
+    latest = snapshots.latest_stored()
+    if latest is None: return None
+
+    timestamp, x = latest[0], None
+    day  = dt.datetime.fromtimestamp(timestamp, dt.timezone.utc)
+    file = os.path.join(cnf.livedir, day.strftime("%Y"), day.strftime("%m"), day.strftime("%d"),
+                        f"{timestamp}_{cnf.domain}.json")
+    if os.path.isfile(file):
+        x = read_json(file)
+    else:
+        archive = bikearchive.get_archive(cnf.archivedir, cnf.domain, timestamp)
+        for file in [archive, archive + ".part"]:
+            if x is not None or not os.path.isfile(file): continue
+            try:
+                x = parse_json(bikearchive.read_snapshot(file, timestamp))
+            except (KeyError, zipfile.BadZipFile):
+                pass
+    return x if x is not None and bikejson.fingerprint(x) == latest[1] else None
+
+
+def process_snapshot(x, timestamp, places, rentals, bikes, trips = None):
+    """process_snapshot(x, timestamp, places, rentals, bikes, trips = None)
+
+    Params
+    ======
+    x : bikejson.Snapshot
+        Parsed json data (see `read_json()`).
+    timestamp : int
+        Timestamp of the snapshot.
+    places : Places
+        Database handler for places.
+    rentals : Rentals
+        Database handler for rentals.
+    bikes : Bikes
+        Database handler for bikes.
+    trips : None, Trips
+        Database handler for trips. If set, the trips
+        are updated using the current snapshot.
+
+    Return
+    ======
+    dict : Duration (seconds) of the stages (see `bikemetrics`).
+    """
+    if not isinstance(x, bikejson.Snapshot): raise TypeError("'x' must be bikejson.Snapshot")
+    if not isinstance(timestamp, int):       raise TypeError("'timestamp' must be int")
+
+    stages = {}
+
+    # Inserting places
+    print(f"  Found {len(x.places)} places to be inserted/updated")
+    tmp_places  = []
+    tmp_rentals = []
+    for rec in x.places:
+        # Official station or just a BIKE left somewhere
+        tmp_places.append(dict(id        = rec.uid,
+                               timestamp = timestamp if rec.name.startswith("BIKE") else None,
+                               name      = rec.name,
+                               lon       = rec.lng,
+                               lat       = rec.lat))
+
+        tmp_rentals.append(dict(place_id  = rec.uid,
+                                timestamp = timestamp,
+                                bikes     = rec.bikes,
+                                available = rec.bikes_available_to_rent))
+
+    with metrics.timer("ingest_stage", stages, stage = "places"):
+        places.bulk_insert(tmp_places)
+    with metrics.timer("ingest_stage", stages, stage = "rentals"):
+        rentals.bulk_insert(tmp_rentals)
+
+    # For each bike, extract the latest record used to check if a bike
+    # status or position has changed since last time (loaded from
+    # the database once, afterwards kept in memory).
+    with metrics.timer("ingest_stage", stages, stage = "previous_records"):
+        previous = bikes.get_previous_records()
+
+    # Inserting places
+    print(f"  Found {len(x.bikes)} bikes to be inserted/updated")
+    tmp_bikes = []
+    for rec in x.bikes:
+        # If the current bike is not in 'previous' (i.e., never seen before)
+        # we can add it to the database; we do so by using timestamp as
+        # 'first_seen' which will create a new line.
+        p = previous.get(str(rec.number))
+        if p is None:
+            first_seen = timestamp
+        # Else we check if the status of the bike has changed.
+        # If not, 'first_seen' is taken from the previous record, forcing
+        # the database to update the existing row (only updating 'last_seen' with
+        # current timestamp). However, if the status has changed
+        # we use timestamp as 'first_seen' triggering a new line in the table.
+        else:
+            first_seen = p["first_seen"]  # Default
+            if p["bike_type"] != rec.bike_type:
+                first_seen = timestamp # Type changed
+            elif p["place_id"] != rec.place_id:
+                first_seen = timestamp # Bike location changed
+            elif p["active"] != rec.active:
+                first_seen = timestamp # Active flag changed
+            elif p["state"] != rec.state:
+                first_seen = timestamp # Bike state changed
+            elif bikes.db.partition(p["first_seen"]) != bikes.db.partition(timestamp):
+                first_seen = timestamp # New partition (month)
+
+        # Append
+        tmp = dict(first_seen = first_seen,
+                   last_seen  = timestamp,
+                   number     = rec.number,
+                   bike_type  = rec.bike_type,
+                   active     = rec.active,
+                   state      = rec.state,
+                   place_id   = rec.place_id)
+        tmp_bikes.append(tmp)
+
+    # Updating trips; must be done before updating the bikes
+    if trips is not None:
+        with metrics.timer("ingest_stage", stages, stage = "trips"):
+            trips.update(previous, tmp_bikes, timestamp)
+
+    # Execute: Remember we have a unique constraint on 'number' and 'first_seen'
+    # which controls whether or not a row is updated, or a new is added (when
+    # the bike status changed).
+    with metrics.timer("ingest_stage", stages, stage = "bikes"):
+        bikes.bulk_insert_or_update(tmp_bikes)
+    del tmp_bikes
+
+    metrics.count("snapshots_total")
+    metrics.count("records_total", len(x.places), type = "places")
+    metrics.count("records_total", len(x.bikes), type = "bikes")
+    metrics.gauge("latest_snapshot_timestamp", timestamp)
+    return stages
+
+
+def process_heartbeat(timestamp, previous, rentals, bikes):
+    """process_heartbeat(timestamp, previous, rentals, bikes)
+
+    Processes a snapshot identical to the previous one (feed not refreshed,
+    see `bikejson.fingerprint()`); only extends the intervals seen in the
+    previous snapshot instead of running `process_snapshot()`.
+
+    Params
+    ======
+    timestamp : int
+        Timestamp of the heartbeat.
+    previous : int
+        Timestamp of the previous snapshot.
+    rentals : Rentals
+        Database handler for rentals.
+    bikes : Bikes
+        Database handler for bikes.
+
+    Return
+    ======
+    dict : Duration (seconds) of the stages (see `bikemetrics`).
+    """
+    if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+    if not isinstance(previous, int):  raise TypeError("'previous' must be int")
+
+    stages = {}
+    with metrics.timer("ingest_stage", stages, stage = "heartbeat"):
+        rentals.extend(timestamp)
+        bikes.extend(previous, timestamp)
+    metrics.count("heartbeats_total")
+    metrics.gauge("latest_snapshot_timestamp", timestamp)
+    return stages
+
+
+def is_heartbeat(db, snapshots, hash, timestamp, previous):
+    """is_heartbeat(db, snapshots, hash, timestamp, previous)
+
+    Params
+    ======
+    db : BikeDB
+        Database handler.
+    snapshots : Snapshots
+        Database handler for snapshots.
+    hash : str
+        Fingerprint of the current snapshot (see `bikejson.fingerprint()`).
+    timestamp : int
+        Timestamp of the current snapshot.
+    previous : None, int
+        Timestamp of the previous snapshot (latest processed).
+
+    Return
+    ======
+    bool : True if the snapshot is identical to the previous one and can
+    be processed as heartbeat (see `process_heartbeat()`). Never across
+    partitions (intervals do not span two months).
+    """
+    return previous is not None and snapshots.latest() == (previous, hash) and \
+           db.partition(previous) == db.partition(timestamp)
+
+
 if __name__ == "__main__":
 
     # Reading config file
@@ -75,6 +626,30 @@ if __name__ == "__main__":
     parser = ArgumentParser("Allows to process single files.")
     parser.add_argument("-f", "--file", type = str, default = None,
                         help = "If set it must be the path to a valid json file")
+    parser.add_argument("-a", "--archive", action = "store_true",
+                        help = "Process the daily zip archives instead of the live folder")
+    parser.add_argument("--start", type = dt.date.fromisoformat, default = None,
+                        help = "Archive mode; first date to process (YYYY-mm-dd)")
+    parser.add_argument("--end", type = dt.date.fromisoformat, default = None,
+                        help = "Archive mode; last date to process (YYYY-mm-dd)")
+    parser.add_argument("-b", "--batch", type = int, default = None,
+                        help = "Batch mode; process all files using one connection, " + \
+                               "committing every BATCH files (0: one single transaction)")
+    parser.add_argument("-s", "--stream", action = "store_true",
+                        help = "Parse json files record by record (the raw document and " + \
+                               "entries other than places and bikes are not held in memory)")
+    parser.add_argument("-j", "--jobs", type = int, default = 1,
+                        help = "Number of processes reading/decoding the files in parallel " + \
+                               "(written in order by the main process), defaults to 1")
+    parser.add_argument("-r", "--rollups", action = "store_true",
+                        help = "Rebuild the hourly/daily rentals aggregates (from the day of the " + \
+                               "oldest file in the live folder, or from --start on in archive mode) " + \
+                               "instead of processing new files")
+    parser.add_argument("--heartbeat", type = int, default = None,
+                        help = "Snapshot at this timestamp identical to the latest one (not stored " + \
+                               "by the downloader); extends the intervals of the latest snapshot")
+    parser.add_argument("--check", action = "store_true",
+                        help = "Check the query plans of the hot queries (fails on full table scans) and exit")
     args = parser.parse_args()
 
     # If args.file is not None we check if the argument is a valid
@@ -84,114 +659,201 @@ if __name__ == "__main__":
             raise ValueError("filename -f/--file not matching the expected file name")
         if not os.path.isfile(args.file):
             raise FileNotFoundError("file {args.file} not found")
+    if args.batch is not None and args.batch < 0:
+        raise ValueError("-b/--batch must be 0 or positive")
+    if args.jobs <= 0:
+        raise ValueError("-j/--jobs must be positive")
+    if args.archive and args.file is not None:
+        raise ValueError("-a/--archive and -f/--file cannot be combined")
+    if not args.archive and (args.start is not None or args.end is not None):
+        raise ValueError("--start/--end only allowed in combination with -a/--archive")
+    if args.heartbeat is not None and (args.file is not None or args.archive or args.rollups):
+        raise ValueError("--heartbeat cannot be combined with -f/--file, -a/--archive, or -r/--rollups")
+    if args.rollups and args.file is not None:
+        raise ValueError("-r/--rollups and -f/--file cannot be combined")
+
+    # Metrics (statsd, structured log) and profiling of slow snapshots.
+    # Prometheus text file (e.g., node exporter textfile collector) written
+    # on exit, adding to the counters of the previous runs (cron mode).
+    metrics.configure(statsd = cnf.metrics_statsd, log = cnf.metrics_log)
+    if cnf.metrics_file is not None:
+        import atexit
+        atexit.register(metrics.write_prometheus, cnf.metrics_file, accumulate = True)
+    profiler = None if cnf.profile_threshold is None else \
+               SlowProfiler(cnf.profile_threshold, cnf.profile_dir)
 
     # Initializing/setting up database connection and data handler
-    db      = BikeDB(cnf.connection_string)
-    Places  = Places(db)
-    Rentals = Rentals(db)
+    db      = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                     partitions = cnf.partitions)
+    Places  = Places(db, update_on_change = cnf.update_places)
+    Rentals = Rentals(db, rollups = cnf.rollups or args.rollups)
     Bikes   = Bikes(db)
+    Trips   = Trips(db)
+    Snapshots = Snapshots(db)
     db.create_all()
 
-    # Used to check if the place is an official station
-    # or just a BIKE left somewhere.
-    no_station = re.compile("^BIKE.*")
-
-    # Searching for available files in the live folder
+    if args.check:
+        handlers = [Rentals, Bikes, Trips, Snapshots] + ([] if Rentals.rollups is None else [Rentals.rollups])
+        db.check_queries(*handlers)
+        print("Query plans ok, no full table scans")
+        sys.exit(0)
+
+    # Rebuilding the rentals aggregates; deletes the aggregates from the
+    # first day processed on (live folder: day of the oldest file) and
+    # adds all snapshots (again).
+    if args.rollups:
+        if args.archive:
+            files,dates = get_zip_files(cnf.archivedir, cnf.domain, args.start, args.end)
+            snapshots = iter_zip_files(files, cnf.domain, args.stream, args.jobs)
+            start = None if args.start is None else \
+                    int(dt.datetime.combine(args.start, dt.time(), dt.timezone.utc).timestamp())
+            end   = None if args.end is None else \
+                    int(dt.datetime.combine(args.end, dt.time(23, 59, 59), dt.timezone.utc).timestamp())
+        else:
+            files,timestamps = get_json_files(cnf.livedir, cnf.domain)
+            snapshots = iter_json_files(files, timestamps, args.stream, args.jobs)
+            # Only the days in the live folder; older days are archived
+            start = None if len(timestamps) == 0 else timestamps[0] - timestamps[0] % 86400
+            end   = None
+        if len(files) == 0:
+            print("No files found, rentals aggregates not rebuilt")
+            sys.exit(0)
+        print(f"Rebuilding rentals aggregates from {len(files)} files")
+
+        with db.batch():
+            Rentals.rollups.delete(start, end)
+            rows = None
+            for i, (file, timestamp, x) in enumerate(snapshots):
+                print(f"Reading file \"{file}\"")
+                # Heartbeat; numbers of the previous snapshot
+                if x is None:
+                    if rows is None: continue
+                    rows = [dict(rec, timestamp = timestamp) for rec in rows]
+                else:
+                    rows = [dict(place_id  = rec.uid,
+                                 timestamp = timestamp,
+                                 bikes     = rec.bikes,
+                                 available = rec.bikes_available_to_rent) for rec in x.places]
+                Rentals.rollups.add(rows)
+                if args.batch and (i + 1) % args.batch == 0:
+                    db.commit()
+        sys.exit(0)
+
+    # Heartbeat; snapshot not stored by the downloader (identical to the latest)
+    if args.heartbeat is not None:
+        latest_entry, latest = Bikes.latest_entry(), Snapshots.latest()
+        if latest_entry is None or latest is None or not latest[0] == latest_entry:
+            raise Exception("no fingerprint of the latest snapshot, cannot process heartbeat")
+        if not latest_entry < args.heartbeat:
+            raise Exception(f"heartbeat {args.heartbeat} older than latest processed data ({latest_entry})")
+        if is_heartbeat(db, Snapshots, latest[1], args.heartbeat, latest_entry):
+            process_heartbeat(args.heartbeat, latest_entry, Rentals, Bikes)
+            Snapshots.add(args.heartbeat, latest[1], duplicate = True)
+            print(f"Heartbeat {args.heartbeat} processed")
+        else:
+            # New partition; intervals do not span two months, processing
+            # the previous (identical) snapshot again.
+            x = read_latest_stored(cnf, Snapshots)
+            if x is None:
+                metrics.count("heartbeats_lost_total")
+                logging.warning(f"Heartbeat {args.heartbeat} in a new partition, " + \
+                                "previous snapshot not found, ignored")
+                sys.exit(0)
+            process_snapshot(x, args.heartbeat, Places, Rentals, Bikes, Trips)
+            Snapshots.add(args.heartbeat, latest[1], duplicate = True)
+            print(f"Heartbeat {args.heartbeat} in a new partition processed as snapshot")
+        sys.exit(0)
+
+    # Optional columnar storage of the snapshots
+    columns = None if cnf.columnardir is None else ColumnWriter(cnf.columnardir, cnf.domain)
+
+    # Searching for available files in the live folder (or archive)
     if args.file is not None:
         tmp = re.search(f"^([0-9]+)_{cnf.domain}\\.json$", os.path.basename(args.file))
-        files      = [args.file]
-        timestamps = [int(tmp.group(1))]
+        snapshots = iter_json_files([args.file], [int(tmp.group(1))], args.stream)
+        nfiles    = 1
+    elif args.archive:
+        files,dates = get_zip_files(cnf.archivedir, cnf.domain, args.start, args.end)
+        snapshots = iter_zip_files(files, cnf.domain, args.stream, args.jobs)
+        nfiles    = len(files)
+        if nfiles > 0:
+            print(f"Found {nfiles} zip files to process in {cnf.archivedir}")
     else:
-        files,timestamps = get_json_files(cnf.livedir, cnf.domain)
-
-    if len(files) > 0:
-        print(f"Found {len(files)} json files to process in {cnf.livedir}")
-
-        for i in range(len(files)):
-            # We MUST process the files in order (oldest to newest) as else
-            # the system how we store the 'bikes' information will not be
-            # correct. Thus, loading the latest timestamp from the 'bikes'
-            # table and ensure that timestamps[i] > last recorded entry.
-            latest_entry = Bikes.latest_entry()
-            if not latest_entry is None and latest_entry >= timestamps[i]:
-                raise Exception(f"File {files[i]} older than latest processed data ({latest_entry}). Not allowed.")
-
-            # Parsing the file
-            print(f"Reading file \"{files[i]}\"")
-            with open(files[i], "r") as fid: x = "".join(fid.readlines())
-            x = json.loads(x)
-            if not "places" in x.keys() or not "bikes" in x.keys():
-                raise Exception("not found 'places' or 'bikes' in parsed json data")
-
-            # Inserting places
-            print(f"  Found {len(x['places'])} places to be inserted/updated")
-            tmp_places  = []
-            tmp_rentals = []
-            for rec in x["places"]:
-                tmp_places.append(dict(id        = rec["uid"],
-                                       timestamp = timestamps[i] if no_station.match(rec["name"]) else None,
-                                       name      = rec["name"],
-                                       lon       = rec["lng"],
-                                       lat       = rec["lat"]))
-
-                tmp_rentals.append(dict(place_id  = rec["uid"],
-                                        timestamp = timestamps[i],
-                                        bikes     = rec["bikes"],
-                                        available = rec["bikes_available_to_rent"]))
-
-            # 999 values per batch is absolute maximum
-            for chunk in chunked(tmp_places, 999 // len(tmp_places[0])):
-                Places.bulk_insert(chunk)
-            for chunk in chunked(tmp_rentals, 999 // len(tmp_rentals[0])):
-                Rentals.bulk_insert(chunk)
-
-            # For each bike, extract the latest record used to check if a bike
-            # status or position has changed since last time.
-            previous = Bikes.get_previous_records()
-
-            # Inserting places
-            print(f"  Found {len(x['bikes'])} bikes to be inserted/updated")
-            tmp_bikes = []
-            for rec in x["bikes"]:
-                # If the current bike is not in 'previous' (i.e., never seen before)
-                # we can add it to the database; we do so by using timestamps[i] as
-                # 'first_seen' which will create a new line.
-                if not str(rec["number"]) in previous.keys():
-                    first_seen = timestamps[i]
-                # Else we check if the status of the bike has changed.
-                # If not, 'first_seen' is taken from the previous record, forcing
-                # the database to update the existing row (only updating 'last_seen' with
-                # current timestamps[i]). However, if the status has changed
-                # we use timestamps[i] as 'first_seen' triggering a new line in the table.
+        # Only files newer than the latest processed data
+        files,timestamps = get_json_files(cnf.livedir, cnf.domain, Bikes.latest_entry())
+        snapshots = iter_json_files(files, timestamps, args.stream, args.jobs)
+        nfiles    = len(files)
+        if nfiles > 0:
+            print(f"Found {nfiles} new json files to process in {cnf.livedir}")
+
+    if nfiles > 0:
+        # We MUST process the files in order (oldest to newest) as else
+        # the system how we store the 'bikes' information will not be
+        # correct. Thus, loading the latest timestamp from the 'bikes'
+        # table and ensure that timestamp > last recorded entry.
+        # Loaded once, afterwards tracked in memory.
+        latest_entry = Bikes.latest_entry()
+        # Latest snapshot read (heartbeats in a new partition)
+        previous = None
+
+        # In batch mode all files are processed using one single
+        # connection; else each handler call runs its own transaction.
+        with (db.batch() if args.batch is not None else nullcontext()):
+            for i, (file, timestamp, x) in enumerate(snapshots):
+                if not latest_entry is None and latest_entry >= timestamp:
+                    raise Exception(f"File {file} older than latest processed data ({latest_entry}). Not allowed.")
+
+                # Heartbeat not stored by the downloader (identical to the
+                # previous snapshot). Intervals do not span two months, in
+                # a new partition the previous snapshot is processed again.
+                if x is None and latest_entry is not None and \
+                        not db.partition(latest_entry) == db.partition(timestamp):
+                    print(f"Heartbeat {timestamp} (\"{file}\") in a new partition")
+                    x = previous if previous is not None else read_latest_stored(cnf, Snapshots)
+                    if x is None:
+                        metrics.count("heartbeats_lost_total")
+                        logging.warning(f"Heartbeat {timestamp} in a new partition, " + \
+                                        "previous snapshot not found, ignored")
+                        continue
+                    with (profiler.profile(str(timestamp)) if profiler is not None else nullcontext()):
+                        stages = process_snapshot(x, timestamp, Places, Rentals, Bikes, Trips)
+                    if columns is not None: columns.append(x, timestamp)
+                    if cnf.dedup: Snapshots.add(timestamp, bikejson.fingerprint(x), duplicate = True)
+                    metrics.event("snapshot", timestamp = timestamp, file = file, places = len(x.places),
+                                  bikes = len(x.bikes), duplicate = True, stages = stages)
+
+                elif x is None:
+                    print(f"Heartbeat {timestamp} (\"{file}\")")
+                    if latest_entry is None:
+                        metrics.count("heartbeats_lost_total")
+                        logging.warning(f"Heartbeat {timestamp} without previous snapshot, ignored")
+                        continue
+                    stages = process_heartbeat(timestamp, latest_entry, Rentals, Bikes)
+                    latest = Snapshots.latest() if cnf.dedup else None
+                    if latest is not None and latest[0] == latest_entry:
+                        Snapshots.add(timestamp, latest[1], duplicate = True)
+                    metrics.event("snapshot", timestamp = timestamp, file = file,
+                                  duplicate = True, stages = stages)
+
+                # Processing the file; snapshots identical to the
+                # previous one are only processed as heartbeat.
                 else:
-                    p = previous[str(rec["number"])]
-                    first_seen = p["first_seen"]  # Default
-                    if p["bike_type"] != rec["bike_type"]:
-                        first_seen = timestamps[i] # Type changed
-                    elif p["place_id"] != rec["place_id"]:
-                        first_seen = timestamps[i] # Bike location changed
-                    elif p["active"] != rec["active"]:
-                        first_seen = timestamps[i] # Active flag changed
-                    elif p["state"] != rec["state"]:
-                        first_seen = timestamps[i] # Bike state changed
-
-                # Append
-                tmp = dict(first_seen = first_seen,
-                           last_seen  = timestamps[i],
-                           number     = int(rec["number"]),
-                           bike_type  = rec["bike_type"],
-                           active     = rec["active"],
-                           state      = rec["state"],
-                           place_id   = rec["place_id"])
-                tmp_bikes.append(tmp)
-
-            # Execute: Remember we have a unique constraint on 'number' and 'first_seen'
-            # which controls whether or not a row is updated, or a new is added (when
-            # the bike status changed).
-            # 999 values per batch is absolute maximum
-            for chunk in chunked(tmp_bikes, 999 // len(tmp_bikes[0])):
-                Bikes.bulk_insert_or_update(chunk)
-            del tmp_bikes
-
-
-
+                    print(f"Reading file \"{file}\"")
+                    hash      = bikejson.fingerprint(x) if cnf.dedup else None
+                    duplicate = hash is not None and is_heartbeat(db, Snapshots, hash, timestamp, latest_entry)
+                    if duplicate:
+                        print("  Identical to previous snapshot, heartbeat only")
+                        stages = process_heartbeat(timestamp, latest_entry, Rentals, Bikes)
+                    else:
+                        with (profiler.profile(str(timestamp)) if profiler is not None else nullcontext()):
+                            stages = process_snapshot(x, timestamp, Places, Rentals, Bikes, Trips)
+                        if columns is not None: columns.append(x, timestamp)
+                    if hash is not None: Snapshots.add(timestamp, hash, duplicate)
+                    metrics.event("snapshot", timestamp = timestamp, file = file, places = len(x.places),
+                                  bikes = len(x.bikes), duplicate = duplicate, stages = stages)
+                    previous = x
+                latest_entry = timestamp
+
+                # Intermediate commit if requested
+                if args.batch and (i + 1) % args.batch == 0:
+                    db.commit()
@@ -0,0 +1,319 @@
+# -------------------------------------------------------------------
+# Streaming daily archives. Snapshots are appended to the archive of
+# the day (<archivedir>/<YYYY-mm-dd>_<domain>.zip.part) as they arrive,
+# alongside an index (.idx, one line per snapshot: timestamp, offset of
+# the zip member, compressed and uncompressed size). Only the members
+# are appended (constant time); the zip directory is written from the
+# index once the day is completed (see `finalize()`) instead of
+# compressing the whole day at once. The index allows to read any
+# snapshot of an archive without the zip directory (see `read_snapshot()`).
+# -------------------------------------------------------------------
+
+import os
+import re
+import time
+import zlib
+import shutil
+import struct
+import zipfile
+import datetime as dt
+
+
+def get_archive(dir, domain, timestamp):
+    """get_archive(dir, domain, timestamp)
+
+    Params
+    ======
+    dir : str
+        Archive directory.
+    domain : str
+        Domain used for file names.
+    timestamp : int
+        Timestamp of the snapshot.
+
+    Return
+    ======
+    str : Name of the (finalized) archive of the day (UTC) of `timestamp`;
+    the archive of the current day carries the suffix '.part'.
+    """
+    if not isinstance(dir, str):       raise TypeError("'dir' must be str")
+    if not isinstance(domain, str):    raise TypeError("'domain' must be str")
+    if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+    date = dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime("%Y-%m-%d")
+    return os.path.join(dir, f"{date}_{domain}.zip")
+
+
+def get_index(archive):
+    """get_index(archive)
+
+    Return
+    ======
+    str : Name of the index of `archive` (with or without '.part').
+    """
+    return re.sub(r"\.zip(\.part)?$", "", archive) + ".idx"
+
+
+def append(dir, domain, timestamp, content):
+    """append(dir, domain, timestamp, content)
+
+    Appends a snapshot (member '<timestamp>_<domain>.json') to the archive
+    of the day (see `get_archive()`, suffix '.part') and adds it to the index.
+    Only the member (local header and compressed data) is written, no
+    zip directory (see `finalize()`).
+
+    Params
+    ======
+    dir : str
+        Archive directory.
+    domain : str
+        Domain used for file names.
+    timestamp : int
+        Timestamp of the snapshot.
+    content : str
+        Content of the snapshot (json).
+    """
+    if not isinstance(content, str): raise TypeError("'content' must be str")
+    file = get_archive(dir, domain, timestamp) + ".part"
+    os.makedirs(dir, exist_ok = True)
+
+    data = content.encode("utf-8")
+    comp = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    raw  = comp.compress(data) + comp.flush()
+    info = zipfile.ZipInfo(f"{timestamp}_{domain}.json", time.localtime(timestamp)[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC           = zlib.crc32(data)
+    info.compress_size = len(raw)
+    info.file_size     = len(data)
+    with open(file, "ab") as fid:
+        fid.seek(0, 2)
+        info.header_offset = fid.tell()
+        fid.write(info.FileHeader() + raw)
+    with open(get_index(file), "a") as fid:
+        fid.write(f"{timestamp},{info.header_offset},{info.compress_size},{info.file_size}\n")
+
+
+def load_index(archive):
+    """load_index(archive)
+
+    Params
+    ======
+    archive : str
+        Name of the archive.
+
+    Return
+    ======
+    dict : Keys are the timestamps of the snapshots, the items tuples with
+    offset (zip member), compressed and uncompressed size. Empty if no
+    index exists (e.g., archives created by `downloader.archive_yesterday()`).
+    """
+    res  = {}
+    file = get_index(archive)
+    if not os.path.isfile(file): return res
+    with open(file, "r") as fid:
+        for line in fid:
+            tmp = [int(x) for x in line.split(",")]
+            if len(tmp) == 4: res[tmp[0]] = tuple(tmp[1:])
+    return res
+
+
+def build_index(archive, domain):
+    """build_index(archive, domain)
+
+    (Re)builds the index of an existing archive (e.g., archives created
+    by `downloader.archive_yesterday()`) from the zip directory.
+
+    Params
+    ======
+    archive : str
+        Name of the archive.
+    domain : str
+        Domain used for file names.
+
+    Return
+    ======
+    int : Number of snapshots in the index.
+    """
+    pat = re.compile(f"^([0-9]+)_{domain}\\.json$")
+    res = []
+    with zipfile.ZipFile(archive, "r") as fid:
+        for info in fid.infolist():
+            tmp = pat.match(os.path.basename(info.filename))
+            if tmp: res.append((int(tmp.group(1)), info.header_offset, info.compress_size, info.file_size))
+    with open(get_index(archive) + ".tmp", "w") as fid:
+        for x in sorted(res): fid.write(",".join([str(v) for v in x]) + "\n")
+    os.replace(get_index(archive) + ".tmp", get_index(archive))
+    return len(res)
+
+
+def read_snapshot(archive, timestamp, index = None):
+    """read_snapshot(archive, timestamp, index = None)
+
+    Reads one snapshot from an archive. Using the index only the
+    member itself is read; falls back to the zip directory if the
+    archive has no index.
+
+    Params
+    ======
+    archive : str
+        Name of the archive.
+    timestamp : int
+        Timestamp of the snapshot.
+    index : None, dict
+        Index of the archive (see `load_index()`); loaded if None.
+
+    Return
+    ======
+    bytes : Content of the snapshot.
+    """
+    if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+    if index is None: index = load_index(archive)
+
+    if not timestamp in index:
+        with zipfile.ZipFile(archive, "r") as fid:
+            names = [x for x in fid.namelist() if os.path.basename(x).startswith(f"{timestamp}_")]
+            if len(names) == 0:
+                raise KeyError(f"snapshot {timestamp} not found in {archive}")
+            return fid.read(names[0])
+
+    offset, compress_size, file_size = index[timestamp]
+    with open(archive, "rb") as fid:
+        fid.seek(offset)
+        header = fid.read(30)
+        if not header[:4] == b"PK\x03\x04":
+            raise Exception(f"invalid index for snapshot {timestamp} in {archive}")
+        method = struct.unpack("<H", header[8:10])[0]
+        fid.seek(sum(struct.unpack("<HH", header[26:30])), 1) # File name and extra field
+        data = fid.read(compress_size)
+    if method == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    elif not method == zipfile.ZIP_STORED:
+        raise NotImplementedError(f"compression method {method} not supported")
+    if not len(data) == file_size:
+        raise Exception(f"snapshot {timestamp} in {archive} is corrupt")
+    return data
+
+
+def write_directory(archive):
+    """write_directory(archive)
+
+    Writes the zip directory of the members listed in the index (see
+    `append()`) at the end of the archive. Members not in the index
+    (e.g., interrupted appends) are not included.
+
+    Params
+    ======
+    archive : str
+        Name of the archive.
+
+    Return
+    ======
+    None, set : Names of the members; None if the archive has no index
+    or does not match the index.
+    """
+    index = load_index(archive)
+    if len(index) == 0: return None
+
+    infos = []
+    with open(archive, "r+b") as fid:
+        for timestamp, (offset, compress_size, file_size) in sorted(index.items(), key = lambda x: x[1]):
+            fid.seek(offset)
+            header = fid.read(30)
+            if not len(header) == 30 or not header[:4] == b"PK\x03\x04": return None
+            flags, method, dostime, dosdate, crc = struct.unpack("<HHHHL", header[6:18])
+            name = fid.read(struct.unpack("<H", header[26:28])[0]).decode("utf-8")
+            info = zipfile.ZipInfo(name, ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+                                          dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2))
+            info.flag_bits     = flags
+            info.compress_type = method
+            info.CRC           = crc
+            info.compress_size = compress_size
+            info.file_size     = file_size
+            info.header_offset = offset
+            info.external_attr = 0o600 << 16
+            infos.append(info)
+
+        # Directory appended after the last member
+        fid.seek(0, 2)
+        with zipfile.ZipFile(fid, "w") as out:
+            for info in infos:
+                out.filelist.append(info)
+                out.NameToInfo[info.filename] = info
+    return set([x.filename for x in infos])
+
+
+def finalize(dir, domain, date, livedir = None):
+    """finalize(dir, domain, date, livedir = None)
+
+    Finalizes the archive of a completed day (writes the zip directory,
+    see `write_directory()`, and removes the suffix '.part'). The
+    heartbeat file of the day (if any) is added. If `livedir` is given,
+    the archive is checked against the json files of the day in the live
+    folder; if incomplete (e.g., archive not updated or damaged) it is
+    rebuilt from the live folder. The folder of the day is deleted afterwards.
+
+    Params
+    ======
+    dir : str
+        Archive directory.
+    domain : str
+        Domain used for file names.
+    date : datetime.date
+        Day to be finalized.
+    livedir : None, str
+        Live folder of the domain.
+
+    Return
+    ======
+    str : Name of the archive.
+    """
+    if not isinstance(date, dt.date): raise TypeError("'date' must be datetime.date")
+    file = os.path.join(dir, f"{date.strftime('%Y-%m-%d')}_{domain}.zip")
+    day  = None if livedir is None else \
+           os.path.join(livedir, date.strftime("%Y"), date.strftime("%m"), date.strftime("%d"))
+    if day is not None and not os.path.isdir(day): day = None
+
+    # Checking the archive against the live folder
+    members = None
+    if os.path.isfile(file + ".part"):
+        write_directory(file + ".part")
+        try:
+            with zipfile.ZipFile(file + ".part", "r") as fid:
+                members = set(fid.namelist())
+        except zipfile.BadZipFile:
+            members = None
+    if day is not None:
+        expected = set([x for x in os.listdir(day) if x.endswith(f"_{domain}.json")])
+        if members is None or not expected <= members:
+            shutil.make_archive(file[:-4] + ".tmp", "zip", day)
+            os.replace(file[:-4] + ".tmp.zip", file + ".part")
+            build_index(file + ".part", domain)
+            # All files of the folder of the day, including the heartbeats
+            with zipfile.ZipFile(file + ".part", "r") as fid:
+                members = set(fid.namelist())
+    if members is None:
+        raise Exception(f"no archive to finalize for {date} ({domain})")
+
+    # Adding heartbeats (see downloader.write_heartbeat())
+    heartbeats = None if day is None else os.path.join(day, f"heartbeats_{domain}.txt")
+    if heartbeats is not None and os.path.isfile(heartbeats) and \
+            not os.path.basename(heartbeats) in members:
+        with zipfile.ZipFile(file + ".part", "a", compression = zipfile.ZIP_DEFLATED) as fid:
+            fid.write(heartbeats, os.path.basename(heartbeats))
+
+    os.replace(file + ".part", file)
+    if day is not None: shutil.rmtree(day)
+    return file
+
+
+def list_open(dir, domain, before):
+    """list_open(dir, domain, before)
+
+    Return
+    ======
+    list of datetime.date : Days with an archive not yet finalized
+    (suffix '.part') before the date `before`, sorted.
+    """
+    pat = re.compile(f"^([0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}})_{re.escape(domain)}\\.zip\\.part$")
+    res = [pat.match(x) for x in os.listdir(dir)] if os.path.isdir(dir) else []
+    res = [dt.date.fromisoformat(x.group(1)) for x in res if x]
+    return sorted([x for x in res if x < before])
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Ingest benchmark. Generates synthetic nextbike (flat)json snapshots
+# and replays them through the ingest (decoding, process_snapshot)
+# against a fresh database. Reports throughput, per-snapshot latency,
+# database size and peak memory; results are appended to a json lines
+# file together with the git commit such that regressions show up
+# across commits.
+# -------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import subprocess
+import datetime as dt
+from contextlib import redirect_stdout
+
+
+# -------------------------------------------------------------------
+# Synthetic feed
+# -------------------------------------------------------------------
+def generate_snapshots(n, start = 1700000000, interval = 60, places = 300, bikes = 2000,
+                       free_floating = 50, move_rate = 0.01, rent_rate = 0.005,
+                       state_rate = 0.001, seed = 1):
+    """generate_snapshots(n, start = 1700000000, interval = 60, places = 300, bikes = 2000,
+                          free_floating = 50, move_rate = 0.01, rent_rate = 0.005,
+                          state_rate = 0.001, seed = 1)
+
+    Params
+    ======
+    n : int
+        Number of snapshots.
+    start : int
+        Timestamp of the first snapshot.
+    interval : int
+        Seconds between two snapshots.
+    places : int
+        Number of stations.
+    bikes : int
+        Number of bikes.
+    free_floating : int
+        Maximum number of bikes left outside a station ('BIKE <number>' places).
+    move_rate : float
+        Probability per bike and snapshot to be moved to another station.
+    rent_rate : float
+        Probability per bike and snapshot to be rented (missing from
+        the feed for a while; returned to a random station or left
+        outside a station).
+    state_rate : float
+        Probability per bike and snapshot to change its state.
+    seed : int
+        Seed of the random number generator.
+
+    Return
+    ======
+    generator : Yields tuples with timestamp and the content of
+    the json file (bytes).
+    """
+    for x in ["n", "start", "interval", "places", "bikes", "free_floating", "seed"]:
+        if not isinstance(locals()[x], int): raise TypeError(f"'{x}' must be int")
+    rng = random.Random(seed)
+
+    stations = {uid: dict(uid = uid, name = f"Station {uid}",
+                          lng = 11.35 + rng.random() * 0.1, lat = 47.24 + rng.random() * 0.05)
+                for uid in range(1, places + 1)}
+    position = {number: rng.randint(1, places) for number in range(10000, 10000 + bikes)}
+    state    = {number: "ok" for number in position.keys()}
+    rented   = {}   # number: snapshots until returned
+    floating = {}   # number: (lng, lat) of bikes left outside a station
+
+    for i in range(n):
+        for number in position.keys():
+            if number in rented:
+                rented[number] -= 1
+                if rented[number] <= 0:
+                    del rented[number]
+                    if len(floating) < free_floating and rng.random() < 0.2:
+                        floating[number] = (11.35 + rng.random() * 0.1, 47.24 + rng.random() * 0.05)
+                    else:
+                        position[number] = rng.randint(1, places)
+            elif rng.random() < rent_rate:
+                rented[number] = rng.randint(5, 30)
+                floating.pop(number, None)
+            elif rng.random() < move_rate:
+                position[number] = rng.randint(1, places)
+                floating.pop(number, None)
+            if rng.random() < state_rate:
+                state[number] = "damaged" if state[number] == "ok" else "ok"
+
+        # Places; stations and bikes left outside a station
+        count = {}
+        for number in position.keys():
+            if number in rented or number in floating: continue
+            count[position[number]] = count.get(position[number], 0) + 1
+        res_places = [dict(uid = x["uid"], name = x["name"], lng = x["lng"], lat = x["lat"],
+                           bikes = count.get(uid, 0),
+                           bikes_available_to_rent = count.get(uid, 0))
+                      for uid, x in stations.items()]
+        res_bikes = []
+        for number, place_id in position.items():
+            if number in rented: continue
+            if number in floating:
+                place_id = 100000 + number
+                res_places.append(dict(uid = place_id, name = f"BIKE {number}",
+                                       lng = floating[number][0], lat = floating[number][1],
+                                       bikes = 1, bikes_available_to_rent = 1))
+            res_bikes.append(dict(number = str(number), bike_type = 150, active = True,
+                                  state = state[number], place_id = place_id))
+
+        yield start + i * interval, json.dumps(dict(places = res_places, bikes = res_bikes)).encode()
+
+
+def write_snapshots(dir, domain, snapshots):
+    """write_snapshots(dir, domain, snapshots)
+
+    Writes snapshots into a live folder (YYYY/mm/dd/<timestamp>_<domain>.json).
+
+    Params
+    ======
+    dir : str
+        Live folder.
+    domain : str
+        Domain used for the file names.
+    snapshots : iterable
+        Tuples with timestamp and content (see `generate_snapshots()`).
+
+    Return
+    ======
+    int : Number of files written.
+    """
+    n = 0
+    for timestamp, content in snapshots:
+        date = dt.datetime.fromtimestamp(timestamp, dt.timezone.utc)
+        path = os.path.join(dir, date.strftime("%Y"), date.strftime("%m"), date.strftime("%d"))
+        os.makedirs(path, exist_ok = True)
+        with open(os.path.join(path, f"{timestamp}_{domain}.json"), "wb") as fid:
+            fid.write(content)
+        n += 1
+    return n
+
+
+# -------------------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------------------
+def _percentile(x, p):
+    x = sorted(x)
+    return x[min(len(x) - 1, int(round(p / 100. * (len(x) - 1))))] if len(x) > 0 else None
+
+
+def _db_size(db):
+    """_db_size(db)
+
+    Return
+    ======
+    None, int : Size of the SQLite database in bytes (including the
+    write-ahead log), None for other databases.
+    """
+    if not db.engine.dialect.name == "sqlite" or not db.engine.url.database: return None
+    file = db.engine.url.database
+    return sum([os.path.getsize(x) for x in [file, file + "-wal"] if os.path.isfile(x)])
+
+
+def run(connection_string, snapshots, batch = None, rollups = False):
+    """run(connection_string, snapshots, batch = None, rollups = False)
+
+    Replays the snapshots through the ingest (decoding and `process_snapshot()`).
+
+    Params
+    ======
+    connection_string : str
+        Connection string; the database should be empty.
+    snapshots : iterable
+        Tuples with timestamp and content (see `generate_snapshots()`).
+    batch : None, int
+        If set, batch mode committing every `batch` snapshots (0: once at the end).
+    rollups : bool
+        If True the rentals aggregates are maintained as well.
+
+    Return
+    ======
+    dict : Benchmark results.
+    """
+    from bikedb import BikeDB, Places, Rentals, Bikes, Trips
+    from alchemy import parse_json, process_snapshot
+    from contextlib import nullcontext
+
+    db      = BikeDB(connection_string, pragmas = dict(journal_mode = "WAL", synchronous = "NORMAL"))
+    places  = Places(db)
+    rentals = Rentals(db, rollups = rollups)
+    bikes   = Bikes(db)
+    trips   = Trips(db)
+    db.create_all()
+    size = _db_size(db)
+
+    latency, rows = [], 0
+    t0 = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        with (db.batch() if batch is not None else nullcontext()):
+            for i, (timestamp, content) in enumerate(snapshots):
+                t = time.perf_counter()
+                x = parse_json(content)
+                process_snapshot(x, timestamp, places, rentals, bikes, trips)
+                if batch and (i + 1) % batch == 0: db.commit()
+                latency.append(time.perf_counter() - t)
+                rows += len(x.places) + len(x.bikes)
+    elapsed = time.perf_counter() - t0
+
+    # Peak resident set size (kilobytes on Linux, bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": rss //= 1024
+
+    return dict(snapshots          = len(latency),
+                rows               = rows,
+                seconds            = round(elapsed, 3),
+                snapshots_per_sec  = round(len(latency) / elapsed, 2),
+                rows_per_sec       = round(rows / elapsed, 1),
+                latency_p50_ms     = round(_percentile(latency, 50) * 1000, 3),
+                latency_p99_ms     = round(_percentile(latency, 99) * 1000, 3),
+                db_size_growth     = None if size is None else _db_size(db) - size,
+                peak_rss_kb        = rss)
+
+
+def git_commit():
+    """git_commit()
+
+    Return
+    ======
+    None, str : Current git commit (short hash), None if not available.
+    """
+    try:
+        res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True,
+                             text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+    except Exception:
+        return None
+    return res.stdout.strip() if res.returncode == 0 else None
+
+
+# -------------------------------------------------------------------
+# Main part
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser("Ingest benchmark using synthetic snapshots.")
+    parser.add_argument("-n", "--snapshots", type = int, default = 200,
+                        help = "Number of snapshots, defaults to 200")
+    parser.add_argument("--places", type = int, default = 300,
+                        help = "Number of stations, defaults to 300")
+    parser.add_argument("--bikes", type = int, default = 2000,
+                        help = "Number of bikes, defaults to 2000")
+    parser.add_argument("--free", type = int, default = 50,
+                        help = "Maximum number of bikes outside a station (BIKE places), defaults to 50")
+    parser.add_argument("--move-rate", type = float, default = 0.01,
+                        help = "Probability per bike and snapshot to be moved, defaults to 0.01")
+    parser.add_argument("--rent-rate", type = float, default = 0.005,
+                        help = "Probability per bike and snapshot to be rented, defaults to 0.005")
+    parser.add_argument("--state-rate", type = float, default = 0.001,
+                        help = "Probability per bike and snapshot to change the state, defaults to 0.001")
+    parser.add_argument("--seed", type = int, default = 1,
+                        help = "Seed of the random number generator, defaults to 1")
+    parser.add_argument("-c", "--connection", type = str, default = "sqlite+pysqlite:///bikebench.db",
+                        help = "Connection string (empty database), defaults to 'sqlite+pysqlite:///bikebench.db' " + \
+                               "which is deleted before the benchmark")
+    parser.add_argument("-b", "--batch", type = int, default = None,
+                        help = "Batch mode, committing every BATCH snapshots (0: one single transaction)")
+    parser.add_argument("-r", "--rollups", action = "store_true",
+                        help = "Maintain the rentals aggregates as well")
+    parser.add_argument("-w", "--write", type = str, default = None,
+                        help = "Only write the snapshots into this live folder (no benchmark)")
+    parser.add_argument("-o", "--output", type = str, default = "bikebench.jsonl",
+                        help = "File the results are appended to, defaults to 'bikebench.jsonl'")
+    args = parser.parse_args()
+
+    feed = dict(n = args.snapshots, places = args.places, bikes = args.bikes,
+                free_floating = args.free, move_rate = args.move_rate,
+                rent_rate = args.rent_rate, state_rate = args.state_rate, seed = args.seed)
+
+    if args.write is not None:
+        n = write_snapshots(args.write, "bench", generate_snapshots(**feed))
+        print(f"Written {n} snapshots to {args.write}")
+        sys.exit(0)
+
+    # Default database is recreated for each run
+    if args.connection == parser.get_default("connection"):
+        for x in ["bikebench.db", "bikebench.db-wal", "bikebench.db-shm"]:
+            if os.path.isfile(x): os.remove(x)
+
+    # Generating snapshots first; not part of the timing
+    snapshots = list(generate_snapshots(**feed))
+    res = run(args.connection, snapshots, args.batch, args.rollups)
+
+    # Previous result with the same settings
+    settings = dict(feed, batch = args.batch, rollups = args.rollups,
+                    dialect = args.connection.split(":")[0].split("+")[0])
+    previous = None
+    if os.path.isfile(args.output):
+        with open(args.output, "r") as fid:
+            for line in fid:
+                tmp = json.loads(line)
+                if tmp["settings"] == settings: previous = tmp
+
+    record = dict(date     = dt.datetime.now(dt.timezone.utc).isoformat(timespec = "seconds"),
+                  commit   = git_commit(),
+                  settings = settings,
+                  results  = res)
+    with open(args.output, "a") as fid:
+        fid.write(json.dumps(record) + "\n")
+
+    for k, v in res.items():
+        change = ""
+        if previous is not None and previous["results"].get(k) and v is not None:
+            change = f"  ({(v / previous['results'][k] - 1) * 100:+.1f}% vs {previous['commit']})"
+        print(f"{k:20s} {v}{change}")
@@ -0,0 +1,308 @@
+# -------------------------------------------------------------------
+# Columnar storage of snapshots. Each day is stored in its own
+# directory <dir>/YYYY-mm-dd_<domain>/ with one binary file per column
+# (<table>.<column>.<type>, raw little-endian values) to which the
+# records of each snapshot are appended. String columns are dictionary
+# encoded (dictionary.json). The files can be memory-mapped (see
+# read_day()), or read via numpy.fromfile or R's readBin().
+# -------------------------------------------------------------------
+
+import os
+import sys
+import json
+import mmap
+import datetime as dt
+from array import array
+from bisect import bisect_left
+
+
+# Columns; name: (array typecode, type name used as file extension)
+COLUMNS = {
+    "places": {"timestamp": ("q", "int64"),
+               "uid":       ("i", "int32"),
+               "name":      ("i", "int32"),   # Dictionary encoded
+               "lng":       ("f", "float32"),
+               "lat":       ("f", "float32"),
+               "bikes":     ("i", "int32"),
+               "available": ("i", "int32")},
+    "bikes":  {"timestamp": ("q", "int64"),
+               "number":    ("i", "int32"),
+               "bike_type": ("i", "int32"),
+               "active":    ("b", "int8"),
+               "state":     ("i", "int32"),   # Dictionary encoded
+               "place_id":  ("i", "int32")}
+}
+
+# Dictionary encoded columns
+DICTIONARY = ["name", "state"]
+
+
+def get_daydir(dir, domain, date):
+    """get_daydir(dir, domain, date)
+
+    Params
+    ======
+    dir : str
+        Parent directory.
+    domain : str
+        Domain used for the directory name.
+    date : datetime.date
+        Date.
+
+    Return
+    ======
+    str : Returns the directory containing the columns of this day.
+    """
+    if not isinstance(dir, str):      raise TypeError("'dir' must be str")
+    if not isinstance(domain, str):   raise TypeError("'domain' must be str")
+    if not isinstance(date, dt.date): raise TypeError("'date' must be datetime.date")
+    return os.path.join(dir, f"{date.strftime('%Y-%m-%d')}_{domain}")
+
+
+def read_dictionary(dir, domain, date):
+    """read_dictionary(dir, domain, date)
+
+    Params
+    ======
+    dir : str
+        Parent directory.
+    domain : str
+        Domain used for the directory name.
+    date : datetime.date
+        Date.
+
+    Return
+    ======
+    dict : Dictionary for each dictionary encoded column (see `DICTIONARY`);
+    list of str where the position corresponds to the code stored.
+    """
+    file = os.path.join(get_daydir(dir, domain, date), "dictionary.json")
+    if not os.path.isfile(file):
+        return {x: [] for x in DICTIONARY}
+    with open(file, "r") as fid: return json.load(fid)
+
+
+def _count_rows(daydir, table):
+    """_count_rows(daydir, table)
+
+    Return
+    ======
+    int : Number of complete rows of `table` in the directory of a day;
+    the last snapshot may have been written partially to some of the
+    columns (crash while appending).
+    """
+    nrow = None
+    for column, (typecode, typename) in COLUMNS[table].items():
+        file = os.path.join(daydir, f"{table}.{column}.{typename}")
+        size = os.path.getsize(file) if os.path.isfile(file) else 0
+        n    = size // array(typecode).itemsize
+        nrow = n if nrow is None else min(nrow, n)
+    return nrow
+
+
+# -------------------------------------------------------------------
+# Writer
+# -------------------------------------------------------------------
+class ColumnWriter:
+
+    def __init__(self, dir, domain):
+        """ColumnWriter(dir, domain)
+
+        Appends snapshots to the daily column files.
+
+        Params
+        ======
+        dir : str
+            Parent directory, created if needed.
+        domain : str
+            Domain used for the directory names.
+        """
+        if not isinstance(dir, str):    raise TypeError("'dir' must be str")
+        if not isinstance(domain, str): raise TypeError("'domain' must be str")
+
+        self.dir    = dir
+        self.domain = domain
+
+        # Dictionary of the current day ({column: {value: code}})
+        self._date       = None
+        self._dictionary = None
+        self._modified   = False
+        # Day whose column files are known to be aligned (see _truncate())
+        self._aligned    = None
+
+    def _get_dictionary(self, date):
+        """_get_dictionary(date)
+
+        Return
+        ======
+        dict : Mapping value -> code for each dictionary encoded
+        column of the day; loaded once per day.
+        """
+        if self._date != date:
+            tmp = read_dictionary(self.dir, self.domain, date)
+            self._dictionary = {k: {x: i for i, x in enumerate(v)} for k, v in tmp.items()}
+            self._date       = date
+        return self._dictionary
+
+    def _encode(self, column, value):
+        """_encode(column, value)
+
+        Return
+        ======
+        int : Code of `value` in the dictionary of `column`, new values are added.
+        """
+        lookup = self._dictionary[column]
+        code   = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(lookup)
+            self._modified = True
+        return code
+
+    def _truncate(self, daydir, timestamp):
+        """_truncate(daydir, timestamp)
+
+        Truncates all column files of a day to the number of complete
+        rows of the table (removes a partially written snapshot) such
+        that new snapshots are appended aligned. Rows of snapshots at or
+        after `timestamp` (processed again) are removed as well.
+        """
+        for table in COLUMNS.keys():
+            nrow = _count_rows(daydir, table)
+            if nrow > 0:
+                times = array("q")
+                with open(os.path.join(daydir, f"{table}.timestamp.int64"), "rb") as fid:
+                    times.fromfile(fid, nrow)
+                if sys.byteorder == "big": times.byteswap()
+                nrow = bisect_left(times, timestamp)
+            for column, (typecode, typename) in COLUMNS[table].items():
+                file = os.path.join(daydir, f"{table}.{column}.{typename}")
+                size = nrow * array(typecode).itemsize
+                if os.path.isfile(file) and os.path.getsize(file) > size:
+                    os.truncate(file, size)
+
+    def append(self, x, timestamp):
+        """append(x, timestamp)
+
+        Params
+        ======
+        x : bikejson.Snapshot
+            Parsed snapshot.
+        timestamp : int
+            Timestamp of the snapshot, defines the day.
+        """
+        if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+
+        date   = dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).date()
+        daydir = get_daydir(self.dir, self.domain, date)
+        if not os.path.isdir(daydir):
+            try:
+                os.makedirs(daydir)
+            except Exception as e:
+                raise Exception(e)
+
+        # Once per day (or after a failed append); removing the
+        # remains of a snapshot not written completely
+        if self._aligned != date:
+            self._truncate(daydir, timestamp)
+
+        self._get_dictionary(date)
+        self._modified = False
+
+        data = {
+            "places": {"timestamp": [timestamp] * len(x.places),
+                       "uid":       [rec.uid for rec in x.places],
+                       "name":      [self._encode("name", rec.name) for rec in x.places],
+                       "lng":       [rec.lng for rec in x.places],
+                       "lat":       [rec.lat for rec in x.places],
+                       "bikes":     [rec.bikes for rec in x.places],
+                       "available": [rec.bikes_available_to_rent for rec in x.places]},
+            "bikes":  {"timestamp": [timestamp] * len(x.bikes),
+                       "number":    [rec.number for rec in x.bikes],
+                       "bike_type": [rec.bike_type for rec in x.bikes],
+                       "active":    [int(rec.active) for rec in x.bikes],
+                       "state":     [self._encode("state", rec.state) for rec in x.bikes],
+                       "place_id":  [rec.place_id for rec in x.bikes]}
+        }
+
+        # Writing dictionary first such that all codes are known
+        if self._modified:
+            file = os.path.join(daydir, "dictionary.json")
+            with open(file + ".tmp", "w") as fid:
+                json.dump({k: list(v.keys()) for k, v in self._dictionary.items()}, fid)
+            os.replace(file + ".tmp", file)
+
+        self._aligned = None
+        for table, columns in data.items():
+            for column, values in columns.items():
+                typecode, typename = COLUMNS[table][column]
+                values = array(typecode, values)
+                if sys.byteorder == "big": values.byteswap()
+                with open(os.path.join(daydir, f"{table}.{column}.{typename}"), "ab") as fid:
+                    values.tofile(fid)
+        self._aligned = date
+
+
+# -------------------------------------------------------------------
+# Reader
+# -------------------------------------------------------------------
+def read_day(dir, domain, date, table, columns = None):
+    """read_day(dir, domain, date, table, columns = None)
+
+    Memory-maps the columns of one day.
+
+    Params
+    ======
+    dir : str
+        Parent directory.
+    domain : str
+        Domain used for the directory name.
+    date : datetime.date
+        Date.
+    table : str
+        Either 'places' or 'bikes'.
+    columns : None, list of str
+        Columns to be returned, defaults to all (see `COLUMNS`).
+
+    Return
+    ======
+    dict : Keys correspond to the columns. The items are read-only
+    `numpy.memmap` arrays if numpy is installed, else `memoryview`s with
+    the corresponding format. Dictionary encoded columns contain the codes
+    (see `read_dictionary()`). Returns None if there are no data for this day.
+    """
+    if not table in COLUMNS.keys():
+        raise ValueError(f"'table' must be one of: {', '.join(COLUMNS.keys())}")
+    if columns is None: columns = list(COLUMNS[table].keys())
+    if not isinstance(columns, list): raise TypeError("'columns' must be None or list")
+    for column in columns:
+        if not column in COLUMNS[table].keys():
+            raise ValueError(f"column '{column}' not available for '{table}'")
+
+    daydir = get_daydir(dir, domain, date)
+    if not os.path.isdir(daydir): return None
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if sys.byteorder == "big" and np is None:
+        raise Exception("reading on big-endian systems requires numpy")
+
+    # Number of complete rows (see _count_rows())
+    nrow = _count_rows(daydir, table)
+    if nrow == 0: return None
+
+    res = {}
+    for column in columns:
+        typecode, typename = COLUMNS[table][column]
+        file = os.path.join(daydir, f"{table}.{column}.{typename}")
+        if np is not None:
+            res[column] = np.memmap(file, dtype = np.dtype(typename).newbyteorder("<"),
+                                    mode = "r", shape = (nrow,))
+        else:
+            with open(file, "rb") as fid:
+                buf = mmap.mmap(fid.fileno(), 0, access = mmap.ACCESS_READ)
+            # Whole items only (cast() fails on a partially written item)
+            res[column] = memoryview(buf)[:(nrow * array(typecode).itemsize)].cast(typecode)
+    return res
+
@@ -18,6 +18,26 @@ class bikeconfig(configparser.ConfigParser):
 
         self.connection_string  = self.get("general", "connection_string")
 
+        # Update name/coordinates of stations if they change (else kept as first seen)
+        self.update_places = self.getboolean("general", "update_places", fallback = False)
+
+        # Partitioning of bikes/rentals (None or 'monthly'; see bikepartitions.py)
+        self.partitions = self.get("general", "partitions", fallback = None)
+        if not self.partitions in [None, "monthly"]:
+            raise ValueError("'partitions' must be 'monthly' if set")
+
+        # Maintain hourly/daily aggregates of the rentals
+        self.rollups = self.getboolean("general", "rollups", fallback = False)
+
+        # Snapshots identical to the previous one (feed not refreshed) are
+        # not stored by the downloader and only processed as heartbeat
+        self.dedup = self.getboolean("general", "dedup", fallback = True)
+
+        # Interval (seconds) between two API calls in daemon mode
+        self.interval = self.getint("general", "interval", fallback = 60)
+        if self.interval <= 0:
+            raise ValueError("'interval' must be positive")
+
         self.livedir = self.get("general", "livedir")
         if not os.path.isdir(self.livedir):
             try:
@@ -31,3 +51,90 @@ class bikeconfig(configparser.ConfigParser):
                 os.makedirs(self.archivedir)
             except Exception as e:
                 raise Exception(e)
+
+        # Optional; if set, snapshots are also stored in columnar format
+        self.columnardir = self.get("general", "columnardir", fallback = None)
+        if self.columnardir is not None and not os.path.isdir(self.columnardir):
+            try:
+                os.makedirs(self.columnardir)
+            except Exception as e:
+                raise Exception(e)
+
+        # Domains to be downloaded (domain: country). Always contains
+        # the main domain from [general], additional domains can be
+        # specified in the [domains] section (only downloaded, not processed).
+        self.domains = {self.domain: self.country}
+        if self.has_section("domains"):
+            for domain, country in self.items("domains"):
+                if domain in self.defaults().keys(): continue
+                self.domains[domain] = country
+
+        # Concurrent downloads; number of parallel requests, timeout (seconds)
+        # and number of retries (with exponential backoff) per domain
+        self.concurrency = self.getint("download", "concurrency", fallback = 4)
+        self.timeout     = self.getfloat("download", "timeout", fallback = 20.)
+        self.retries     = self.getint("download", "retries", fallback = 2)
+        # Archiving; 'stream': snapshots are appended to the archive of the
+        # day as they arrive (see bikearchive.py), finalized after midnight.
+        # 'daily': the folder of the day is compressed after midnight.
+        self.archive_mode = self.get("download", "archive", fallback = "stream")
+        if not self.archive_mode in ["stream", "daily"]:
+            raise ValueError("'archive' must be 'stream' or 'daily'")
+        if self.concurrency <= 0: raise ValueError("'concurrency' must be positive")
+        if self.timeout <= 0:     raise ValueError("'timeout' must be positive")
+        if self.retries < 0:      raise ValueError("'retries' must be 0 or positive")
+
+        # SQLite only; pragmas set on each connection. Defaults to WAL mode
+        # (readers do not block the ingest and vice versa), can be
+        # overruled in the [sqlite] section.
+        self.sqlite_pragmas = dict(journal_mode = "WAL",
+                                   synchronous  = "NORMAL",
+                                   mmap_size    = 268435456,   # 256 MB
+                                   cache_size   = -65536,      # 64 MB
+                                   temp_store   = "MEMORY",
+                                   busy_timeout = 10000)       # Milliseconds
+        if self.has_section("sqlite"):
+            for k, v in self.items("sqlite"):
+                if k in self.defaults().keys(): continue
+                self.sqlite_pragmas[k] = v
+
+        # Metrics (see bikemetrics.py); Prometheus text file and/or http
+        # endpoint (port), statsd daemon ('host:port') and structured log
+        # (json lines) of the snapshots processed. If 'profile_threshold'
+        # (seconds) is set, snapshots taking longer are profiled.
+        self.metrics_file      = self.get("metrics", "file", fallback = None)
+        self.metrics_port      = self.getint("metrics", "port", fallback = None)
+        self.metrics_statsd    = self.get("metrics", "statsd", fallback = None)
+        self.metrics_log       = self.get("metrics", "log", fallback = None)
+        self.profile_threshold = self.getfloat("metrics", "profile_threshold", fallback = None)
+        self.profile_dir       = self.get("metrics", "profile_dir", fallback = "profiles")
+        if self.profile_threshold is not None and self.profile_threshold <= 0:
+            raise ValueError("'profile_threshold' must be positive")
+
+        # Spatial layer (see bikegeo.py); districts as GeoJSON file (e.g.,
+        # exported from R), property containing the name of the district,
+        # buffer (meters) around the districts and maximum distance (meters)
+        # of free-floating bikes to the nearest station.
+        self.districts        = self.get("geo", "districts", fallback = None)
+        self.districts_name   = self.get("geo", "name", fallback = "name")
+        self.districts_buffer = self.getfloat("geo", "buffer", fallback = 20.)
+        self.station_distance = self.getfloat("geo", "max_distance", fallback = 500.)
+        if self.districts is not None and not os.path.isfile(self.districts):
+            raise FileNotFoundError(f"districts file \"{self.districts}\" not found")
+
+    def get_livedir(self, domain):
+        """get_livedir(domain)
+
+        Params
+        ======
+        domain : str
+            Name of the domain.
+
+        Return
+        ======
+        str : Returns the directory for the live data of this domain;
+        `livedir` for the main domain, `<livedir>/<domain>` else.
+        """
+        if not isinstance(domain, str): raise TypeError("'domain' must be str")
+        if domain == self.domain: return self.livedir
+        return os.path.join(self.livedir, domain)
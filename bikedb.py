@@ -1,25 +1,42 @@
 
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy import select, func
-from sqlalchemy import Table, Column, ForeignKey, UniqueConstraint
+import re
+import datetime as dt
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import create_engine, MetaData, event
+from sqlalchemy import select, update, delete, func, bindparam, inspect, text
+from sqlalchemy import Table, Column, ForeignKey, UniqueConstraint, Index
 from sqlalchemy import Integer, Float, Boolean, String
 
+from bikemetrics import metrics
+
 
 # -------------------------------------------------------------------
 # Database handler; SQLAlchemy
 # -------------------------------------------------------------------
 class BikeDB:
 
-    def __init__(self, connection_string = "sqlite+pysqlite:///test.db", echo = False):
-        """BikeDB(connection_string = "sqlite+pysqlite:///test.db")
+    def __init__(self, connection_string = "sqlite+pysqlite:///test.db", echo = False, pragmas = None,
+                 partitions = None):
+        """BikeDB(connection_string = "sqlite+pysqlite:///test.db", echo = False, pragmas = None,
+                  partitions = None)
 
         Params
         ======
         connection_string : str
             connection string for SQLAlchemy. Defaults to
-            SQLite 'test.db' for now.
+            SQLite 'test.db' for now. Supports sqlite, mysql, and postgresql.
         echo : bool
             Forwarded to `sqlalchemy.create_engine()`, defaults to `False`.
+        pragmas : None, dict
+            SQLite only; pragmas (name: value) set on each new connection,
+            e.g., `{"journal_mode": "WAL", "synchronous": "NORMAL"}`.
+            Connections are pooled and reused across handler calls, thus
+            this is done once per connection.
+        partitions : None, str
+            if 'monthly', intervals (bikes, rentals) never span two months
+            such that completed months can be moved into separate files
+            (see bikepartitions.py).
 
         Return
         ======
@@ -30,39 +47,367 @@ class BikeDB:
             raise TypeError("'connection_string' must be str")
         if not isinstance(echo, bool):
             raise TypeError("'echo' must be bool")
+        if not pragmas is None and not isinstance(pragmas, dict):
+            raise TypeError("'pragmas' must be None or dict")
+        if not partitions in [None, "monthly"]:
+            raise ValueError("'partitions' must be None or 'monthly'")
 
         try:
             self.engine   = create_engine(connection_string, echo = echo)
         except Exception as e:
             raise Exception(e)
-        self.metadata = MetaData()
+
+        # Setting pragmas whenever the pool opens a new connection
+        if pragmas and self.engine.dialect.name == "sqlite":
+            for k, v in pragmas.items():
+                if not re.match(r"^[a-z_]+$", k) or not re.match(r"^-?[\w]+$", str(v)):
+                    raise ValueError(f"invalid pragma '{k} = {v}'")
+            sql = [f"PRAGMA {k} = {v}" for k, v in pragmas.items()]
+            @event.listens_for(self.engine, "connect")
+            def set_pragmas(con, record):
+                cursor = con.cursor()
+                for x in sql: cursor.execute(x)
+                cursor.close()
+        self.metadata   = MetaData()
+        self.partitions = partitions
+        # Dialect dependent bulk writes used by the handlers
+        self.writer     = BulkWriter(self.engine)
+        # Connection used while in batch mode (see batch())
+        self._con     = None
+        # Functions called before each commit in batch mode (see on_commit())
+        self._on_commit = []
 
     def create_all(self):
         """create_all()
 
-        Creates the database tables (if not existing).
+        Creates the database tables (if not existing). Indices are
+        created separately (if not existing) such that indices added
+        later on are also created on existing databases.
+        Raises an exception if an existing table misses columns (outdated
+        database schema).
         """
         self.metadata.create_all(self.engine)
+        insp = inspect(self.engine)
+        for table in self.metadata.sorted_tables:
+            existing = [x["name"] for x in insp.get_columns(table.name)]
+            missing  = [x.name for x in table.columns if not x.name in existing]
+            if len(missing) > 0:
+                hint = " (convert using 'bikeexport.py migrate')" if table.name == "rentals" else ""
+                raise Exception(f"table '{table.name}' outdated, missing columns: {', '.join(missing)}{hint}")
+            for idx in table.indexes:
+                idx.create(self.engine, checkfirst = True)
 
     def begin(self):
         """begin()
 
-        Construct new connection.
+        Construct new connection. If in batch mode (see `batch()`) the
+        connection of the batch is returned instead, the transaction is
+        then controlled by `batch()` and `commit()`.
 
         Return
         ======
         RootTransaction : Returns root transaction handler.
         """
+        if self._con is not None:
+            return nullcontext(self._con)
+        metrics.count("transactions_total")
         return self.engine.begin() # Context-managed connection
 
+    @contextmanager
+    def batch(self):
+        """batch()
+
+        Context manager for batch mode. All handler calls within the
+        context share one connection and one transaction which is committed
+        when leaving the context (or when calling `commit()`), and
+        rolled back if an exception occurs.
+
+        Note that in-memory states (e.g., `Bikes.get_previous_records()`)
+        are not rolled back; reload them if you recover from an error.
+        """
+        if self._con is not None:
+            raise Exception("batch mode already active")
+        with self.engine.connect() as con:
+            self._con = con
+            try:
+                con.begin()
+                yield self
+                for fun in self._on_commit: fun()
+                con.commit()
+                metrics.count("transactions_total")
+            finally:
+                self._con = None
+
+    def commit(self):
+        """commit()
+
+        Commits the current batch transaction and starts a new one.
+        Only allowed in batch mode (see `batch()`).
+        """
+        if self._con is None:
+            raise Exception("commit() only allowed in batch mode")
+        for fun in self._on_commit: fun()
+        self._con.commit()
+        metrics.count("transactions_total")
+        self._con.begin()
+
+    def in_batch(self):
+        """in_batch()
+
+        Return
+        ======
+        bool : True if batch mode is active (see `batch()`), else False.
+        """
+        return self._con is not None
+
+    def on_commit(self, fun):
+        """on_commit(fun)
+
+        Registers a function which is called before each commit
+        in batch mode (e.g., to write deferred changes).
+
+        Params
+        ======
+        fun : callable
+            function without arguments.
+        """
+        if not callable(fun): raise TypeError("'fun' must be callable")
+        self._on_commit.append(fun)
+
+    def partition(self, timestamp):
+        """partition(timestamp)
+
+        Params
+        ======
+        timestamp : int
+            timestamp.
+
+        Return
+        ======
+        None, str : Partition (month, 'YYYY-mm') of `timestamp`;
+        None if partitioning is disabled.
+        """
+        if self.partitions is None: return None
+        return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime("%Y-%m")
+
+    def explain(self, stmt):
+        """explain(stmt)
+
+        Params
+        ======
+        stmt : sqlalchemy.sql.Select
+            statement to be explained.
+
+        Return
+        ======
+        list of dict : Query plan as returned by 'EXPLAIN QUERY PLAN' (sqlite)
+        or 'EXPLAIN' (mysql, postgresql), one dict per row.
+        """
+        sql = str(stmt.compile(self.engine, compile_kwargs = {"literal_binds": True}))
+        if self.engine.dialect.name == "sqlite":
+            sql = "EXPLAIN QUERY PLAN " + sql
+        elif self.engine.dialect.name in ["mysql", "postgresql"]:
+            sql = "EXPLAIN " + sql
+        else:
+            raise NotImplementedError(f"self.db {self.engine.dialect.name} not implemented")
+        with self.begin() as con:
+            res = [dict(x) for x in con.execute(text(sql)).mappings().all()]
+        return res
+
+    def full_scans(self, stmt):
+        """full_scans(stmt)
+
+        Params
+        ======
+        stmt : sqlalchemy.sql.Select
+            statement to be checked.
+
+        Return
+        ======
+        list of str : Names of the tables which are read by a full table scan
+        (no index used) when executing `stmt`, empty if none.
+        """
+        res = []
+        for rec in self.explain(stmt):
+            if self.engine.dialect.name == "sqlite":
+                tmp = re.match(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$", rec["detail"])
+                if tmp and tmp.group(1) in self.metadata.tables.keys():
+                    res.append(tmp.group(1))
+            elif self.engine.dialect.name == "postgresql":
+                tmp = re.search(r"Seq Scan on (\w+)", rec["QUERY PLAN"])
+                if tmp and tmp.group(1) in self.metadata.tables.keys():
+                    res.append(tmp.group(1))
+            elif rec["type"] == "ALL" and rec["table"] in self.metadata.tables.keys():
+                res.append(rec["table"])
+        return res
+
+    def check_queries(self, *handlers):
+        """check_queries(*handlers)
+
+        Checks that none of the hot queries of the handlers (see the
+        `queries()` method of the handlers) falls back to a full table
+        scan. Raises an exception listing the queries affected, e.g.,
+        if an index is missing in an existing database.
+
+        Params
+        ======
+        *handlers : object
+            handlers providing a `queries()` method.
+        """
+        failed = []
+        for handler in handlers:
+            for name, stmt in handler.queries().items():
+                tables = self.full_scans(stmt)
+                if len(tables) > 0:
+                    failed.append(f"{type(handler).__name__}.{name} ({', '.join(tables)})")
+        if len(failed) > 0:
+            raise Exception(f"full table scan in hot queries: {', '.join(failed)}")
+
+
+# -------------------------------------------------------------------
+# Bulk writes; dialect dependent statements (insert ignoring duplicates,
+# upserts) shared by all handlers. Rows are written using executemany;
+# on PostgreSQL large batches are loaded into a temporary staging
+# table using COPY and merged from there.
+# -------------------------------------------------------------------
+class BulkWriter:
+
+    # Minimum number of rows for using COPY (PostgreSQL)
+    COPY_THRESHOLD = 5000
+
+    def __init__(self, engine):
+        """BulkWriter(engine)
+
+        Params
+        ======
+        engine : sqlalchemy.engine.Engine
+            database engine; sqlite, mysql, or postgresql.
+        """
+        self.dialect = engine.dialect.name
+        if self.dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+            self.least, self.greatest = func.min, func.max
+        elif self.dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert
+            self.least, self.greatest = func.least, func.greatest
+        elif self.dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+            self.least, self.greatest = func.least, func.greatest
+        else:
+            raise NotImplementedError(f"self.db {self.dialect} not implemented")
+        # Insert method used in .statement()
+        self.__insert = insert
+
+    def statement(self, table, keys = None, update = None, ignore = False, source = None):
+        """statement(table, keys = None, update = None, ignore = False, source = None)
+
+        Params
+        ======
+        table : sqlalchemy.Table
+            table to be written.
+        keys : None, list of str
+            columns of the unique constraint (upsert).
+        update : None, callable
+            upsert; function called with the new row (excluded/inserted) returning
+            a dict with the columns to be updated (column: expression).
+        ignore : bool
+            if True, rows violating a unique constraint are ignored.
+        source : None, sqlalchemy.sql.Select
+            if set, rows are inserted from this select statement.
+
+        Return
+        ======
+        sqlalchemy.sql.Insert : Insert statement.
+        """
+        stmt = self.__insert(table)
+        if source is not None:
+            stmt = stmt.from_select([c.name for c in table.columns], source)
+        if update is not None:
+            if self.dialect == "mysql":
+                stmt = stmt.on_duplicate_key_update(**update(stmt.inserted))
+            else:
+                stmt = stmt.on_conflict_do_update(index_elements = keys, set_ = update(stmt.excluded))
+        elif ignore:
+            if self.dialect == "sqlite":
+                stmt = stmt.prefix_with("OR IGNORE")
+            elif self.dialect == "mysql":
+                stmt = stmt.prefix_with("IGNORE")
+            else:
+                stmt = stmt.on_conflict_do_nothing()
+        return stmt
+
+    def write(self, con, table, rows, keys = None, update = None, ignore = False):
+        """write(con, table, rows, keys = None, update = None, ignore = False)
+
+        Params
+        ======
+        con : sqlalchemy.engine.Connection
+            connection (see `BikeDB.begin()`).
+        table : sqlalchemy.Table
+            table to be written.
+        rows : list of dict
+            rows to be written.
+        keys, update, ignore :
+            see `statement()`.
+
+        Return
+        ======
+        int : Number of rows affected (inserted or updated; -1 if unknown).
+        The number of rows ignored is counted as the difference (see `bikemetrics`).
+        """
+        if len(rows) == 0: return 0
+        op = "upsert" if update is not None else "ignore" if ignore else "insert"
+        with metrics.timer("db_write", table = table.name, op = op):
+            if self.dialect == "postgresql" and len(rows) >= self.COPY_THRESHOLD:
+                result = self._copy(con, table, rows, keys, update, ignore)
+            else:
+                # Prepared statement executed once per row (executemany)
+                result = con.execute(self.statement(table, keys, update, ignore), rows)
+        metrics.count("rows_total", len(rows), table = table.name, op = op)
+        if result.rowcount >= 0:
+            metrics.count("rows_affected_total", result.rowcount, table = table.name, op = op)
+        return result.rowcount
+
+    def _copy(self, con, table, rows, keys, update, ignore):
+        """_copy(con, table, rows, keys, update, ignore)
+
+        PostgreSQL; loads the rows into a temporary staging table
+        using COPY (psycopg2 or psycopg), merged into `table` afterwards.
+        """
+        import io, csv
+        stage   = Table(f"stage_{table.name}", MetaData(),
+                        *[Column(c.name, c.type) for c in table.columns], prefixes = ["TEMPORARY"])
+        columns = [c.name for c in table.columns]
+        stage.drop(con, checkfirst = True)
+        stage.create(con)
+
+        buf = io.StringIO()
+        out = csv.writer(buf)
+        for rec in rows:
+            out.writerow(["\\N" if rec.get(c) is None else rec[c] for c in columns])
+        sql = f"COPY {stage.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        cursor = con.connection.driver_connection.cursor()
+        try:
+            if hasattr(cursor, "copy_expert"):   # psycopg2
+                buf.seek(0)
+                cursor.copy_expert(sql, buf)
+            else:                                # psycopg 3
+                with cursor.copy(sql) as copy: copy.write(buf.getvalue())
+        finally:
+            cursor.close()
+
+        result = con.execute(self.statement(table, keys, update, ignore, source = select(stage)))
+        stage.drop(con)
+        return result
+
 
 # -------------------------------------------------------------------
 # Places handler
 # -------------------------------------------------------------------
 class Places:
 
-    def __init__(self, db: BikeDB):
-        """Places(db)
+    def __init__(self, db: BikeDB, update_on_change = False, max_floating = 10000):
+        """Places(db, update_on_change = False, max_floating = 10000)
 
         Handler for 'places'.
 
@@ -70,11 +415,22 @@ class Places:
         ======
         db : BikeDB
             database handler (SQLAlchemy).
+        update_on_change : bool
+            if set True, name and coordinates of existing stations are
+            updated if they changed. Defaults to False (kept as first seen).
+        max_floating : int
+            number of free-floating bikes (places with timestamp) kept in
+            memory (least recently seen are dropped first).
         """
         if not isinstance(db, BikeDB):
             raise TypeError("'db' must be a BikeDB object")
+        if not isinstance(update_on_change, bool):
+            raise TypeError("'update_on_change' must be bool")
+        if not isinstance(max_floating, int) or max_floating < 0:
+            raise ValueError("'max_floating' must be a non-negative int")
 
         self.db = db
+        self.update_on_change = update_on_change
         self.table = Table("places", db.metadata,
             Column("id",        Integer,     primary_key = True),
             Column("timestamp", Integer,     nullable = True),
@@ -83,19 +439,22 @@ class Places:
             Column("lat",       Float,       nullable = False)
         )
 
-        # Define insert method (diaclect dependent)
-        if db.engine.dialect.name == "sqlite":
-            from sqlalchemy.dialects.sqlite import insert
-        elif db.engine.dialect.name == "mysql":
-            from sqlalchemy.dialects.mysql import insert
-        else:
-            raise NotImplementedError(f"self.db {db.engine.dialect.name} not implemented")
-        # Insert method used in .insert(), .upsert() etc
-        self.__insert = insert
+        # In-memory copy of the stations in the database; loaded once by
+        # get_known_places(), kept up to date by bulk_insert().
+        self._known = None
+        # Ids of the free-floating bikes seen recently (LRU); new ids keep
+        # showing up, thus not all of them are kept.
+        self._floating     = OrderedDict()
+        self._max_floating = max_floating
 
     def bulk_insert(self, rows, ignore_on_duplicate = True):
         """bulk_insert(rows, ignore_on_duplicate = True)
 
+        Only places not yet in the database are inserted. If `update_on_change = True`
+        (see `Places()`) stations with a new name or new coordinates are
+        updated. Free-floating bikes (places with timestamp) never change;
+        those not seen recently are inserted (ignored if existing).
+
         Params
         ======
         rows : list of dict
@@ -105,26 +464,107 @@ class Places:
         """
         if not isinstance(rows, list): raise TypeError("'rows' must be list")
 
-        stmt = self.__insert(self.table).values(rows)
-        # Adding ignore rules
-        if ignore_on_duplicate:
-            if self.db.engine.dialect.name == "sqlite":
-                stmt = stmt.prefix_with("OR IGNORE")
-            elif self.db.engine.dialect.name == "mysql":
-                stmt = stmt.prefix_with("IGNORE")
+        if len(rows) == 0: return
+
+        known    = self.get_known_places()
+        new      = []
+        changed  = []
+        floating = []
+        for rec in rows:
+            # Free-floating bikes; fast path if seen recently
+            if rec["timestamp"] is not None:
+                if rec["id"] in self._floating:
+                    self._floating.move_to_end(rec["id"])
+                else:
+                    floating.append(rec)
+            elif not rec["id"] in known:
+                new.append(rec)
+            elif self.update_on_change and self._changed(known[rec["id"]], rec):
+                changed.append(rec)
+
+        if len(new) > 0 or len(floating) > 0:
+            with self.db.begin() as con:
+                self.db.writer.write(con, self.table, new, ignore = ignore_on_duplicate)
+                self.db.writer.write(con, self.table, floating, ignore = True)
+
+        if len(changed) > 0:
+            stmt = update(self.table).where(self.table.c.id == bindparam("b_id")) \
+                       .values(name = bindparam("b_name"),
+                               lon  = bindparam("b_lon"),
+                               lat  = bindparam("b_lat"))
+            with self.db.begin() as con:
+                result = con.execute(stmt, [dict(b_id = x["id"], b_name = x["name"],
+                                                 b_lon = x["lon"], b_lat = x["lat"]) for x in changed])
+            metrics.count("rows_updated_total", len(changed), table = self.table.name)
+
+        # Keeping known places up to date
+        for rec in new + changed:
+            known[rec["id"]] = (rec["name"], rec["lon"], rec["lat"])
+        for rec in floating:
+            self._floating[rec["id"]] = None
+        while len(self._floating) > self._max_floating:
+            self._floating.popitem(last = False)
+
+    def _changed(self, previous, rec):
+        """_changed(previous, rec)
+
+        Params
+        ======
+        previous : tuple
+            known name, lon, and lat of the place.
+        rec : dict
+            new record.
+
+        Return
+        ======
+        bool : True if name or coordinates changed. Coordinates are compared
+        with a tolerance as they may be stored with lower precision (MySQL FLOAT).
+        """
+        return previous[0] != rec["name"] or \
+               abs(previous[1] - rec["lon"]) > 1e-5 or \
+               abs(previous[2] - rec["lat"]) > 1e-5
+
+    def get_known_places(self, reload = False):
+        """get_known_places(reload = False)
+
+        Loads the stations stored in the database once, afterwards
+        they are served from memory (free-floating bikes not included).
+
+        Params
+        ======
+        reload : bool
+            if set True the places are re-loaded from the database and
+            the free-floating bikes seen recently are forgotten.
+
+        Return
+        ======
+        dict : The keys of the dictionary corresponds to the place id (int),
+        the items contain a tuple with name, lon, and lat.
+        """
+        if not isinstance(reload, bool): raise TypeError("'reload' must be bool")
+        if self._known is not None and not reload:
+            return self._known
+        if reload: self._floating = OrderedDict()
+
+        stmt = select(self.table).where(self.table.c.timestamp.is_(None))
+        res  = {}
         with self.db.begin() as con:
-            result = con.execute(stmt)
+            for rec in con.execute(stmt):
+                res[rec.id] = (rec.name, rec.lon, rec.lat)
+        self._known = res
+        return res
 
 
 # -------------------------------------------------------------------
 # Rentals table; how many bikes are available at a certain station
 # at a specific type. Separated from 'Places' to avoid storing the
-# location each time.
+# location each time. Stored as intervals (first_seen, last_seen) as
+# for 'Bikes'; a new row is only added if the numbers change.
 # -------------------------------------------------------------------
 class Rentals:
 
-    def __init__(self, db: BikeDB):
-        """Places(db)
+    def __init__(self, db: BikeDB, rollups = False):
+        """Rentals(db, rollups = False)
 
         Handler for 'number of available rental bikes'.
 
@@ -132,51 +572,486 @@ class Rentals:
         ======
         db : BikeDB
             database handler (SQLAlchemy).
+        rollups : bool
+            if set True, hourly and daily aggregates are
+            updated as well (see `RentalsRollups`).
         """
         if not isinstance(db, BikeDB):
             raise TypeError("'db' must be a BikeDB object")
+        if not isinstance(rollups, bool):
+            raise TypeError("'rollups' must be bool")
 
         self.db = db
+        self.rollups = RentalsRollups(db) if rollups else None
         self.table = Table("rentals", db.metadata,
-            Column("place_id",  ForeignKey("places.id"), nullable = False),
-            Column("timestamp", Integer, nullable = False),
-            Column("bikes",     Integer, nullable = False),
-            Column("available", Integer, nullable = False),
-            UniqueConstraint("place_id", "timestamp", name = "rentals_index_place_id_timestamp")
+            Column("first_seen", Integer,                 nullable = False),
+            Column("last_seen",  Integer,                 nullable = False),
+            Column("place_id",   ForeignKey("places.id"), nullable = False),
+            Column("bikes",      Integer,                 nullable = False),
+            Column("available",  Integer,                 nullable = False),
+
+            UniqueConstraint("first_seen", "place_id", name = "rentals_index_first_seen_place_id"),
+            # Used to quickly find the latest record of each place
+            Index("rentals_index_place_id_first_seen", "place_id", "first_seen"),
+            # Used for time-range queries (see get_counts())
+            Index("rentals_index_last_seen", "last_seen")
         )
 
-        # Define insert method (diaclect dependent)
-        if db.engine.dialect.name == "sqlite":
-            from sqlalchemy.dialects.sqlite import insert
-        elif db.engine.dialect.name == "mysql":
-            from sqlalchemy.dialects.mysql import insert
+        # In-memory copy of the latest record of each place; loaded once
+        # by get_previous_records(), kept up to date by bulk_insert().
+        self._current = None
+        # New 'last_seen' of unchanged intervals not yet written to the
+        # database; (place_id, first_seen) -> last_seen. See flush().
+        self._pending = {}
+        # Timestamps of the latest and the previous snapshot
+        self._latest   = None
+        self._previous = None
+        db.on_commit(self.flush)
+
+    def bulk_insert(self, rows):
+        """bulk_insert(rows)
+
+        Only places where the number of bikes changed (or places not
+        seen in the previous snapshot) are written as new rows. For all others only
+        'last_seen' of the current interval is extended; in batch mode
+        (see `BikeDB.batch()`) this is deferred until the next commit,
+        else written immediately (see `flush()`).
+
+        Params
+        ======
+        rows : list of dict
+            list of dictionaries defining the rows; 'place_id',
+            'timestamp', 'bikes', and 'available'.
+        """
+        if not isinstance(rows, list): raise TypeError("'rows' must be list")
+
+        if len(rows) == 0: return
+
+        if self.rollups is not None:
+            self.rollups.add(rows)
+
+        previous = self.get_previous_records()
+        new      = []
+        for rec in rows:
+            if self._latest is None or rec["timestamp"] > self._latest:
+                self._previous, self._latest = self._latest, rec["timestamp"]
+            p = previous.get(rec["place_id"])
+            # Unchanged and seen in the previous snapshot (not missing in
+            # between), same partition; only extending the current interval
+            if p is not None and p["bikes"] == rec["bikes"] and p["available"] == rec["available"] \
+                    and (self._previous is None or p["last_seen"] >= self._previous) \
+                    and self.db.partition(p["first_seen"]) == self.db.partition(rec["timestamp"]):
+                if rec["timestamp"] > p["last_seen"]:
+                    p["last_seen"] = rec["timestamp"]
+                    self._pending[(rec["place_id"], p["first_seen"])] = rec["timestamp"]
+                continue
+            new.append(dict(first_seen = rec["timestamp"],
+                            last_seen  = rec["timestamp"],
+                            place_id   = rec["place_id"],
+                            bikes      = rec["bikes"],
+                            available  = rec["available"]))
+
+        if len(new) > 0:
+            with self.db.begin() as con:
+                self.db.writer.write(con, self.table, new, ignore = True)
+
+            # Keeping current state up to date
+            for rec in new: previous[rec["place_id"]] = rec
+
+        if not self.db.in_batch():
+            self.flush()
+
+    def flush(self):
+        """flush()
+
+        Writes the deferred 'last_seen' of unchanged intervals
+        to the database (see `bulk_insert()`).
+        """
+        if len(self._pending) == 0: return
+
+        stmt = update(self.table).where(
+                   (self.table.c.place_id == bindparam("b_place_id")) &
+                   (self.table.c.first_seen == bindparam("b_first_seen"))
+               ).values(last_seen = bindparam("b_last_seen"))
+        rows = [dict(b_place_id = k[0], b_first_seen = k[1], b_last_seen = v) \
+                for k, v in self._pending.items()]
+        with self.db.begin() as con:
+            with metrics.timer("db_write", table = self.table.name, op = "update"):
+                result = con.execute(stmt, rows)
+        metrics.count("rows_updated_total", len(rows), table = self.table.name)
+        self._pending = {}
+
+    def extend(self, timestamp):
+        """extend(timestamp)
+
+        Heartbeat; snapshot identical to the previous one. Extends
+        'last_seen' of all intervals seen in the previous snapshot
+        (deferred as in `bulk_insert()`), the aggregates (if enabled)
+        are updated with the numbers of the previous snapshot.
+
+        Params
+        ======
+        timestamp : int
+            timestamp of the heartbeat.
+        """
+        if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+
+        previous = self.get_previous_records()
+        if self._latest is None or timestamp <= self._latest: return
+
+        rows = []
+        for p in previous.values():
+            if not p["last_seen"] == self._latest: continue
+            p["last_seen"] = timestamp
+            self._pending[(p["place_id"], p["first_seen"])] = timestamp
+            rows.append(dict(place_id = p["place_id"], timestamp = timestamp,
+                             bikes = p["bikes"], available = p["available"]))
+        self._previous, self._latest = self._latest, timestamp
+
+        if self.rollups is not None:
+            self.rollups.add(rows)
+        if not self.db.in_batch():
+            self.flush()
+
+    def get_previous_records(self, reload = False):
+        """get_previous_records(reload = False)
+
+        Loads the latest record for each place used to check if the number
+        of bikes changed since the last data point we stored. The database
+        is only queried once, afterwards the records are served from memory.
+
+        Params
+        ======
+        reload : bool
+            if set True the records are re-loaded from the database.
+
+        Return
+        ======
+        dict : The keys of the dictionary corresponds to the place id (int),
+        the items contain the last recorded numbers.
+        """
+        if not isinstance(reload, bool): raise TypeError("'reload' must be bool")
+        if self._current is not None and not reload:
+            return self._current
+
+        self.flush()
+
+        res    = {}
+        with self.db.begin() as con:
+            tmp = con.execute(self._stmt_previous_records()).mappings().all()
+
+        for rec in tmp: res[rec["place_id"]] = dict(rec)
+        self._current  = res
+        self._latest   = max([x["last_seen"] for x in res.values()], default = None)
+        self._previous = None
+        return res
+
+    def get_counts(self, timestamps, place_ids = None):
+        """get_counts(timestamps, place_ids = None)
+
+        Expands the stored intervals to point-in-time
+        numbers for a set of timestamps.
+
+        Params
+        ======
+        timestamps : list of int
+            timestamps for which the numbers should be returned.
+        place_ids : None, list of int
+            if set, only these places are returned.
+
+        Return
+        ======
+        list of dict : One entry for each place and timestamp covered by an
+        interval ('place_id', 'timestamp', 'bikes', 'available'), ordered
+        by timestamp and place id.
+        """
+        if not isinstance(timestamps, list): raise TypeError("'timestamps' must be list")
+        if not place_ids is None and not isinstance(place_ids, list):
+            raise TypeError("'place_ids' must be None or list")
+        if len(timestamps) == 0: return []
+
+        from bisect import bisect_left, bisect_right
+        timestamps = sorted(set(timestamps))
+
+        # Make sure the intervals in the database are up to date
+        self.flush()
+
+        # Monthly partitions; reading the partitions overlapping as well
+        if self.db.partitions is not None:
+            from bikepartitions import select_range
+            tmp = select_range(self.db, self.table.name, timestamps[0], timestamps[-1])
+            if place_ids is not None:
+                place_ids = set(place_ids)
+                tmp = [x for x in tmp if x["place_id"] in place_ids]
         else:
-            raise NotImplementedError(f"self.db {db.engine.dialect.name} not implemented")
-        # Insert method used in .insert(), .upsert() etc
-        self.__insert = insert
+            with self.db.begin() as con:
+                tmp = con.execute(self._stmt_counts(timestamps[0], timestamps[-1], place_ids)).mappings().all()
 
-    def bulk_insert(self, rows, ignore_on_duplicate = True):
-        """bulk_insert(rows, ignore_on_duplicate = True)
+        res = []
+        for rec in tmp:
+            for t in timestamps[bisect_left(timestamps, rec["first_seen"]):bisect_right(timestamps, rec["last_seen"])]:
+                res.append(dict(place_id  = rec["place_id"],
+                                timestamp = t,
+                                bikes     = rec["bikes"],
+                                available = rec["available"]))
+        res.sort(key = lambda x: (x["timestamp"], x["place_id"]))
+        return res
+
+    def _stmt_previous_records(self):
+        # Latest first_seen for each place; uses the (place_id, first_seen) index
+        latest = select(self.table.c.place_id,
+                        func.max(self.table.c.first_seen).label("first_seen")
+                       ).group_by(self.table.c.place_id).subquery()
+        return select(self.table).join(latest,
+                        (self.table.c.place_id == latest.c.place_id) &
+                        (self.table.c.first_seen == latest.c.first_seen))
+
+    def _stmt_counts(self, start, end, place_ids = None):
+        # Intervals overlapping with [start, end]
+        stmt = select(self.table).where((self.table.c.first_seen <= end) &
+                                        (self.table.c.last_seen >= start))
+        if place_ids is not None:
+            stmt = stmt.where(self.table.c.place_id.in_(place_ids))
+        return stmt
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        return dict(get_previous_records = self._stmt_previous_records(),
+                    get_counts           = self._stmt_counts(0, 0))
+
+
+# -------------------------------------------------------------------
+# Hourly and daily aggregates of the rentals per place.
+# -------------------------------------------------------------------
+class RentalsRollups:
+
+    # Length of the periods in seconds
+    PERIODS = {"hourly": 3600, "daily": 86400}
+
+    def __init__(self, db: BikeDB, max_gap = 900):
+        """RentalsRollups(db, max_gap = 900)
+
+        Handler for the hourly and daily aggregates of the rentals
+        ('rentals_hourly', 'rentals_daily'). Each snapshot is weighted
+        by the time since the previous snapshot (seconds), the aggregates
+        contain min/max and the weighted sums of 'available' and 'bikes'.
+        Updates are collected in memory and written at the next commit
+        in batch mode (see `BikeDB.batch()`), else immediately.
+
+        Params
+        ======
+        db : BikeDB
+            database handler (SQLAlchemy).
+        max_gap : int
+            maximum weight (seconds) of a snapshot, limits the weight
+            of the first snapshot after a data gap.
+        """
+        if not isinstance(db, BikeDB):
+            raise TypeError("'db' must be a BikeDB object")
+        if not isinstance(max_gap, int) or max_gap <= 0:
+            raise ValueError("'max_gap' must be a positive int")
+
+        self.db      = db
+        self.max_gap = max_gap
+        self.tables  = {}
+        for period in self.PERIODS.keys():
+            self.tables[period] = Table(f"rentals_{period}", db.metadata,
+                Column("place_id",      ForeignKey("places.id"), nullable = False),
+                Column("timestamp",     Integer, nullable = False), # Start of period
+                Column("last_seen",     Integer, nullable = False), # Latest snapshot
+                Column("seconds",       Integer, nullable = False), # Sum of weights
+                Column("min_available", Integer, nullable = False),
+                Column("max_available", Integer, nullable = False),
+                Column("sum_available", Integer, nullable = False), # Weighted sum
+                Column("sum_bikes",     Integer, nullable = False), # Weighted sum
+
+                UniqueConstraint("place_id", "timestamp", name = f"rentals_{period}_index_place_id_timestamp"),
+                Index(f"rentals_{period}_index_timestamp", "timestamp"),
+                Index(f"rentals_{period}_index_last_seen", "last_seen")
+            )
+
+        # Timestamps of the latest and the previous snapshot (see add())
+        self._latest   = None
+        self._previous = None
+        self._loaded   = False
+        # Aggregates not yet written; (period, place_id, timestamp) -> dict
+        self._buffer   = {}
+        db.on_commit(self.flush)
+
+    def add(self, rows):
+        """add(rows)
 
         Params
         ======
         rows : list of dict
-            list of dictionaries defining the rows.
-        ignore_on_duplicate : bool
-            if set True (default) 'insert or ignore' is used.
+            list of dictionaries with 'place_id', 'timestamp',
+            'bikes', and 'available' (see `Rentals.bulk_insert()`).
         """
         if not isinstance(rows, list): raise TypeError("'rows' must be list")
 
-        stmt = self.__insert(self.table).values(rows)
-        # Adding ignore rules
-        if ignore_on_duplicate:
-            if self.db.engine.dialect.name == "sqlite":
-                stmt = stmt.prefix_with("OR IGNORE")
-            elif self.db.engine.dialect.name == "mysql":
-                stmt = stmt.prefix_with("IGNORE")
+        # Latest snapshot contained in the aggregates (cold start)
+        if not self._loaded:
+            with self.db.begin() as con:
+                self._latest = con.execute(self._stmt_latest()).scalar_one_or_none()
+            self._loaded = True
+
+        for rec in rows:
+            t = rec["timestamp"]
+            if self._latest is None or t > self._latest:
+                self._previous, self._latest = self._latest, t
+            weight = 0 if self._previous is None else min(t - self._previous, self.max_gap)
+
+            for period, length in self.PERIODS.items():
+                key = (period, rec["place_id"], t - t % length)
+                x   = self._buffer.get(key)
+                if x is None:
+                    self._buffer[key] = dict(last_seen     = t,
+                                             seconds       = weight,
+                                             min_available = rec["available"],
+                                             max_available = rec["available"],
+                                             sum_available = weight * rec["available"],
+                                             sum_bikes     = weight * rec["bikes"])
+                else:
+                    x["last_seen"]      = max(x["last_seen"], t)
+                    x["seconds"]       += weight
+                    x["min_available"]  = min(x["min_available"], rec["available"])
+                    x["max_available"]  = max(x["max_available"], rec["available"])
+                    x["sum_available"] += weight * rec["available"]
+                    x["sum_bikes"]     += weight * rec["bikes"]
+
+        if not self.db.in_batch():
+            self.flush()
+
+    def flush(self):
+        """flush()
+
+        Writes the aggregates collected in memory to the database,
+        merging them with existing aggregates of the same period.
+        """
+        if len(self._buffer) == 0: return
+
         with self.db.begin() as con:
-            result = con.execute(stmt)
+            for period, table in self.tables.items():
+                rows = [dict(place_id = k[1], timestamp = k[2], **v) \
+                        for k, v in self._buffer.items() if k[0] == period]
+                # Merging with existing aggregates
+                w = self.db.writer
+                merge = lambda new, table = table: dict(
+                             last_seen     = w.greatest(table.c.last_seen, new.last_seen),
+                             seconds       = table.c.seconds + new.seconds,
+                             min_available = w.least(table.c.min_available, new.min_available),
+                             max_available = w.greatest(table.c.max_available, new.max_available),
+                             sum_available = table.c.sum_available + new.sum_available,
+                             sum_bikes     = table.c.sum_bikes + new.sum_bikes)
+                w.write(con, table, rows, keys = ["place_id", "timestamp"], update = merge)
+        self._buffer = {}
+
+    def delete(self, start = None, end = None):
+        """delete(start = None, end = None)
 
+        Deletes the aggregates of all periods overlapping with `start`
+        and `end`, e.g., before rebuilding them by adding the snapshots
+        from `start` onwards (`start` should be the start of a day).
+
+        Params
+        ======
+        start : None, int
+            if set, only periods containing or after `start`.
+        end : None, int
+            if set, only periods starting before or at `end`.
+        """
+        if start is not None and not isinstance(start, int): raise TypeError("'start' must be None or int")
+        if end is not None and not isinstance(end, int):     raise TypeError("'end' must be None or int")
+
+        self._buffer = {}
+        with self.db.begin() as con:
+            for period, table in self.tables.items():
+                stmt = delete(table)
+                if start is not None:
+                    stmt = stmt.where(table.c.timestamp >= start - start % self.PERIODS[period])
+                if end is not None:
+                    stmt = stmt.where(table.c.timestamp <= end)
+                result = con.execute(stmt)
+
+            # Latest snapshot before `start` such that the snapshots
+            # added next are weighted correctly.
+            self._latest = None if start is None else con.execute(self._stmt_latest(start)).scalar_one_or_none()
+        self._previous, self._loaded = None, True
+
+    def get(self, period, start = None, end = None, place_ids = None):
+        """get(period, start = None, end = None, place_ids = None)
+
+        Params
+        ======
+        period : str
+            either 'hourly' or 'daily'.
+        start : None, int
+            if set, only periods starting at or after `start`.
+        end : None, int
+            if set, only periods starting before or at `end`.
+        place_ids : None, list of int
+            if set, only these places are returned.
+
+        Return
+        ======
+        list of dict : Aggregates ordered by timestamp and place id; 'place_id',
+        'timestamp' (start of period), 'seconds', 'min_available', 'max_available',
+        'mean_available', and 'mean_bikes' (time-weighted means, None if seconds is 0).
+        """
+        if not period in self.PERIODS.keys():
+            raise ValueError(f"'period' must be one of: {', '.join(self.PERIODS.keys())}")
+        if not place_ids is None and not isinstance(place_ids, list):
+            raise TypeError("'place_ids' must be None or list")
+
+        # Make sure the aggregates in the database are up to date
+        self.flush()
+
+        res = []
+        with self.db.begin() as con:
+            for rec in con.execute(self._stmt_get(period, start, end, place_ids)).mappings():
+                n = rec["seconds"]
+                res.append(dict(place_id       = rec["place_id"],
+                                timestamp      = rec["timestamp"],
+                                seconds        = n,
+                                min_available  = rec["min_available"],
+                                max_available  = rec["max_available"],
+                                mean_available = rec["sum_available"] / n if n > 0 else None,
+                                mean_bikes     = rec["sum_bikes"] / n if n > 0 else None))
+        return res
+
+    def _stmt_latest(self, before = None):
+        # Latest snapshot contained in the aggregates (before `before`)
+        stmt = select(func.max(self.tables["hourly"].c.last_seen))
+        if before is not None:
+            stmt = stmt.where(self.tables["hourly"].c.last_seen < before)
+        return stmt
+
+    def _stmt_get(self, period, start = None, end = None, place_ids = None):
+        table = self.tables[period]
+        stmt  = select(table)
+        if start is not None:     stmt = stmt.where(table.c.timestamp >= start)
+        if end is not None:       stmt = stmt.where(table.c.timestamp <= end)
+        if place_ids is not None: stmt = stmt.where(table.c.place_id.in_(place_ids))
+        return stmt.order_by(table.c.timestamp, table.c.place_id)
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        res = dict(latest = self._stmt_latest(0))
+        for period in self.PERIODS.keys():
+            res[f"get_{period}"] = self._stmt_get(period, 0, 0)
+        return res
 
 
 # -------------------------------------------------------------------
@@ -207,18 +1082,17 @@ class Bikes:
             Column("active",     Boolean,                 nullable = False),
             Column("state",      String(5),               nullable = False),
 
-            UniqueConstraint("first_seen", "number", name = "bikes_index_first_seen_number")
+            UniqueConstraint("first_seen", "number", name = "bikes_index_first_seen_number"),
+            # Used to quickly find the latest record of each bike
+            Index("bikes_index_number_first_seen", "number", "first_seen"),
+            # Used by latest_entry() and to find intervals changed since
+            Index("bikes_index_last_seen", "last_seen")
         )
 
-        # Define insert method (diaclect dependent)
-        if db.engine.dialect.name == "sqlite":
-            from sqlalchemy.dialects.sqlite import insert
-        elif db.engine.dialect.name == "mysql":
-            from sqlalchemy.dialects.mysql import insert
-        else:
-            raise NotImplementedError(f"self.db {db.engine.dialect.name} not implemented")
-        # Insert method used in .insert(), .upsert() etc
-        self.__insert = insert
+        # In-memory copy of the latest record of each bike (current state);
+        # loaded once by get_previous_records(), kept up to date
+        # by bulk_insert_or_update().
+        self._current = None
 
     def bulk_insert_or_update(self, rows):
         """bulk_insert_or_ignore(rows)
@@ -228,25 +1102,64 @@ class Bikes:
         rows : list of dict
             list of dictionaries defining the rows.
         """
-        stmt = self.__insert(self.table).values(rows)
-
-        # Adding update rulez
-        if self.db.engine.dialect.name == "sqlite":
-            stmt = stmt.on_conflict_do_update(
-                       index_elements = ["first_seen", "number"],
-                       set_ = dict(last_seen = stmt.excluded.last_seen)
-                   )
-        elif self.db.engine.dialect.name == "mysql":
-            stmt = stmt.on_duplicate_key_update(
-                       last_seen = stmt.inserted.last_seen
-                   )
-        else:
-            raise NotImplementedError(f"self.db {db.engine.dialect.name} not implemented")
+        if not isinstance(rows, list): raise TypeError("'rows' must be list")
+        if len(rows) == 0: return
+
+        # Upsert; only updating last_seen of existing rows
+        with self.db.begin() as con:
+            self.db.writer.write(con, self.table, rows, keys = ["first_seen", "number"],
+                                 update = lambda new: dict(last_seen = new.last_seen))
 
+        # Keeping current state up to date (only once loaded)
+        if self._current is not None:
+            self._update_current(rows)
+
+    def extend(self, since, timestamp):
+        """extend(since, timestamp)
+
+        Heartbeat; snapshot identical to the previous one. Extends
+        'last_seen' of all intervals seen in the previous snapshot
+        (one update using the last_seen index).
+
+        Params
+        ======
+        since : int
+            timestamp of the previous snapshot.
+        timestamp : int
+            timestamp of the heartbeat.
+        """
+        if not isinstance(since, int):     raise TypeError("'since' must be int")
+        if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
 
+        stmt = update(self.table).where(self.table.c.last_seen == since).values(last_seen = timestamp)
         with self.db.begin() as con:
-            result = con.execute(stmt)
+            with metrics.timer("db_write", table = self.table.name, op = "update"):
+                result = con.execute(stmt)
+        metrics.count("rows_updated_total", result.rowcount, table = self.table.name)
 
+        # Keeping current state up to date (only once loaded)
+        if self._current is not None:
+            for rec in self._current.values():
+                if rec["last_seen"] == since: rec["last_seen"] = timestamp
+
+    def _update_current(self, rows):
+        """_update_current(rows)
+
+        Updates the in-memory current state of the bikes with the
+        rows just written to the database.
+
+        Params
+        ======
+        rows : list of dict
+            list of dictionaries defining the rows.
+        """
+        keys = ["first_seen", "last_seen", "number", "bike_type", "place_id", "active", "state"]
+        for rec in rows:
+            key = str(rec["number"])
+            if key in self._current.keys() and \
+                    self._current[key]["first_seen"] > rec["first_seen"]:
+                continue
+            self._current[key] = {k: rec[k] for k in keys}
 
     def latest_entry(self):
         """latest_entry()
@@ -256,38 +1169,373 @@ class Bikes:
         None, int : Returns None if the database is currently empty, else
         the latest (max) timestamp from latest (newest) record in the database.
         """
-        stmt = select(func.max(self.table.c.last_seen))
-        with self.db.engine.begin() as con:
-            res = con.execute(stmt).scalar_one_or_none()
+        with self.db.begin() as con:
+            res = con.execute(self._stmt_latest_entry()).scalar_one_or_none()
         return res
 
-    def get_previous_records(self):
-        """get_previous_records()
+    def get_previous_records(self, reload = False):
+        """get_previous_records(reload = False)
 
         Loads the latest record for each bike used to check if the status
         of the bike changed since the last data point we stored.
+        The database is only queried once, afterwards the records are
+        served from memory (updated by `bulk_insert_or_update()`).
+
+        Params
+        ======
+        reload : bool
+            if set True the records are re-loaded from the database.
 
         Return
         ======
         dict : The keys of the dictionary corresponds to the bike number (str),
         the items contain the last recorded status.
         """
-        stmt = select(self.table.c.first_seen,
+        if not isinstance(reload, bool): raise TypeError("'reload' must be bool")
+        if self._current is not None and not reload:
+            return self._current
+
+        res    = {}
+        with self.db.begin() as con:
+            tmp = con.execute(self._stmt_previous_records()).mappings().all()
+
+        for rec in tmp: res[str(rec["number"])] = dict(rec)
+        self._current = res
+        return res
+
+    def _stmt_latest_entry(self):
+        return select(func.max(self.table.c.last_seen))
+
+    def _stmt_previous_records(self):
+        # Latest first_seen for each bike; uses the (number, first_seen) index
+        latest = select(self.table.c.number,
+                        func.max(self.table.c.first_seen).label("first_seen")
+                       ).group_by(self.table.c.number).subquery()
+        return select(self.table.c.first_seen,
+                      self.table.c.last_seen,
                       self.table.c.number,
                       self.table.c.bike_type,
                       self.table.c.place_id,
                       self.table.c.active,
-                      self.table.c.state,
-                      func.row_number().over(
-                          partition_by = self.table.c.number,
-                          order_by     = self.table.c.first_seen.desc()
-                      ).label("rnk")
-                     ).subquery()
-        latest = select(stmt).where(stmt.c.rnk == 1)
-        res    = {}
-        with self.db.engine.begin() as con:
-            tmp = con.execute(latest).mappings().all()
+                      self.table.c.state
+                     ).join(latest, (self.table.c.number == latest.c.number) &
+                                    (self.table.c.first_seen == latest.c.first_seen))
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        c = self.table.c
+        return dict(latest_entry         = self._stmt_latest_entry(),
+                    get_previous_records = self._stmt_previous_records(),
+                    # Intervals changed since (see biketrips.load_intervals())
+                    changed_since        = select(c.number, c.place_id, c.first_seen,
+                                                  c.last_seen).where(c.last_seen > 0))
+
+
+# -------------------------------------------------------------------
+# Trips handler; maintained during ingest. A trip is a change of the
+# place of a bike. Bikes which disappear from the feed are stored as
+# open trips (end unknown) which are closed once the bike reappears.
+# -------------------------------------------------------------------
+class Trips:
+
+    def __init__(self, db: BikeDB):
+        """Trips(db)
+
+        Handler for 'trips'.
+
+        Params
+        ======
+        db : BikeDB
+            database handler (SQLAlchemy).
+        """
+        if not isinstance(db, BikeDB):
+            raise TypeError("'db' must be a BikeDB object")
+
+        self.db = db
+        self.table = Table("trips", db.metadata,
+            Column("number",         Integer,                 nullable = False),
+            Column("start_place_id", ForeignKey("places.id"), nullable = False),
+            Column("start_time",     Integer,                 nullable = False),
+            Column("end_place_id",   ForeignKey("places.id"), nullable = True),
+            Column("end_time",       Integer,                 nullable = True),
+
+            UniqueConstraint("number", "start_time", name = "trips_index_number_start_time"),
+            Index("trips_index_start_time", "start_time"),
+            # Open trips only (partial index; see get_open_trips())
+            Index("trips_index_open", "end_time", sqlite_where = text("end_time IS NULL"),
+                  postgresql_where = text("end_time IS NULL"))
+        )
+
+        # In-memory copy of the open trips; loaded once by
+        # get_open_trips(), kept up to date by update().
+        self._open = None
+
+    def get_open_trips(self, reload = False):
+        """get_open_trips(reload = False)
+
+        Loads the open trips once, afterwards they are served from memory.
+
+        Params
+        ======
+        reload : bool
+            if set True the open trips are re-loaded from the database.
+
+        Return
+        ======
+        dict : The keys of the dictionary correspond to the bike number (int),
+        the items contain start_place_id and start_time of the open trip.
+        """
+        if not isinstance(reload, bool): raise TypeError("'reload' must be bool")
+        if self._open is not None and not reload:
+            return self._open
 
-        for rec in tmp: res[str(rec["number"])] = rec
+        res  = {}
+        with self.db.begin() as con:
+            for rec in con.execute(self._stmt_open_trips()).mappings():
+                res[rec["number"]] = dict(start_place_id = rec["start_place_id"],
+                                          start_time     = rec["start_time"])
+        self._open = res
         return res
 
+    def update(self, previous, rows, timestamp):
+        """update(previous, rows, timestamp)
+
+        Must be called before the rows are written to the bikes table.
+
+        Params
+        ======
+        previous : dict
+            latest record of each bike before this snapshot
+            (see `Bikes.get_previous_records()`).
+        rows : list of dict
+            bikes of the current snapshot ('number', 'place_id').
+        timestamp : int
+            timestamp of the current snapshot.
+        """
+        if not isinstance(previous, dict): raise TypeError("'previous' must be dict")
+        if not isinstance(rows, list):     raise TypeError("'rows' must be list")
+        if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+
+        opentrips = self.get_open_trips()
+        new       = []   # New trips (closed or open)
+        closed    = []   # Open trips to be closed
+        removed   = []   # Open trips to be deleted (bike back at the same place)
+
+        current = set()
+        for rec in rows:
+            number = rec["number"]
+            current.add(number)
+            if number in opentrips.keys():
+                o = opentrips[number]
+                if o["start_place_id"] != rec["place_id"]:
+                    closed.append(dict(b_number = number, b_start_time = o["start_time"],
+                                       b_end_place_id = rec["place_id"], b_end_time = timestamp))
+                else:
+                    removed.append(dict(b_number = number, b_start_time = o["start_time"]))
+                continue
+            p = previous.get(str(number))
+            # Bike moved without disappearing in between
+            if p is not None and p["place_id"] != rec["place_id"]:
+                new.append(dict(number         = number,
+                                start_place_id = p["place_id"],
+                                start_time     = p["last_seen"],
+                                end_place_id   = rec["place_id"],
+                                end_time       = timestamp))
+
+        # Bikes which disappeared; open trips
+        for p in previous.values():
+            if p["number"] in current or p["number"] in opentrips.keys(): continue
+            new.append(dict(number         = p["number"],
+                            start_place_id = p["place_id"],
+                            start_time     = p["last_seen"],
+                            end_place_id   = None,
+                            end_time       = None))
+
+        if len(new) == 0 and len(closed) == 0 and len(removed) == 0: return
+
+        with self.db.begin() as con:
+            if len(new) > 0:
+                self.db.writer.write(con, self.table, new, ignore = True)
+            where = (self.table.c.number == bindparam("b_number")) & \
+                    (self.table.c.start_time == bindparam("b_start_time"))
+            if len(closed) > 0:
+                stmt = update(self.table).where(where).values(
+                           end_place_id = bindparam("b_end_place_id"),
+                           end_time     = bindparam("b_end_time"))
+                result = con.execute(stmt, closed)
+                metrics.count("rows_updated_total", len(closed), table = self.table.name)
+            if len(removed) > 0:
+                result = con.execute(delete(self.table).where(where), removed)
+
+        # Keeping open trips up to date
+        for rec in closed + removed: del opentrips[rec["b_number"]]
+        for rec in new:
+            if rec["end_time"] is None:
+                opentrips[rec["number"]] = dict(start_place_id = rec["start_place_id"],
+                                                start_time     = rec["start_time"])
+
+    def replace_all(self, rows):
+        """replace_all(rows)
+
+        Deletes all trips and inserts `rows` instead (e.g., when
+        rebuilding the table from the bikes history).
+
+        Params
+        ======
+        rows : list of dict
+            list of dictionaries defining the trips.
+        """
+        if not isinstance(rows, list): raise TypeError("'rows' must be list")
+        with self.db.begin() as con:
+            result = con.execute(delete(self.table))
+            self.db.writer.write(con, self.table, rows)
+        self._open = None
+
+    def get_trips(self, start = None, end = None):
+        """get_trips(start = None, end = None)
+
+        Params
+        ======
+        start : None, int
+            if set, only trips starting at or after `start` are returned.
+        end : None, int
+            if set, only trips starting before or at `end` are returned.
+
+        Return
+        ======
+        list of dict : Trips ordered by start time; end_place_id and
+        end_time are None for open trips.
+        """
+        with self.db.begin() as con:
+            res = [dict(x) for x in con.execute(self._stmt_trips(start, end)).mappings().all()]
+        return res
+
+    def _stmt_open_trips(self):
+        return select(self.table.c.number,
+                      self.table.c.start_place_id,
+                      self.table.c.start_time).where(self.table.c.end_time.is_(None))
+
+    def _stmt_trips(self, start = None, end = None):
+        stmt = select(self.table)
+        if start is not None: stmt = stmt.where(self.table.c.start_time >= start)
+        if end is not None:   stmt = stmt.where(self.table.c.start_time <= end)
+        return stmt.order_by(self.table.c.start_time, self.table.c.number)
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        return dict(get_open_trips = self._stmt_open_trips(),
+                    get_trips      = self._stmt_trips(0, 0))
+
+
+# -------------------------------------------------------------------
+# Snapshots handler; content hash of each snapshot processed. Snapshots
+# identical to the previous one (feed not refreshed) are not processed
+# but only recorded as heartbeat (duplicate = True).
+# -------------------------------------------------------------------
+class Snapshots:
+
+    def __init__(self, db: BikeDB):
+        """Snapshots(db)
+
+        Handler for 'snapshots'.
+
+        Params
+        ======
+        db : BikeDB
+            database handler (SQLAlchemy).
+        """
+        if not isinstance(db, BikeDB):
+            raise TypeError("'db' must be a BikeDB object")
+
+        self.db = db
+        self.table = Table("snapshots", db.metadata,
+            Column("timestamp", Integer,    primary_key = True),
+            Column("hash",      String(40), nullable = False),
+            Column("duplicate", Boolean,    nullable = False)
+        )
+
+        # Latest snapshot (timestamp, hash); loaded once by latest(),
+        # kept up to date by add().
+        self._latest = None
+
+    def add(self, timestamp, hash, duplicate = False):
+        """add(timestamp, hash, duplicate = False)
+
+        Params
+        ======
+        timestamp : int
+            timestamp of the snapshot.
+        hash : str
+            content hash of the snapshot.
+        duplicate : bool
+            True if identical to the previous snapshot (heartbeat).
+        """
+        if not isinstance(timestamp, int):  raise TypeError("'timestamp' must be int")
+        if not isinstance(hash, str):       raise TypeError("'hash' must be str")
+        if not isinstance(duplicate, bool): raise TypeError("'duplicate' must be bool")
+        with self.db.begin() as con:
+            self.db.writer.write(con, self.table, [dict(timestamp = timestamp, hash = hash,
+                                                        duplicate = duplicate)], ignore = True)
+        self._latest = (timestamp, hash)
+
+    def latest(self, reload = False):
+        """latest(reload = False)
+
+        Params
+        ======
+        reload : bool
+            if set True the latest snapshot is re-loaded from the database.
+
+        Return
+        ======
+        None, tuple : None if no snapshot was recorded yet, else the
+        timestamp and hash of the latest snapshot.
+        """
+        if not isinstance(reload, bool): raise TypeError("'reload' must be bool")
+        if self._latest is not None and not reload:
+            return self._latest
+        with self.db.begin() as con:
+            res = con.execute(self._stmt_latest()).one_or_none()
+        self._latest = None if res is None else tuple(res)
+        return self._latest
+
+    def latest_stored(self):
+        """latest_stored()
+
+        Return
+        ======
+        None, tuple : None if no snapshot was processed yet, else the
+        timestamp and hash of the latest snapshot processed completely
+        (not a heartbeat; the json file of this timestamp was stored).
+        """
+        c      = self.table.c
+        latest = select(func.max(c.timestamp)).where(c.duplicate.is_(False)).scalar_subquery()
+        with self.db.begin() as con:
+            res = con.execute(select(c.timestamp, c.hash).where(c.timestamp == latest)).one_or_none()
+        return None if res is None else tuple(res)
+
+    def _stmt_latest(self):
+        latest = select(func.max(self.table.c.timestamp)).scalar_subquery()
+        return select(self.table.c.timestamp, self.table.c.hash).where(self.table.c.timestamp == latest)
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        return dict(latest = self._stmt_latest())
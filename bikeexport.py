@@ -0,0 +1,350 @@
+# -------------------------------------------------------------------
+# Consistent exports of the database while the ingest is running.
+# backup() creates a full copy using the SQLite online backup API,
+# export() only writes the rows changed after a watermark (timestamp)
+# to a new (optionally gzip compressed) SQLite file which is merged
+# into another database using import_export().
+# -------------------------------------------------------------------
+
+import os
+import sys
+import gzip
+import shutil
+import sqlite3
+import tempfile
+from sqlalchemy import create_engine, select, delete, inspect, bindparam, or_
+from sqlalchemy import UniqueConstraint, PrimaryKeyConstraint
+
+from bikedb import BikeDB
+
+
+def _changed(table, since):
+    """_changed(table, since)
+
+    Return
+    ======
+    None, condition : Condition for the rows of `table` changed after
+    `since`; None if the table is always exported completely (places).
+    Snapshots (fingerprints) are exported by timestamp.
+    All open trips are exported (see `_remove_open_trips()`).
+    """
+    c = table.c
+    if table.name == "trips":
+        return or_(c.start_time > since, c.end_time > since, c.end_time.is_(None))
+    if "last_seen" in c.keys():
+        return c.last_seen > since
+    if table.name == "snapshots":
+        return c.timestamp > since
+    return None
+
+
+def _compress(file, tmp):
+    """_compress(file, tmp)
+
+    Moves (or gzip compresses if `file` ends on '.gz')
+    the temporary file `tmp` to `file`.
+    """
+    if file.endswith(".gz"):
+        with open(tmp, "rb") as src, gzip.open(file + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(tmp)
+        os.replace(file + ".tmp", file)
+    else:
+        os.replace(tmp, file)
+
+
+def _remove_open_trips(src, out, table):
+    """_remove_open_trips(src, out, table)
+
+    Deletes the open trips of the database (`out`) which are not open
+    in the export (`src`); open trips are deleted by `Trips.update()`
+    if the bike is back at the same place. The export contains all
+    open trips (see `_changed()`).
+
+    Return
+    ======
+    int : Number of trips deleted.
+    """
+    c    = table.c
+    stmt = select(c.number, c.start_time).where(c.end_time.is_(None))
+    keep = set([tuple(x) for x in src.execute(stmt)])
+    rows = [dict(b_number = x[0], b_start_time = x[1]) for x in out.execute(stmt) if not tuple(x) in keep]
+    if len(rows) > 0:
+        out.execute(delete(table).where((c.number == bindparam("b_number")) & \
+                                        (c.start_time == bindparam("b_start_time"))), rows)
+    return len(rows)
+
+
+def backup(db, file):
+    """backup(db, file)
+
+    Full copy of the database using the SQLite online backup API; the
+    copy is consistent even if the database is written while copying.
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy), SQLite only.
+    file : str
+        name of the output file, gzip compressed if ending on '.gz'.
+    """
+    if not isinstance(db, BikeDB): raise TypeError("'db' must be a BikeDB object")
+    if not isinstance(file, str):  raise TypeError("'file' must be str")
+    if not db.engine.dialect.name == "sqlite":
+        raise NotImplementedError("backup() only implemented for sqlite")
+
+    tmp = file + ".part"
+    if os.path.isfile(tmp): os.remove(tmp)
+    con = db.engine.raw_connection()
+    try:
+        dst = sqlite3.connect(tmp)
+        with dst: con.driver_connection.backup(dst, pages = 1024)
+        dst.close()
+    finally:
+        con.close()
+    _compress(file, tmp)
+
+
+def export(db, file, since = None, chunk_size = 10000):
+    """export(db, file, since = None, chunk_size = 10000)
+
+    Writes the rows changed after `since` into a new SQLite file with
+    the same schema. All tables are read in one transaction (consistent
+    snapshot).
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy) with the handlers (tables) defined.
+    file : str
+        name of the output file, gzip compressed if ending on '.gz'.
+    since : None, int
+        watermark; only rows with last_seen > since (trips started or
+        ended after since, or open) are exported. All rows if None.
+    chunk_size : int
+        number of rows read/written at once.
+
+    Return
+    ======
+    int : Number of rows exported.
+    """
+    if not isinstance(db, BikeDB):  raise TypeError("'db' must be a BikeDB object")
+    if not isinstance(file, str):   raise TypeError("'file' must be str")
+    if not since is None and not isinstance(since, int):
+        raise TypeError("'since' must be None or int")
+    if not isinstance(chunk_size, int) or chunk_size <= 0:
+        raise ValueError("'chunk_size' must be a positive int")
+
+    existing = inspect(db.engine).get_table_names()
+    tables   = [x for x in db.metadata.sorted_tables if x.name in existing]
+
+    tmp = file + ".part"
+    if os.path.isfile(tmp): os.remove(tmp)
+    dst = create_engine(f"sqlite+pysqlite:///{tmp}")
+    db.metadata.create_all(dst, tables = tables)
+
+    n = 0
+    with db.engine.connect() as con, dst.begin() as out:
+        # One read transaction for all tables; pysqlite emits no BEGIN
+        # for SELECT statements (each would read the latest state).
+        if db.engine.dialect.name == "sqlite":
+            con.exec_driver_sql("BEGIN")
+        else:
+            con.execution_options(isolation_level = "REPEATABLE READ")
+        for table in tables:
+            stmt = select(table)
+            if since is not None and _changed(table, since) is not None:
+                stmt = stmt.where(_changed(table, since))
+            result = con.execution_options(yield_per = chunk_size).execute(stmt)
+            for rows in result.mappings().partitions():
+                out.execute(table.insert(), [dict(x) for x in rows])
+                n += len(rows)
+        con.rollback()
+    dst.dispose()
+    _compress(file, tmp)
+    return n
+
+
+def import_export(db, file, chunk_size = 10000):
+    """import_export(db, file, chunk_size = 10000)
+
+    Merges an export (see `export()`) into the database; existing rows
+    are updated (matched by the unique constraint of the table). Open
+    trips not contained in the export (deleted in the source database)
+    are deleted.
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy) with the handlers (tables) defined.
+    file : str
+        name of the export, gzip compressed if ending on '.gz'.
+    chunk_size : int
+        number of rows read/written at once.
+
+    Return
+    ======
+    int : Number of rows imported.
+    """
+    if not isinstance(db, BikeDB): raise TypeError("'db' must be a BikeDB object")
+    if not isinstance(file, str):  raise TypeError("'file' must be str")
+    if not os.path.isfile(file):   raise FileNotFoundError(f"file '{file}' not found")
+
+    tmp = None
+    if file.endswith(".gz"):
+        fd, tmp = tempfile.mkstemp(suffix = ".db")
+        with os.fdopen(fd, "wb") as dst, gzip.open(file, "rb") as src:
+            shutil.copyfileobj(src, dst)
+    src = create_engine(f"sqlite+pysqlite:///{file if tmp is None else tmp}")
+
+    try:
+        existing = inspect(src).get_table_names()
+        n = 0
+        with src.connect() as con, db.begin() as out:
+            for table in db.metadata.sorted_tables:
+                if not table.name in existing: continue
+
+                # Columns identifying a row
+                keys = [x for x in table.constraints if isinstance(x, UniqueConstraint)] + \
+                       [x for x in table.constraints if isinstance(x, PrimaryKeyConstraint) and len(x.columns) > 0]
+                keys = [c.name for c in keys[0].columns] if len(keys) > 0 else None
+                if keys is None:
+                    raise Exception(f"no unique constraint for table '{table.name}'")
+
+                if table.name == "trips": _remove_open_trips(con, out, table)
+
+                update = lambda new, table = table, keys = keys: \
+                    {c.name: new[c.name] for c in table.columns if not c.name in keys}
+
+                result = con.execution_options(yield_per = chunk_size).execute(select(table))
+                for rows in result.mappings().partitions():
+                    db.writer.write(out, table, [dict(x) for x in rows], keys = keys, update = update)
+                    n += len(rows)
+    finally:
+        src.dispose()
+        if tmp is not None: os.remove(tmp)
+    return n
+
+
+def migrate_rentals(db, rentals, batch = 100):
+    """migrate_rentals(db, rentals, batch = 100)
+
+    One-time conversion of a 'rentals' table of the old layout (one row
+    per place and snapshot; place_id, timestamp, bikes, available) into
+    intervals (first_seen, last_seen; see `Rentals`). The old table is
+    renamed to 'rentals_old' and replayed snapshot by snapshot using
+    `Rentals.bulk_insert()` (aggregates are built as well if enabled),
+    then dropped. Can be resumed if interrupted.
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy) with the handlers (tables) defined;
+        `BikeDB.create_all()` is called after renaming the old table.
+    rentals : Rentals
+        database handler for rentals.
+    batch : int
+        number of snapshots read and written per transaction.
+
+    Return
+    ======
+    int : Number of snapshots converted; 0 if the table is up to date.
+    """
+    from itertools import groupby
+    from sqlalchemy import MetaData, Table, Index
+    from bikedb import Rentals
+    if not isinstance(db, BikeDB):       raise TypeError("'db' must be a BikeDB object")
+    if not isinstance(rentals, Rentals): raise TypeError("'rentals' must be a Rentals object")
+    if not isinstance(batch, int) or batch <= 0:
+        raise ValueError("'batch' must be a positive int")
+
+    insp = inspect(db.engine)
+    if "rentals" in insp.get_table_names():
+        columns = [x["name"] for x in insp.get_columns("rentals")]
+        if "timestamp" in columns and not "first_seen" in columns:
+            with db.engine.begin() as con:
+                con.exec_driver_sql("ALTER TABLE rentals RENAME TO rentals_old")
+    if not "rentals_old" in inspect(db.engine).get_table_names():
+        return 0
+    db.create_all()
+
+    # Snapshots not yet converted (resuming if interrupted)
+    old = Table("rentals_old", MetaData(), autoload_with = db.engine)
+    Index("rentals_old_index_timestamp", old.c.timestamp).create(db.engine, checkfirst = True)
+    latest = max([x["last_seen"] for x in rentals.get_previous_records().values()], default = None)
+    stmt   = select(old.c.timestamp).distinct().order_by(old.c.timestamp)
+    if latest is not None: stmt = stmt.where(old.c.timestamp > latest)
+    with db.begin() as con:
+        timestamps = con.execute(stmt).scalars().all()
+
+    stmt = select(old.c.place_id, old.c.timestamp, old.c.bikes, old.c.available)
+    with db.batch():
+        for i in range(0, len(timestamps), batch):
+            tmp = timestamps[i:(i + batch)]
+            with db.begin() as con:
+                rows = con.execute(stmt.where((old.c.timestamp >= tmp[0]) & (old.c.timestamp <= tmp[-1])) \
+                                       .order_by(old.c.timestamp, old.c.place_id)).mappings().all()
+            for timestamp, x in groupby(rows, key = lambda x: x["timestamp"]):
+                rentals.bulk_insert([dict(rec) for rec in x])
+            db.commit()
+
+    with db.engine.begin() as con:
+        con.exec_driver_sql("DROP TABLE rentals_old")
+    return len(timestamps)
+
+
+# -------------------------------------------------------------------
+# Main part
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from bikeconfig import bikeconfig
+    from bikedb import Places, Rentals, Bikes, Trips, Snapshots
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    parser = ArgumentParser("Consistent (incremental) exports of the database.")
+    parser.add_argument("action", choices = ["backup", "export", "import", "latest", "migrate"],
+                        help = "backup: full copy (online backup API); export: rows changed " + \
+                               "since --since; import: merge an export into the database; " + \
+                               "latest: print the latest timestamp in the database (watermark); " + \
+                               "migrate: convert a rentals table of the old layout (one row per " + \
+                               "place and snapshot) into intervals")
+    parser.add_argument("file", type = str, nargs = "?", default = None,
+                        help = "Output file (backup/export) or export to be imported; " + \
+                               "gzip compressed if ending on '.gz'")
+    parser.add_argument("--since", type = int, default = None,
+                        help = "Export; only rows changed after this timestamp (watermark)")
+    args = parser.parse_args()
+
+    if args.file is None and not args.action in ["latest", "migrate"]:
+        raise ValueError(f"file required for '{args.action}'")
+
+    db      = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                     partitions = cnf.partitions)
+    Places(db)
+    rentals = Rentals(db, rollups = cnf.rollups)
+    bikes   = Bikes(db)
+    Trips(db)
+    Snapshots(db)
+
+    # Before create_all(), fails on outdated tables
+    if args.action == "migrate":
+        n = migrate_rentals(db, rentals)
+        print(f"Converted {n} snapshots into rentals intervals" if n > 0 else "Rentals table up to date")
+        sys.exit(0)
+    db.create_all()
+
+    if args.action == "backup":
+        backup(db, args.file)
+        print(f"Database written to {args.file}")
+    elif args.action == "export":
+        n = export(db, args.file, args.since)
+        print(f"Exported {n} rows to {args.file}")
+    elif args.action == "import":
+        n = import_export(db, args.file)
+        print(f"Imported {n} rows from {args.file}")
+    else:
+        latest = bikes.latest_entry()
+        print(0 if latest is None else latest)
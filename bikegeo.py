@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Spatial layer for the places. Places are assigned to a grid cell
+# (indexed; bounding box queries), a district (point-in-polygon, e.g.,
+# the Innsbruck 'stadtteile' exported from R as GeoJSON using
+# sf::st_write(stadtteile, "stadtteile.geojson")), and free-floating
+# bikes to the nearest station. Computed once per place (vectorized,
+# numpy) and cached in the table 'places_geo' such that boundary
+# filtering and per-district aggregates are simple lookups.
+# -------------------------------------------------------------------
+
+import json
+import numpy as np
+from sqlalchemy import Table, Column, ForeignKey, Index, Integer, Float, String
+from sqlalchemy import select, delete, or_
+
+from bikedb import BikeDB, Places
+
+
+# Mean earth radius in meters
+EARTH_RADIUS = 6371000.
+
+
+def project(lon, lat, lat0):
+    """project(lon, lat, lat0)
+
+    Equirectangular projection; sufficiently accurate for distances
+    within a city.
+
+    Params
+    ======
+    lon, lat : numpy.ndarray
+        Coordinates (degrees).
+    lat0 : float
+        Reference latitude (degrees).
+
+    Return
+    ======
+    tuple : x and y in meters.
+    """
+    lon, lat = np.asarray(lon, dtype = float), np.asarray(lat, dtype = float)
+    return np.radians(lon) * np.cos(np.radians(lat0)) * EARTH_RADIUS, np.radians(lat) * EARTH_RADIUS
+
+
+def grid_cell(lon, lat, size = 0.005):
+    """grid_cell(lon, lat, size = 0.005)
+
+    Params
+    ======
+    lon, lat : numpy.ndarray
+        Coordinates (degrees).
+    size : float
+        Size of the grid cells in degrees.
+
+    Return
+    ======
+    numpy.ndarray : Cell ids (int64); row (latitude) * 2^24 + column (longitude),
+    i.e., the cells of one row are consecutive (see `PlacesGeo.in_bbox()`).
+    """
+    row = np.floor((np.asarray(lat, dtype = float) + 90.) / size).astype(np.int64)
+    col = np.floor((np.asarray(lon, dtype = float) + 180.) / size).astype(np.int64)
+    return row * 2**24 + col
+
+
+# -------------------------------------------------------------------
+# Districts; point-in-polygon
+# -------------------------------------------------------------------
+def load_districts(file, name = "name"):
+    """load_districts(file, name = "name")
+
+    Params
+    ======
+    file : str
+        GeoJSON file (FeatureCollection) with Polygon or MultiPolygon
+        features (WGS84, lon/lat).
+    name : str
+        Property containing the name of the district.
+
+    Return
+    ======
+    dict : Keys are the names of the districts, the items a list of
+    rings (numpy arrays with lon/lat, exterior rings and holes).
+    """
+    if not isinstance(file, str): raise TypeError("'file' must be str")
+    if not isinstance(name, str): raise TypeError("'name' must be str")
+    with open(file, "r") as fid:
+        tmp = json.load(fid)
+
+    res = {}
+    for feature in tmp["features"]:
+        geom = feature["geometry"]
+        if geom["type"] == "Polygon":
+            polygons = [geom["coordinates"]]
+        elif geom["type"] == "MultiPolygon":
+            polygons = geom["coordinates"]
+        else:
+            raise Exception(f"geometry type '{geom['type']}' not supported")
+        key = str(feature["properties"][name])
+        res.setdefault(key, [])
+        res[key] += [np.asarray(ring, dtype = float)[:, :2] for polygon in polygons for ring in polygon]
+    return res
+
+
+def points_in_polygon(lon, lat, rings):
+    """points_in_polygon(lon, lat, rings)
+
+    Even-odd rule (ray casting), vectorized over the points; points
+    outside the bounding box of the polygon are skipped.
+
+    Params
+    ======
+    lon, lat : numpy.ndarray
+        Coordinates of the points.
+    rings : list of numpy.ndarray
+        Rings of the polygon (see `load_districts()`).
+
+    Return
+    ======
+    numpy.ndarray : True for all points inside the polygon.
+    """
+    lon, lat = np.asarray(lon, dtype = float), np.asarray(lat, dtype = float)
+    allxy    = np.concatenate(rings)
+    idx = np.flatnonzero((lon >= allxy[:, 0].min()) & (lon <= allxy[:, 0].max()) &
+                         (lat >= allxy[:, 1].min()) & (lat <= allxy[:, 1].max()))
+    res = np.zeros(len(lon), dtype = bool)
+    if len(idx) == 0: return res
+
+    x, y   = lon[idx], lat[idx]
+    inside = np.zeros(len(idx), dtype = bool)
+    for ring in rings:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for i in range(len(ring)):
+            if y0[i] == y1[i]: continue
+            cross = (y0[i] > y) != (y1[i] > y)
+            xint  = x0[i] + (y - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+            inside ^= cross & (x < xint)
+    res[idx] = inside
+    return res
+
+
+def _distance_to_rings(x, y, rings):
+    """_distance_to_rings(x, y, rings)
+
+    Return
+    ======
+    numpy.ndarray : Distance of the points to the closest edge of the rings
+    (same units as `x`, `y`, and `rings`).
+    """
+    res = np.full(len(x), np.inf)
+    for ring in rings:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for i in range(len(ring)):
+            dx, dy = x1[i] - x0[i], y1[i] - y0[i]
+            d2 = dx * dx + dy * dy
+            t  = np.zeros(len(x)) if d2 == 0 else \
+                 np.clip(((x - x0[i]) * dx + (y - y0[i]) * dy) / d2, 0., 1.)
+            res = np.minimum(res, np.hypot(x - x0[i] - t * dx, y - y0[i] - t * dy))
+    return res
+
+
+def assign_districts(lon, lat, districts, buffer = 0.):
+    """assign_districts(lon, lat, districts, buffer = 0.)
+
+    Params
+    ======
+    lon, lat : numpy.ndarray
+        Coordinates of the points.
+    districts : dict
+        Districts as returned by `load_districts()`.
+    buffer : float
+        Points outside all districts but within `buffer` meters of a
+        district are assigned to the closest one (positions reported
+        slightly outside the boundary).
+
+    Return
+    ======
+    numpy.ndarray : Name of the district for each point (object),
+    None if outside all districts.
+    """
+    if not isinstance(districts, dict): raise TypeError("'districts' must be dict")
+    lon, lat = np.asarray(lon, dtype = float), np.asarray(lat, dtype = float)
+    res = np.full(len(lon), None, dtype = object)
+    for name, rings in districts.items():
+        res[points_in_polygon(lon, lat, rings) & (res == None)] = name
+
+    outside = np.flatnonzero(res == None)
+    if buffer > 0 and len(outside) > 0 and len(districts) > 0:
+        lat0 = float(np.mean(lat))
+        x, y = project(lon[outside], lat[outside], lat0)
+        best = np.full(len(outside), np.inf)
+        for name, rings in districts.items():
+            d   = _distance_to_rings(x, y, [np.stack(project(r[:, 0], r[:, 1], lat0), axis = 1) for r in rings])
+            idx = (d <= buffer) & (d < best)
+            res[outside[idx]] = name
+            best[idx] = d[idx]
+    return res
+
+
+# -------------------------------------------------------------------
+# Nearest station
+# -------------------------------------------------------------------
+class NearestStation:
+
+    def __init__(self, ids, lon, lat, max_distance = 500.):
+        """NearestStation(ids, lon, lat, max_distance = 500.)
+
+        Grid index over the stations for nearest-station lookups; the
+        cell size corresponds to `max_distance` such that only the
+        neighboring cells have to be searched.
+
+        Params
+        ======
+        ids : numpy.ndarray
+            Ids of the stations.
+        lon, lat : numpy.ndarray
+            Coordinates of the stations.
+        max_distance : float
+            Maximum distance (meters); stations further away are not returned.
+        """
+        if not max_distance > 0: raise ValueError("'max_distance' must be positive")
+        self.max_distance = float(max_distance)
+        self.lat0 = float(np.mean(lat)) if len(lat) > 0 else 0.
+
+        ids  = np.asarray(ids, dtype = np.int64)
+        x, y = project(lon, lat, self.lat0)
+        cell = self._cell(x, y)
+        idx  = np.argsort(cell, kind = "stable")
+        self.ids, self.x, self.y, self.cell = ids[idx], x[idx], y[idx], cell[idx]
+
+    def _cell(self, x, y):
+        return np.floor(y / self.max_distance).astype(np.int64) * 2**32 + \
+               np.floor(x / self.max_distance).astype(np.int64)
+
+    def query(self, lon, lat):
+        """query(lon, lat)
+
+        Params
+        ======
+        lon, lat : numpy.ndarray
+            Coordinates of the points.
+
+        Return
+        ======
+        tuple : Ids of the nearest station (int64, -1 if none within
+        `max_distance`) and the distance in meters (inf if none).
+        """
+        x, y = project(lon, lat, self.lat0)
+        res  = np.full(len(x), -1, dtype = np.int64)
+        best = np.full(len(x), np.inf)
+        if len(self.ids) == 0: return res, best
+
+        # Searching the 3x3 neighboring cells; stations sorted by cell
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                cell = self._cell(x + dx * self.max_distance, y + dy * self.max_distance)
+                lo   = np.searchsorted(self.cell, cell, side = "left")
+                hi   = np.searchsorted(self.cell, cell, side = "right")
+                for j in range(int((hi - lo).max())):
+                    pos   = np.flatnonzero(lo + j < hi)
+                    k     = lo[pos] + j
+                    d     = np.hypot(self.x[k] - x[pos], self.y[k] - y[pos])
+                    better = d < best[pos]
+                    res[pos[better]]  = self.ids[k[better]]
+                    best[pos[better]] = d[better]
+
+        far = best > self.max_distance
+        res[far], best[far] = -1, np.inf
+        return res, best
+
+
+# -------------------------------------------------------------------
+# Cache per place
+# -------------------------------------------------------------------
+class PlacesGeo:
+
+    def __init__(self, places, districts = None, buffer = 20., grid_size = 0.005, max_distance = 500.):
+        """PlacesGeo(places, districts = None, buffer = 20., grid_size = 0.005, max_distance = 500.)
+
+        Handler for 'places_geo'; grid cell, district, and nearest station
+        of each place (computed once, see `update()`).
+
+        Params
+        ======
+        places : Places
+            Database handler for places.
+        districts : None, dict
+            Districts (see `load_districts()`). If None, no districts are assigned.
+        buffer : float
+            Buffer in meters around the districts (see `assign_districts()`).
+        grid_size : float
+            Size of the grid cells in degrees (see `grid_cell()`).
+        max_distance : float
+            Maximum distance (meters) to the nearest station of free-floating bikes.
+        """
+        if not isinstance(places, Places): raise TypeError("'places' must be a Places object")
+        if not districts is None and not isinstance(districts, dict):
+            raise TypeError("'districts' must be None or dict")
+
+        self.db           = places.db
+        self.places       = places
+        self.districts    = districts
+        self.buffer       = buffer
+        self.grid_size    = grid_size
+        self.max_distance = max_distance
+        self.table = Table("places_geo", self.db.metadata,
+            Column("place_id",   ForeignKey("places.id"), primary_key = True),
+            Column("cell",       Integer,                 nullable = False),
+            Column("district",   String(100),             nullable = True),
+            Column("station_id", Integer,                 nullable = True),
+            Column("distance",   Float,                   nullable = True),
+
+            # Used for bounding box queries (see in_bbox())
+            Index("places_geo_index_cell", "cell")
+        )
+
+        # Lookup (sorted place ids, districts); see districts_of()
+        self._lookup = None
+
+    def update(self):
+        """update()
+
+        Computes the grid cell, the district, and (free-floating bikes) the
+        nearest station of all places not yet in 'places_geo'.
+
+        Return
+        ======
+        int : Number of places added.
+        """
+        p, g = self.places.table, self.table
+        stmt = select(p.c.id, p.c.timestamp, p.c.lon, p.c.lat) \
+                   .select_from(p.outerjoin(g, g.c.place_id == p.c.id)) \
+                   .where(g.c.place_id.is_(None))
+        with self.db.begin() as con:
+            new      = con.execute(stmt).all()
+            stations = con.execute(select(p.c.id, p.c.lon, p.c.lat).where(p.c.timestamp.is_(None))).all()
+        if len(new) == 0: return 0
+
+        ids      = np.array([x[0] for x in new], dtype = np.int64)
+        floating = np.array([x[1] is not None for x in new], dtype = bool)
+        lon      = np.array([x[2] for x in new], dtype = float)
+        lat      = np.array([x[3] for x in new], dtype = float)
+
+        cell     = grid_cell(lon, lat, self.grid_size)
+        district = np.full(len(ids), None, dtype = object) if self.districts is None else \
+                   assign_districts(lon, lat, self.districts, self.buffer)
+        station  = np.full(len(ids), -1, dtype = np.int64)
+        distance = np.full(len(ids), np.inf)
+        if floating.any() and len(stations) > 0:
+            index = NearestStation([x[0] for x in stations], [x[1] for x in stations],
+                                   [x[2] for x in stations], self.max_distance)
+            station[floating], distance[floating] = index.query(lon[floating], lat[floating])
+
+        rows = [dict(place_id   = int(ids[i]),
+                     cell       = int(cell[i]),
+                     district   = district[i],
+                     station_id = None if station[i] < 0 else int(station[i]),
+                     distance   = None if station[i] < 0 else round(float(distance[i]), 1))
+                for i in range(len(ids))]
+        with self.db.begin() as con:
+            self.db.writer.write(con, self.table, rows, ignore = True)
+        self._lookup = None
+        return len(rows)
+
+    def reset(self):
+        """reset()
+
+        Deletes the cache (e.g., after changing the districts or if
+        stations were added); recomputed by the next `update()`.
+        """
+        with self.db.begin() as con:
+            con.execute(delete(self.table))
+        self._lookup = None
+
+    def districts_of(self, place_ids):
+        """districts_of(place_ids)
+
+        Params
+        ======
+        place_ids : numpy.ndarray
+            Place ids (e.g., from `bikestate.FleetState`).
+
+        Return
+        ======
+        numpy.ndarray : District of each place (object), None if outside
+        all districts or unknown.
+        """
+        if self._lookup is None:
+            self.update()
+            with self.db.begin() as con:
+                tmp = con.execute(select(self.table.c.place_id, self.table.c.district)
+                                  .order_by(self.table.c.place_id)).all()
+            self._lookup = (np.array([x[0] for x in tmp], dtype = np.int64),
+                            np.array([x[1] for x in tmp] + [None], dtype = object))
+
+        ids, names = self._lookup
+        place_ids  = np.asarray(place_ids, dtype = np.int64)
+        idx   = np.searchsorted(ids, place_ids)
+        found = idx < len(ids)
+        found[found] = ids[idx[found]] == place_ids[found]
+        idx[~found]  = len(ids)
+        return names[idx]
+
+    def inside(self, place_ids):
+        """inside(place_ids)
+
+        Return
+        ======
+        numpy.ndarray : True for all places within a district (boundary filtering).
+        """
+        return self.districts_of(place_ids) != None
+
+    def aggregate(self, place_ids, values = None):
+        """aggregate(place_ids, values = None)
+
+        Params
+        ======
+        place_ids : numpy.ndarray
+            Place ids (e.g., from `bikestate.FleetState`).
+        values : None, numpy.ndarray
+            If set, the values are summed up per district, else counted.
+
+        Return
+        ======
+        dict : Count (sum) per district; places outside all districts are
+        not included.
+        """
+        district = self.districts_of(place_ids)
+        weights  = np.ones(len(district)) if values is None else np.asarray(values, dtype = float)
+        keep     = district != None
+        names, idx = np.unique(district[keep].astype(str), return_inverse = True)
+        res = np.bincount(idx, weights = weights[keep], minlength = len(names))
+        return {str(k): (int(v) if values is None else float(v)) for k, v in zip(names, res)}
+
+    def _stmt_bbox(self, lon0, lat0, lon1, lat1):
+        # One range of cells for each row of the grid; uses the cell index
+        a, b = grid_cell([lon0, lon1], [lat0, lat1], self.grid_size)
+        rows = range(int(a // 2**24), int(b // 2**24) + 1)
+        cols = (int(a % 2**24), int(b % 2**24))
+        return select(self.table.c.place_id).where(or_(*[
+                   self.table.c.cell.between(r * 2**24 + cols[0], r * 2**24 + cols[1]) for r in rows]))
+
+    def in_bbox(self, lon0, lat0, lon1, lat1):
+        """in_bbox(lon0, lat0, lon1, lat1)
+
+        Params
+        ======
+        lon0, lat0, lon1, lat1 : float
+            Bounding box (lower left, upper right).
+
+        Return
+        ======
+        list of int : Ids of the places within the bounding box.
+        """
+        self.update()
+        p = self.places.table
+        sub  = self._stmt_bbox(lon0, lat0, lon1, lat1).subquery()
+        stmt = select(p.c.id).join(sub, sub.c.place_id == p.c.id) \
+                   .where(p.c.lon.between(lon0, lon1) & p.c.lat.between(lat0, lat1))
+        with self.db.begin() as con:
+            return [x[0] for x in con.execute(stmt)]
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        return dict(in_bbox = self._stmt_bbox(11.3, 47.2, 11.4, 47.3))
+
+
+# -------------------------------------------------------------------
+# Main part; updating the cache, number of bikes per district.
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from bikeconfig import bikeconfig
+    from bikedb import Bikes
+    from bikestate import FleetState
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    parser = ArgumentParser("Spatial layer; districts and nearest stations of the places.")
+    parser.add_argument("-t", "--timestamp", type = int, default = None,
+                        help = "Number of bikes per district at this time")
+    parser.add_argument("--reset", action = "store_true",
+                        help = "Recompute the districts/nearest stations of all places")
+    args = parser.parse_args()
+
+    db     = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                    partitions = cnf.partitions)
+    places = Places(db)
+    geo    = PlacesGeo(places, None if cnf.districts is None else load_districts(cnf.districts, cnf.districts_name),
+                       buffer = cnf.districts_buffer, max_distance = cnf.station_distance)
+    bikes  = Bikes(db)
+    state  = FleetState(bikes)
+    db.create_all()
+
+    if args.reset: geo.reset()
+    print(f"Added {geo.update()} places to 'places_geo'")
+
+    if args.timestamp is not None:
+        for k, v in geo.aggregate(state.at(args.timestamp)["place_id"]).items():
+            print(f"{k:30s} {v}")
@@ -0,0 +1,295 @@
+# -------------------------------------------------------------------
+# Decoding nextbike (flat)json snapshots into typed records.
+# Uses msgspec or orjson if installed, else the json module of
+# the standard library.
+# -------------------------------------------------------------------
+
+import re
+import json
+from typing import NamedTuple
+
+
+# -------------------------------------------------------------------
+# Records
+# -------------------------------------------------------------------
+class Place(NamedTuple):
+    uid:                     int
+    name:                    str
+    lng:                     float
+    lat:                     float
+    bikes:                   int
+    bikes_available_to_rent: int
+
+class Bike(NamedTuple):
+    number:    int
+    bike_type: int
+    active:    bool
+    state:     str
+    place_id:  int
+
+class Snapshot(NamedTuple):
+    places: list
+    bikes:  list
+
+
+def _place(rec):
+    return Place(rec["uid"], rec["name"], rec["lng"], rec["lat"],
+                 rec["bikes"], rec["bikes_available_to_rent"])
+
+def _bike(rec):
+    return Bike(int(rec["number"]), rec["bike_type"], rec["active"],
+                rec["state"], rec["place_id"])
+
+
+# -------------------------------------------------------------------
+# Backend; msgspec decodes straight into typed structs (same fields in
+# the same order as the records above, converted into records), orjson
+# is a faster json.loads.
+# -------------------------------------------------------------------
+try:
+    import msgspec
+
+    class _Place(msgspec.Struct):
+        uid:                     int
+        name:                    str
+        lng:                     float
+        lat:                     float
+        bikes:                   int
+        bikes_available_to_rent: int
+
+    class _Bike(msgspec.Struct):
+        number:    int
+        bike_type: int
+        active:    bool
+        state:     str
+        place_id:  int
+
+    class _Snapshot(msgspec.Struct):
+        places: list[_Place]
+        bikes:  list[_Bike]
+
+    # strict = False allows numbers transmitted as strings (e.g., bike number)
+    _decoder = msgspec.json.Decoder(_Snapshot, strict = False)
+    BACKEND  = "msgspec"
+    loads    = msgspec.json.decode
+except ImportError:
+    try:
+        import orjson
+        BACKEND = "orjson"
+        loads   = orjson.loads
+    except ImportError:
+        BACKEND = "json"
+        loads   = json.loads
+
+
+def decode(x):
+    """decode(x)
+
+    Params
+    ======
+    x : str, bytes
+        Content of a json file (e.g., the API response).
+
+    Return
+    ======
+    Snapshot : Named tuple with 'places' and 'bikes', lists of typed
+    records (see `Place` and `Bike`). Raises an Exception if `x` is not
+    valid json or not a snapshot (same for all backends).
+    """
+    if not isinstance(x, (str, bytes)): raise TypeError("'x' must be str or bytes")
+
+    if BACKEND == "msgspec":
+        try:
+            x = _decoder.decode(x)
+        except (msgspec.ValidationError, msgspec.DecodeError) as e:
+            raise Exception(f"invalid json data: {e}")
+        astuple = msgspec.structs.astuple
+        return Snapshot([Place._make(astuple(rec)) for rec in x.places],
+                        [Bike._make(astuple(rec)) for rec in x.bikes])
+
+    try:
+        x = loads(x)
+    except ValueError as e:
+        raise Exception(f"invalid json data: {e}")
+    if not isinstance(x, dict) or not "places" in x.keys() or not "bikes" in x.keys():
+        raise Exception("invalid json data: not found 'places' or 'bikes'")
+    try:
+        return Snapshot([_place(rec) for rec in x["places"]],
+                        [_bike(rec) for rec in x["bikes"]])
+    except (KeyError, TypeError, ValueError) as e:
+        raise Exception(f"invalid json data: {e}")
+
+
+def fingerprint(x):
+    """fingerprint(x)
+
+    Content hash of a snapshot used to detect identical snapshots (feed
+    not refreshed). Normalized; only the fields decoded (see `Place`
+    and `Bike`) are considered and the records are sorted.
+
+    Params
+    ======
+    x : Snapshot
+        Decoded snapshot (see `decode()`, `stream()`).
+
+    Return
+    ======
+    str : SHA1 hash (hex).
+    """
+    import hashlib
+    places = sorted([tuple(getattr(rec, k) for k in Place._fields) for rec in x.places], key = repr)
+    bikes  = sorted([tuple(getattr(rec, k) for k in Bike._fields) for rec in x.bikes], key = repr)
+    return hashlib.sha1(repr((places, bikes)).encode()).hexdigest()
+
+
+# -------------------------------------------------------------------
+# Streaming parser
+# -------------------------------------------------------------------
+_whitespace = re.compile(r"[ \t\n\r]*")
+# Used to skip values (see iter_records()); strings, numbers/true/
+# false/null, and the content of arrays/objects up to the next bracket
+# (strings included)
+_string     = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_scalar     = re.compile(r"[^,}\] \t\n\r]*")
+_content    = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+
+def iter_records(fid, chunk_size = 1 << 16):
+    """iter_records(fid, chunk_size = 1 << 16)
+
+    Streams the records out of a json file without materialising the
+    whole document; reads the file in chunks and decodes one place or
+    bike at a time. Other top-level entries (e.g., 'countries') are
+    skipped without decoding them.
+
+    Params
+    ======
+    fid : file object
+        File opened in text mode.
+    chunk_size : int
+        Number of characters read at once.
+
+    Return
+    ======
+    generator : Yields typed records (`Place` or `Bike`) in the order
+    they appear in the file.
+    """
+    if not isinstance(chunk_size, int) or chunk_size <= 0:
+        raise ValueError("'chunk_size' must be a positive int")
+
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = fid.read(chunk_size)
+        if not chunk: eof = True
+        buf, pos = buf[pos:] + chunk, 0
+
+    def peek():
+        nonlocal pos
+        while True:
+            pos = _whitespace.match(buf, pos).end()
+            if pos < len(buf): return buf[pos]
+            if eof: return ""
+            more()
+
+    def value():
+        nonlocal pos
+        while True:
+            peek()
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # Values ending at the end of the buffer may be incomplete (numbers)
+                if end < len(buf) or eof:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof: raise
+            more()
+
+    def skip():
+        # Skips one value without decoding it; only the brackets outside
+        # of strings are visited (linear in the length of the value,
+        # consumed chunks are dropped).
+        nonlocal pos
+        char = peek()
+        if not char in ["[", "{"]:
+            # Strings, numbers, true, false, null
+            match = _string if char == '"' else _scalar
+            while True:
+                tmp = match.match(buf, pos)
+                if tmp is not None and (tmp.end() < len(buf) or eof):
+                    pos = tmp.end()
+                    return
+                if eof: raise Exception("invalid json data, unexpected end of file")
+                more()
+        depth = 0
+        while True:
+            # Arrays and objects; up to the next bracket
+            end = _content.match(buf, pos).end()
+            if end < len(buf) and buf[end] in "[]{}":
+                depth += 1 if buf[end] in "[{" else -1
+                pos    = end + 1
+                if depth == 0: return
+                continue
+            if eof: raise Exception("invalid json data, unexpected end of file")
+            pos = end
+            more()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char: raise Exception(f"invalid json data, expected '{char}'")
+        pos += 1
+
+    expect("{")
+    while True:
+        char = peek()
+        if char == "}": return
+        if char == ",":
+            pos += 1
+            continue
+        key = value()
+        expect(":")
+        if key in ["places", "bikes"] and peek() == "[":
+            fun = _place if key == "places" else _bike
+            pos += 1
+            while True:
+                char = peek()
+                if char == "]":
+                    pos += 1
+                    break
+                if char == ",":
+                    pos += 1
+                    continue
+                yield fun(value())
+        else:
+            skip()
+
+
+def stream(fid, chunk_size = 1 << 16):
+    """stream(fid, chunk_size = 1 << 16)
+
+    Collects the records of `iter_records()`. Only the raw document
+    and the entries skipped (e.g., 'countries') are not held in memory,
+    the decoded records are (required to process a snapshot, e.g.,
+    `fingerprint()`). Use `iter_records()` to process the records as
+    they arrive.
+
+    Params
+    ======
+    fid : file object
+        File opened in text mode.
+    chunk_size : int
+        Number of characters read at once.
+
+    Return
+    ======
+    Snapshot : Same as `decode()` but parsed with `iter_records()`.
+    """
+    places = []
+    bikes  = []
+    for rec in iter_records(fid, chunk_size):
+        if isinstance(rec, Place): places.append(rec)
+        else:                      bikes.append(rec)
+    return Snapshot(places, bikes)
+
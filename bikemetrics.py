@@ -0,0 +1,325 @@
+# -------------------------------------------------------------------
+# Instrumentation of the download and ingest. Timings, counters and
+# gauges are collected in the module-level `metrics` object and can be
+# exported in the Prometheus text format (file or http endpoint), sent
+# to a statsd daemon (udp), and written to a structured log (json
+# lines). Optionally, slow snapshots are profiled (cProfile or
+# pyinstrument if installed).
+# -------------------------------------------------------------------
+
+import os
+import re
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+
+    def __init__(self, prefix = "bikes"):
+        """Metrics(prefix = "bikes")
+
+        Collects counters (monotonically increasing), gauges (last value)
+        and timings (count, sum and max of the durations in seconds).
+
+        Params
+        ======
+        prefix : str
+            prefix of the metric names.
+        """
+        if not isinstance(prefix, str): raise TypeError("'prefix' must be str")
+        self.prefix   = prefix
+        self.counters = {}   # (name, labels): value
+        self.gauges   = {}   # (name, labels): value
+        self.timings  = {}   # (name, labels): [count, sum, max]
+        self._lock    = threading.Lock()
+        # Optional sinks (see configure())
+        self._statsd  = None
+        self._log     = None
+
+    def configure(self, statsd = None, log = None):
+        """configure(statsd = None, log = None)
+
+        Params
+        ======
+        statsd : None, str
+            if set ('host:port'), all values are also sent to this statsd daemon.
+        log : None, str
+            if set, events (see `event()`) are appended to this file (json lines).
+        """
+        if statsd is not None:
+            host, port   = statsd.rsplit(":", 1)
+            self._statsd = (socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (host, int(port)))
+        self._log = log
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def _send(self, name, value, kind):
+        if self._statsd is None: return
+        try:
+            self._statsd[0].sendto(f"{self.prefix}.{name}:{value}|{kind}".encode(), self._statsd[1])
+        except OSError:
+            pass # Metrics must never break the ingest
+
+    def count(self, name, value = 1, **labels):
+        """count(name, value = 1, **labels)
+
+        Increases counter `name` by `value`.
+        """
+        key = self._key(name, labels)
+        with self._lock: self.counters[key] = self.counters.get(key, 0) + value
+        self._send(name, value, "c")
+
+    def gauge(self, name, value, **labels):
+        """gauge(name, value, **labels)
+
+        Sets gauge `name` to `value`.
+        """
+        with self._lock: self.gauges[self._key(name, labels)] = value
+        self._send(name, value, "g")
+
+    def observe(self, name, seconds, **labels):
+        """observe(name, seconds, **labels)
+
+        Records a duration (seconds).
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            x = self.timings.setdefault(key, [0, 0., 0.])
+            x[0] += 1
+            x[1] += seconds
+            x[2]  = max(x[2], seconds)
+        self._send(name, round(seconds * 1000, 3), "ms")
+
+    @contextmanager
+    def timer(self, name, into = None, **labels):
+        """timer(name, into = None, **labels)
+
+        Context manager recording the duration of its body (see `observe()`).
+        If `into` (dict) is set, the duration is also stored in `into`
+        (key: label 'stage' if set, else `name`).
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t
+            self.observe(name, seconds, **labels)
+            if into is not None: into[labels.get("stage", name)] = round(seconds, 6)
+
+    def event(self, name, **fields):
+        """event(name, **fields)
+
+        Writes an event to the structured log (if configured).
+        """
+        if self._log is None: return
+        rec = dict(time = round(time.time(), 3), event = name, **fields)
+        with self._lock, open(self._log, "a") as fid:
+            fid.write(json.dumps(rec) + "\n")
+
+    def _parse(self, text):
+        """_parse(text)
+
+        Return
+        ======
+        tuple : Counters, gauges and timings (see `Metrics`) read from
+        `text` (Prometheus text format as written by `prometheus()`).
+        """
+        counters, gauges, timings, kinds = {}, {}, {}, {}
+        pat = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$")
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                tmp = line[7:].split(" ")
+                if len(tmp) == 2: kinds[tmp[0]] = tmp[1]
+                continue
+            tmp = pat.match(line)
+            if not tmp or not tmp.group(1).startswith(self.prefix + "_"): continue
+            name   = tmp.group(1)[len(self.prefix) + 1:]
+            labels = tuple(sorted(re.findall(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"', tmp.group(2) or "")))
+            value  = int(tmp.group(3)) if re.match(r"^-?[0-9]+$", tmp.group(3)) else float(tmp.group(3))
+            kind   = kinds.get(tmp.group(1))
+            if kind == "counter":
+                counters[(name, labels)] = value
+            elif kind == "gauge":
+                gauges[(name, labels)] = value
+            else:
+                for i, suffix in enumerate(["_seconds_count", "_seconds_sum", "_seconds_max"]):
+                    summary = tmp.group(1)[:-len(suffix)] + "_seconds"
+                    if name.endswith(suffix) and kinds.get(summary) == "summary":
+                        timings.setdefault((name[:-len(suffix)], labels), [0, 0., 0.])[i] = value
+        return counters, gauges, timings
+
+    def prometheus(self, previous = None):
+        """prometheus(previous = None)
+
+        Params
+        ======
+        previous : None, str
+            if set, metrics in the Prometheus text format (e.g., written by
+            an earlier process); counters and timings are added to the
+            values collected, gauges not set by this process are kept.
+
+        Return
+        ======
+        str : All metrics in the Prometheus text exposition format.
+        """
+        def fmt(name, labels, value):
+            tmp = ",".join([f'{k}="{v}"' for k, v in labels])
+            return f"{self.prefix}_{name}{{{tmp}}} {value}" if tmp else f"{self.prefix}_{name} {value}"
+
+        # Label values as written (str) such that the keys can be merged
+        key = lambda k: (k[0], tuple([(l, str(v)) for l, v in k[1]]))
+        with self._lock:
+            counters = {key(k): v for k, v in self.counters.items()}
+            gauges   = {key(k): v for k, v in self.gauges.items()}
+            timings  = {key(k): list(v) for k, v in self.timings.items()}
+        if previous is not None:
+            c, g, t = self._parse(previous)
+            for k, v in c.items(): counters[k] = counters.get(k, 0) + v
+            for k, v in g.items(): gauges.setdefault(k, v)
+            for k, v in t.items():
+                x = timings.setdefault(k, [0, 0., 0.])
+                x[0], x[1], x[2] = x[0] + v[0], x[1] + v[1], max(x[2], v[2])
+
+        res = []
+        for kind, values in [("counter", counters), ("gauge", gauges)]:
+            for name in sorted(set([k[0] for k in values.keys()])):
+                res.append(f"# TYPE {self.prefix}_{name} {kind}")
+                res += [fmt(name, k[1], v) for k, v in values.items() if k[0] == name]
+        for name in sorted(set([k[0] for k in timings.keys()])):
+            res.append(f"# TYPE {self.prefix}_{name}_seconds summary")
+            for k, v in timings.items():
+                if not k[0] == name: continue
+                res.append(fmt(f"{name}_seconds_count", k[1], v[0]))
+                res.append(fmt(f"{name}_seconds_sum", k[1], round(v[1], 6)))
+                res.append(fmt(f"{name}_seconds_max", k[1], round(v[2], 6)))
+        return "\n".join(res) + "\n"
+
+    def write_prometheus(self, file, accumulate = False):
+        """write_prometheus(file, accumulate = False)
+
+        Writes the metrics to `file` (Prometheus text format; e.g., for
+        the textfile collector of the node exporter). Written atomically.
+
+        Params
+        ======
+        file : str
+            name of the file.
+        accumulate : bool
+            if False (long-running process) the file is replaced. If True
+            (short-lived processes, e.g., cron mode) the values of this
+            process are added to those in the existing file (see
+            `prometheus()`) such that the counters keep increasing across
+            runs; call once per process.
+        """
+        if not accumulate:
+            with open(file + ".tmp", "w") as fid: fid.write(self.prometheus())
+            os.replace(file + ".tmp", file)
+            return
+
+        # Processes running concurrently (e.g., downloader and alchemy)
+        import fcntl
+        with open(file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            previous = None
+            if os.path.isfile(file):
+                with open(file, "r") as fid: previous = fid.read()
+            with open(file + ".tmp", "w") as fid: fid.write(self.prometheus(previous))
+            os.replace(file + ".tmp", file)
+
+    def serve(self, port, host = "127.0.0.1"):
+        """serve(port, host = "127.0.0.1")
+
+        Starts an http server in a background thread serving the
+        metrics in the Prometheus text format (any path).
+
+        Return
+        ======
+        http.server.ThreadingHTTPServer : The server.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        return server
+
+
+# Used by all modules
+metrics = Metrics()
+
+
+# -------------------------------------------------------------------
+# Profiling slow snapshots
+# -------------------------------------------------------------------
+class SlowProfiler:
+
+    def __init__(self, threshold, dir = "."):
+        """SlowProfiler(threshold, dir = ".")
+
+        Profiles code blocks (see `profile()`) and keeps the profile
+        only if the block took longer than `threshold` seconds. Uses
+        pyinstrument if installed (html report), else cProfile (pstats file).
+
+        Params
+        ======
+        threshold : float
+            latency threshold in seconds.
+        dir : str
+            directory the profiles are written to.
+        """
+        if not isinstance(threshold, (int, float)) or threshold <= 0:
+            raise ValueError("'threshold' must be a positive number")
+        if not isinstance(dir, str): raise TypeError("'dir' must be str")
+        self.threshold = threshold
+        self.dir       = dir
+        try:
+            import pyinstrument
+            self._pyinstrument = pyinstrument
+        except ImportError:
+            self._pyinstrument = None
+
+    @contextmanager
+    def profile(self, name):
+        """profile(name)
+
+        Context manager profiling its body; the profile is
+        written to `dir/profile_<name>.(html|prof)` if slow.
+        """
+        if self._pyinstrument is not None:
+            profiler = self._pyinstrument.Profiler()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+        t = time.perf_counter()
+        profiler.enable() if self._pyinstrument is None else profiler.start()
+        try:
+            yield
+        finally:
+            profiler.disable() if self._pyinstrument is None else profiler.stop()
+            seconds = time.perf_counter() - t
+            if seconds > self.threshold:
+                os.makedirs(self.dir, exist_ok = True)
+                if self._pyinstrument is None:
+                    file = os.path.join(self.dir, f"profile_{name}.prof")
+                    profiler.dump_stats(file)
+                else:
+                    file = os.path.join(self.dir, f"profile_{name}.html")
+                    with open(file, "w") as fid: fid.write(profiler.output_html())
+                metrics.count("slow_snapshots_total")
+                metrics.event("slow_snapshot", block = name, seconds = round(seconds, 3), profile = file)
@@ -0,0 +1,300 @@
+# -------------------------------------------------------------------
+# Monthly partitions of the 'bikes' and 'rentals' tables (SQLite).
+# With monthly partitioning enabled (see `BikeDB`) intervals never span
+# two months; the ingest writes to the main database (current
+# partition), completed months are moved into separate files
+# <database>_YYYY-mm.db which are not modified afterwards and can be
+# compacted, archived or dropped independently. The latest record of
+# each bike/place is always kept in the main database as it is used
+# by the ingest. select_range() reads the main database and the
+# partitions overlapping with a time range (attached on demand).
+# -------------------------------------------------------------------
+
+import os
+import re
+import time
+import sqlite3
+import datetime as dt
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy import select, insert, delete, func, tuple_
+
+from bikedb import BikeDB
+
+
+# Partitioned tables; name: column identifying a bike/place
+PARTITIONED = {"bikes": "number", "rentals": "place_id"}
+
+
+def month_range(month):
+    """month_range(month)
+
+    Params
+    ======
+    month : str
+        Partition, 'YYYY-mm'.
+
+    Return
+    ======
+    tuple : Start (inclusive) and end (exclusive) of the month (timestamps, UTC).
+    """
+    if not isinstance(month, str) or not re.match(r"^[0-9]{4}-[0-9]{2}$", month):
+        raise ValueError("'month' must be str of format 'YYYY-mm'")
+    start = dt.datetime.strptime(month, "%Y-%m").replace(tzinfo = dt.timezone.utc)
+    end   = (start + dt.timedelta(days = 32)).replace(day = 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def _check(db):
+    if not isinstance(db, BikeDB): raise TypeError("'db' must be a BikeDB object")
+    if not db.engine.dialect.name == "sqlite":
+        raise NotImplementedError("partitions only implemented for sqlite")
+    if not db.partitions == "monthly":
+        raise Exception("monthly partitioning not enabled (see BikeDB)")
+    if db.in_batch():
+        raise Exception("not allowed in batch mode")
+
+
+def get_file(db, month):
+    """get_file(db, month)
+
+    Return
+    ======
+    str : Name of the file of the partition `month` ('YYYY-mm').
+    """
+    month_range(month) # Checks format
+    base, ext = os.path.splitext(db.engine.url.database)
+    return f"{base}_{month}{ext}"
+
+
+def list_partitions(db):
+    """list_partitions(db)
+
+    Return
+    ======
+    list of str : Months ('YYYY-mm') moved into separate files, sorted.
+    """
+    base, ext = os.path.splitext(db.engine.url.database)
+    dir       = os.path.dirname(os.path.abspath(base))
+    pattern   = re.compile(f"^{re.escape(os.path.basename(base))}_([0-9]{{4}}-[0-9]{{2}}){re.escape(ext)}$")
+    res = [pattern.match(x) for x in os.listdir(dir)]
+    return sorted([x.group(1) for x in res if x])
+
+
+def _part_table(table, schema):
+    """_part_table(table, schema)
+
+    Return
+    ======
+    sqlalchemy.Table : Copy of `table` (columns only, no constraints)
+    in schema `schema` (attached database).
+    """
+    return Table(table.name, MetaData(),
+                 *[Column(c.name, c.type, nullable = c.nullable) for c in table.columns],
+                 Index(f"{table.name}_index_first_seen", "first_seen"),
+                 Index(f"{table.name}_index_last_seen", "last_seen"),
+                 schema = schema)
+
+
+def archive(db, month):
+    """archive(db, month)
+
+    Moves the records of a completed month from the main database into
+    the file of the partition (see `get_file()`), except the latest
+    record of each bike/place. Done in two steps, each a transaction on
+    one database: the partition is written to a temporary file ('.part',
+    removed if left by an interrupted run) and renamed, then the records
+    contained in the partition are deleted from the main database. If
+    the partition already exists only the second step is done (e.g.,
+    interrupted before).
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy) with the handlers (tables) defined.
+    month : str
+        Partition, 'YYYY-mm'.
+
+    Return
+    ======
+    dict : Number of records moved (deleted from the main database) per table.
+    """
+    _check(db)
+    start, end = month_range(month)
+    if end > time.time():
+        raise Exception(f"month {month} not yet completed")
+    file = get_file(db, month)
+
+    # Writing the partition
+    if not os.path.isfile(file):
+        for x in [file + ".part", file + ".part-journal", file + ".part-wal", file + ".part-shm"]:
+            if os.path.isfile(x): os.remove(x)
+        with db.engine.connect() as con:
+            con.exec_driver_sql("ATTACH DATABASE ? AS part", (file + ".part",))
+            con.commit()
+            try:
+                with con.begin():
+                    for name, key in PARTITIONED.items():
+                        table = db.metadata.tables[name]
+                        part  = _part_table(table, "part")
+                        part.create(con)
+
+                        # Latest record of each bike/place stays in main
+                        latest = select(table.c[key], func.max(table.c.first_seen)).group_by(table.c[key])
+                        where  = (table.c.first_seen >= start) & (table.c.first_seen < end) & \
+                                 tuple_(table.c[key], table.c.first_seen).not_in(latest)
+                        con.execute(insert(part).from_select([c.name for c in table.columns],
+                                                             select(*table.columns).where(where)))
+            finally:
+                con.exec_driver_sql("DETACH DATABASE part")
+                con.commit()
+        os.replace(file + ".part", file)
+
+    # Deleting the records contained in the partition from main
+    res = {}
+    with db.engine.connect() as con:
+        con.exec_driver_sql("ATTACH DATABASE ? AS part", (file,))
+        con.commit()
+        try:
+            with con.begin():
+                for name, key in PARTITIONED.items():
+                    table = db.metadata.tables[name]
+                    part  = _part_table(table, "part")
+                    where = (table.c.first_seen >= start) & (table.c.first_seen < end) & \
+                            tuple_(table.c[key], table.c.first_seen).in_(select(part.c[key], part.c.first_seen))
+                    res[name] = con.execute(delete(table).where(where)).rowcount
+        finally:
+            con.exec_driver_sql("DETACH DATABASE part")
+            con.commit()
+    return res
+
+
+def compact(db, month):
+    """compact(db, month)
+
+    Vacuums the file of the partition `month` ('YYYY-mm').
+    """
+    file = get_file(db, month)
+    if not os.path.isfile(file): raise FileNotFoundError(f"partition {month} not found")
+    con = sqlite3.connect(file)
+    try:
+        con.execute("VACUUM")
+    finally:
+        con.close()
+
+
+def select_range(db, table, start = None, end = None):
+    """select_range(db, table, start = None, end = None)
+
+    Reads the records of a partitioned table overlapping with a time
+    range from the main database and the partitions needed.
+
+    Params
+    ======
+    db : BikeDB
+        database handler (SQLAlchemy) with the handlers (tables) defined.
+    table : str
+        Either 'bikes' or 'rentals'.
+    start : None, int
+        If set, only records with last_seen >= start.
+    end : None, int
+        If set, only records with first_seen <= end.
+
+    Return
+    ======
+    list of dict : Records ordered by first_seen.
+    """
+    if not table in PARTITIONED.keys():
+        raise ValueError(f"'table' must be one of: {', '.join(PARTITIONED.keys())}")
+    table = db.metadata.tables[table]
+
+    def stmt(x):
+        res = select(*[x.c[c.name] for c in table.columns])
+        if start is not None: res = res.where(x.c.last_seen >= start)
+        if end is not None:   res = res.where(x.c.first_seen <= end)
+        return res
+
+    # Partitions overlapping with [start, end]
+    months = []
+    if db.partitions is not None and db.engine.dialect.name == "sqlite":
+        for month in list_partitions(db):
+            a, b = month_range(month)
+            if (start is None or b > start) and (end is None or a <= end):
+                months.append(month)
+
+    res = []
+    with db.engine.connect() as con:
+        with con.begin():
+            res += [dict(x) for x in con.execute(stmt(table)).mappings()]
+        # Attached one by one (number of attached databases is limited)
+        for month in months:
+            con.exec_driver_sql("ATTACH DATABASE ? AS part", (get_file(db, month),))
+            con.commit()
+            try:
+                with con.begin():
+                    res += [dict(x) for x in con.execute(stmt(_part_table(table, "part"))).mappings()]
+            finally:
+                con.exec_driver_sql("DETACH DATABASE part")
+                con.commit()
+    res.sort(key = lambda x: x["first_seen"])
+    return res
+
+
+# -------------------------------------------------------------------
+# Main part; managing the partitions.
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from bikeconfig import bikeconfig
+    from bikedb import Places, Rentals, Bikes, Trips
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    parser = ArgumentParser("Managing monthly partitions.")
+    parser.add_argument("action", choices = ["list", "archive", "compact", "drop"],
+                        help = "list: show partitions; archive: move completed months into " + \
+                               "separate files; compact: vacuum a partition; drop: delete a partition")
+    parser.add_argument("-m", "--month", type = str, default = None,
+                        help = "Partition (YYYY-mm); required for compact/drop, archive " + \
+                               "defaults to all completed months (completing interrupted runs)")
+    args = parser.parse_args()
+
+    db    = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                   partitions = cnf.partitions)
+    Places(db)
+    Rentals(db, rollups = cnf.rollups)
+    bikes = Bikes(db)
+    Trips(db)
+    db.create_all()
+
+    if args.action in ["compact", "drop"] and args.month is None:
+        raise ValueError(f"-m/--month required for '{args.action}'")
+
+    if args.action == "list":
+        for month in list_partitions(db):
+            print(f"{month}  {get_file(db, month)}")
+    elif args.action == "archive":
+        if args.month is not None:
+            months = [args.month]
+        else:
+            # All completed months since the first record (archived months
+            # again, completing interrupted runs); the month of the latest
+            # record is the current partition.
+            with db.begin() as con:
+                first = con.execute(select(func.min(bikes.table.c.first_seen))).scalar_one_or_none()
+            months = []
+            month  = None if first is None else db.partition(first)
+            if month is not None:
+                current = min(db.partition(int(time.time())), db.partition(bikes.latest_entry()))
+            while month is not None and month < current:
+                months.append(month)
+                month = db.partition(month_range(month)[1])
+        for month in months:
+            res = archive(db, month)
+            print(f"Archived {month}: " + ", ".join([f"{v} {k}" for k, v in res.items()]))
+    elif args.action == "compact":
+        compact(db, args.month)
+        print(f"Compacted {get_file(db, args.month)}")
+    else:
+        os.remove(get_file(db, args.month))
+        print(f"Dropped {get_file(db, args.month)}")
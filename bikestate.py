@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Point-in-time fleet state. Finding the intervals of 'bikes' (or
+# 'rentals') covering a time T (first_seen <= T <= last_seen) would
+# require scanning the history. Instead, periodic checkpoints store
+# the intervals active at the checkpoint (keys only); the state at T
+# is given by the intervals of the latest checkpoint <= T which last
+# until T plus the intervals started in between (delta). Both are
+# index lookups bounded by the checkpoint interval. Results are
+# returned as columnar numpy arrays.
+# -------------------------------------------------------------------
+
+import numpy as np
+from sqlalchemy import Table, Column, Integer, Boolean, PrimaryKeyConstraint
+from sqlalchemy import select, delete, func
+
+from bikedb import Bikes, Rentals
+from bikepartitions import select_range
+
+
+class FleetState:
+
+    def __init__(self, handler, interval = 86400):
+        """FleetState(handler, interval = 86400)
+
+        Point-in-time and time-window queries on the intervals of
+        bikes or places (rentals). Creates the table '<table>_checkpoints'
+        (call `BikeDB.create_all()` afterwards).
+
+        Checkpoints are built incrementally (see `update()`); each contains
+        all intervals active at the checkpoint plus the latest interval of
+        each bike/place (which may still be extended by the ingest).
+        Intervals imported afterwards with an older first_seen (see
+        bikeexport.py) require to rebuild the checkpoints (see `reset()`).
+        With monthly partitions (see `BikeDB`) the partitions are read
+        directly (see `bikepartitions.select_range()`), no checkpoints.
+
+        Params
+        ======
+        handler : Bikes, Rentals
+            Database handler for bikes or rentals.
+        interval : int
+            Seconds between two checkpoints; defaults to one day.
+        """
+        if not isinstance(handler, (Bikes, Rentals)):
+            raise TypeError("'handler' must be a Bikes or Rentals object")
+        if not isinstance(interval, int) or interval <= 0:
+            raise ValueError("'interval' must be a positive int")
+
+        self.db       = handler.db
+        self.handler  = handler
+        self.interval = interval
+        self.key      = "number" if isinstance(handler, Bikes) else "place_id"
+
+        name = handler.table.name
+        self.table = Table(f"{name}_checkpoints", self.db.metadata,
+            Column("timestamp",  Integer, nullable = False),
+            Column(self.key,     Integer, nullable = False),
+            Column("first_seen", Integer, nullable = False),
+
+            # Entries of one checkpoint are read using the primary key
+            PrimaryKeyConstraint("timestamp", self.key, "first_seen",
+                                 name = f"{name}_checkpoints_pk")
+        )
+
+    # ---------------------------------------------------------------
+    # Checkpoints
+    # ---------------------------------------------------------------
+    def update(self):
+        """update()
+
+        Builds all missing checkpoints up to the latest interval started
+        (all snapshots up to this time are processed). Each checkpoint is
+        derived from the previous one and the intervals started in between.
+
+        Return
+        ======
+        int : Number of checkpoints added.
+        """
+        if self.db.partitions is not None: return 0
+
+        c = self.handler.table.c
+        with self.db.begin() as con:
+            first, latest = con.execute(select(func.min(c.first_seen), func.max(c.first_seen))).one()
+            last = con.execute(select(func.max(self.table.c.timestamp))).scalar_one_or_none()
+        if latest is None: return 0
+
+        # Entries (key, first_seen: last_seen) of the latest checkpoint
+        if last is None:
+            current, previous = {}, None
+            timestamp = (first // self.interval + 1) * self.interval
+        else:
+            current, previous = self._load(last), last
+            timestamp = last + self.interval
+
+        n = 0
+        while timestamp <= latest:
+            stmt = select(c[self.key], c.first_seen, c.last_seen).where(c.first_seen <= timestamp)
+            if previous is not None: stmt = stmt.where(c.first_seen > previous)
+            with self.db.begin() as con:
+                for rec in con.execute(stmt): current[(rec[0], rec[1])] = rec[2]
+
+            # Active at the checkpoint, plus latest interval of each key
+            newest = {}
+            for (key, first_seen) in current.keys():
+                if first_seen > newest.get(key, first_seen - 1): newest[key] = first_seen
+            current = {k: v for k, v in current.items() if v >= timestamp or newest[k[0]] == k[1]}
+
+            rows = [{"timestamp": timestamp, self.key: k[0], "first_seen": k[1]} for k in current.keys()]
+            with self.db.begin() as con:
+                self.db.writer.write(con, self.table, rows, ignore = True)
+            previous   = timestamp
+            timestamp += self.interval
+            n += 1
+        return n
+
+    def _load(self, timestamp):
+        """_load(timestamp)
+
+        Return
+        ======
+        dict : Entries of the checkpoint `timestamp`; the keys are tuples
+        (key, first_seen), the items the current last_seen of the interval.
+        """
+        stmt = select(self.handler.table.c[self.key], self.handler.table.c.first_seen,
+                      self.handler.table.c.last_seen
+                     ).select_from(self._join()).where(self.table.c.timestamp == timestamp)
+        with self.db.begin() as con:
+            return {(x[0], x[1]): x[2] for x in con.execute(stmt)}
+
+    def reset(self):
+        """reset()
+
+        Deletes all checkpoints; rebuilt by the next `update()`.
+        """
+        with self.db.begin() as con:
+            con.execute(delete(self.table))
+
+    def _join(self):
+        t = self.handler.table
+        return t.join(self.table, (self.table.c[self.key] == t.c[self.key]) &
+                                  (self.table.c.first_seen == t.c.first_seen))
+
+    # ---------------------------------------------------------------
+    # Queries
+    # ---------------------------------------------------------------
+    def _stmt_checkpoint(self, timestamp):
+        # Latest checkpoint at or before timestamp; uses the primary key
+        return select(func.max(self.table.c.timestamp)).where(self.table.c.timestamp <= timestamp)
+
+    def _stmt_active(self, checkpoint, timestamp):
+        # Intervals of the checkpoint still active at timestamp
+        t = self.handler.table
+        return select(t).select_from(self._join()).where(
+                   (self.table.c.timestamp == checkpoint) & (t.c.last_seen >= timestamp))
+
+    def _stmt_started(self, after, end, timestamp = None):
+        # Intervals started in (after, end]; active at timestamp if set
+        c    = self.handler.table.c
+        stmt = select(self.handler.table).where(c.first_seen <= end)
+        if after is not None:     stmt = stmt.where(c.first_seen > after)
+        if timestamp is not None: stmt = stmt.where(c.last_seen >= timestamp)
+        return stmt
+
+    def _columns(self, rows):
+        """_columns(rows)
+
+        Return
+        ======
+        dict : Columnar representation of `rows` (one numpy array for each
+        column of the table), ordered by key and first_seen.
+        """
+        res = {}
+        for i, col in enumerate(self.handler.table.columns):
+            if isinstance(col.type, Integer):   dtype = np.int64
+            elif isinstance(col.type, Boolean): dtype = bool
+            else:                               dtype = object
+            res[col.name] = np.array([x[i] for x in rows], dtype = dtype)
+        idx = np.lexsort((res["first_seen"], res[self.key]))
+        return {k: v[idx] for k, v in res.items()}
+
+    def _rows_range(self, start, end):
+        """_rows_range(start, end)
+
+        Return
+        ======
+        list : Rows (tuples) of the intervals overlapping with [start, end].
+        """
+        if self.db.partitions is not None:
+            names = [c.name for c in self.handler.table.columns]
+            tmp   = select_range(self.db, self.handler.table.name, start, end)
+            return [tuple(x[k] for k in names) for x in tmp]
+
+        # Make sure the intervals in the database are up to date
+        if isinstance(self.handler, Rentals): self.handler.flush()
+
+        self.update()
+        with self.db.begin() as con:
+            checkpoint = con.execute(self._stmt_checkpoint(start)).scalar_one_or_none()
+            res = [] if checkpoint is None else con.execute(self._stmt_active(checkpoint, start)).all()
+            res += con.execute(self._stmt_started(checkpoint, start, start)).all()
+            if end > start:
+                res += con.execute(self._stmt_started(start, end)).all()
+        return res
+
+    def at(self, timestamp):
+        """at(timestamp)
+
+        Params
+        ======
+        timestamp : int
+            point in time.
+
+        Return
+        ======
+        dict : State at `timestamp`; the intervals covering `timestamp`
+        (one per bike/place), one numpy array for each column of the
+        table (e.g., number, place_id, state for bikes), ordered by
+        bike number (place id).
+        """
+        if not isinstance(timestamp, int): raise TypeError("'timestamp' must be int")
+        return self._columns(self._rows_range(timestamp, timestamp))
+
+    def window(self, start, end):
+        """window(start, end)
+
+        Params
+        ======
+        start, end : int
+            time window (inclusive).
+
+        Return
+        ======
+        dict : All intervals overlapping with the time window, see `at()`;
+        ordered by bike number (place id) and first_seen.
+        """
+        if not isinstance(start, int): raise TypeError("'start' must be int")
+        if not isinstance(end, int):   raise TypeError("'end' must be int")
+        if end < start: raise ValueError("'end' must be larger or equal to 'start'")
+        return self._columns(self._rows_range(start, end))
+
+    def replay(self, start, end, step = 60, chunk = 3600):
+        """replay(start, end, step = 60, chunk = 3600)
+
+        Streams the state every `step` seconds from `start` to `end`
+        (e.g., map animations). The intervals are loaded in chunks
+        (see `window()`), the states are derived in memory.
+
+        Params
+        ======
+        start, end : int
+            time window (inclusive).
+        step : int
+            seconds between two states.
+        chunk : int
+            seconds loaded at once.
+
+        Return
+        ======
+        generator : Yields tuples with the timestamp and the
+        state at this time (see `at()`).
+        """
+        if not isinstance(step, int) or step <= 0:   raise ValueError("'step' must be a positive int")
+        if not isinstance(chunk, int) or chunk <= 0: raise ValueError("'chunk' must be a positive int")
+        chunk = max(chunk // step, 1) * step
+        for a in range(start, end + 1, chunk):
+            b = min(a + chunk - step, end)
+            x = self.window(a, b)
+            for t in range(a, b + 1, step):
+                idx = (x["first_seen"] <= t) & (x["last_seen"] >= t)
+                yield t, {k: v[idx] for k, v in x.items()}
+
+    def queries(self):
+        """queries()
+
+        Return
+        ======
+        dict : Hot queries of this handler (name: statement),
+        see `BikeDB.check_queries()`.
+        """
+        return dict(checkpoint = self._stmt_checkpoint(0),
+                    active     = self._stmt_active(0, 0),
+                    started    = self._stmt_started(0, 0, 0))
+
+
+# -------------------------------------------------------------------
+# Main part; writing the state at a given time to a csv file.
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from bikeconfig import bikeconfig
+    from bikedb import BikeDB, Places
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    parser = ArgumentParser("State of the fleet (bikes or stations) at a given time.")
+    parser.add_argument("timestamp", type = int,
+                        help = "Point in time")
+    parser.add_argument("-t", "--table", choices = ["bikes", "rentals"], default = "bikes",
+                        help = "State of the bikes (default) or the number of bikes per place (rentals)")
+    parser.add_argument("-o", "--output", type = str, default = "state.csv",
+                        help = "Name of the csv file to be written, defaults to 'state.csv'")
+    args = parser.parse_args()
+
+    db      = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                     partitions = cnf.partitions)
+    Places(db)  # Required for the foreign keys
+    handler = Bikes(db) if args.table == "bikes" else Rentals(db)
+    state   = FleetState(handler)
+    db.create_all()
+
+    res = state.at(args.timestamp)
+    print(f"Found {len(res['first_seen'])} {args.table} intervals at {args.timestamp}, writing {args.output}")
+    np.savetxt(args.output, np.stack([res[k].astype(str) for k in res.keys()], axis = 1),
+               fmt = "%s", delimiter = ",", header = ",".join(res.keys()), comments = "")
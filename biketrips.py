@@ -0,0 +1,285 @@
+# -------------------------------------------------------------------
+# Calculating bike trips from the 'bikes' intervals (first_seen,
+# last_seen, place_id). A trip is a change of the place between two
+# consecutive intervals of a bike; it starts when the bike was last
+# seen at the old place and ends when it was first seen at the new one.
+# All bikes are processed at once (sorting/diffing with numpy).
+# -------------------------------------------------------------------
+
+import numpy as np
+from sqlalchemy import select
+
+from bikedb import Bikes
+from bikepartitions import select_range
+
+
+# Columns of the trips returned; missing values (open trips) are -1
+TRIP_COLUMNS = ["number", "start_place_id", "start_time",
+                "end_place_id", "end_time", "duration"]
+
+
+def calculate_trips(number, place_id, first_seen, last_seen):
+    """calculate_trips(number, place_id, first_seen, last_seen)
+
+    Params
+    ======
+    number, place_id, first_seen, last_seen : numpy.ndarray
+        Intervals of the bikes (see `Bikes`), integer arrays of equal length,
+        in any order.
+
+    Return
+    ======
+    dict : Trips; keys correspond to `TRIP_COLUMNS`, the items are numpy
+    arrays (int64). Duration in seconds. Ordered by number and start time.
+    """
+    number, place_id, first_seen, last_seen = \
+        [np.asarray(x, dtype = np.int64) for x in (number, place_id, first_seen, last_seen)]
+    if not len(number) == len(place_id) == len(first_seen) == len(last_seen):
+        raise ValueError("arrays must be of same length")
+
+    # Sorting by bike and time
+    idx = np.lexsort((first_seen, number))
+    number, place_id, first_seen, last_seen = \
+        number[idx], place_id[idx], first_seen[idx], last_seen[idx]
+
+    # Consecutive intervals of the same bike with different place
+    moved = np.flatnonzero((number[1:] == number[:-1]) & (place_id[1:] != place_id[:-1]))
+
+    res = dict(number         = number[moved],
+               start_place_id = place_id[moved],
+               start_time     = last_seen[moved],
+               end_place_id   = place_id[moved + 1],
+               end_time       = first_seen[moved + 1])
+    res["duration"] = res["end_time"] - res["start_time"]
+    return res
+
+
+def calculate_open_trips(number, place_id, first_seen, last_seen, until):
+    """calculate_open_trips(number, place_id, first_seen, last_seen, until)
+
+    Params
+    ======
+    number, place_id, first_seen, last_seen : numpy.ndarray
+        Intervals of the bikes (see `Bikes`), integer arrays of equal length,
+        in any order.
+    until : int
+        End of the period; bikes whose latest interval ended
+        before are on a trip (not yet seen again).
+
+    Return
+    ======
+    dict : Open trips (end unknown, -1), see `calculate_trips()`.
+    """
+    number, place_id, first_seen, last_seen = \
+        [np.asarray(x, dtype = np.int64) for x in (number, place_id, first_seen, last_seen)]
+
+    # Latest interval of each bike
+    idx  = np.lexsort((first_seen, number))
+    idx  = idx[np.append(number[idx][1:] != number[idx][:-1], True)] if len(idx) > 0 else idx
+    idx  = idx[last_seen[idx] < until]
+    n    = len(idx)
+    return dict(number         = number[idx],
+                start_place_id = place_id[idx],
+                start_time     = last_seen[idx],
+                end_place_id   = np.full(n, -1, dtype = np.int64),
+                end_time       = np.full(n, -1, dtype = np.int64),
+                duration       = np.full(n, -1, dtype = np.int64))
+
+
+def concat_trips(*args):
+    """concat_trips(*args)
+
+    Params
+    ======
+    *args : dict
+        Trips as returned by `calculate_trips()`.
+
+    Return
+    ======
+    dict : Combined trips.
+    """
+    if len(args) == 0:
+        return {k: np.zeros(0, dtype = np.int64) for k in TRIP_COLUMNS}
+    return {k: np.concatenate([x[k] for x in args]) for k in TRIP_COLUMNS}
+
+
+def load_intervals(bikes, since = None, end = None):
+    """load_intervals(bikes, since = None, end = None)
+
+    Params
+    ======
+    bikes : Bikes
+        Database handler for bikes.
+    since : None, int
+        If set, only intervals with last_seen > since are loaded.
+    end : None, int
+        If set, only intervals with first_seen <= end are loaded.
+
+    Return
+    ======
+    list : List of numpy arrays with number, place_id, first_seen, last_seen.
+    """
+    if not isinstance(bikes, Bikes): raise TypeError("'bikes' must be a Bikes object")
+    # Monthly partitions; reading the partitions needed as well
+    if bikes.db.partitions is not None:
+        tmp = select_range(bikes.db, "bikes", None if since is None else since + 1, end)
+        tmp = [(x["number"], x["place_id"], x["first_seen"], x["last_seen"]) for x in tmp]
+    else:
+        c    = bikes.table.c
+        stmt = select(c.number, c.place_id, c.first_seen, c.last_seen)
+        if since is not None: stmt = stmt.where(c.last_seen > since)
+        if end is not None:   stmt = stmt.where(c.first_seen <= end)
+        with bikes.db.begin() as con:
+            tmp = con.execute(stmt).all()
+    tmp = np.array(tmp, dtype = np.int64).reshape(-1, 4)
+    return [tmp[:, i] for i in range(4)]
+
+
+def get_trips(bikes, start = None, end = None):
+    """get_trips(bikes, start = None, end = None)
+
+    Params
+    ======
+    bikes : Bikes
+        Database handler for bikes.
+    start : None, int
+        If set, only trips ending at or after `start` (or not yet
+        ended) are returned.
+    end : None, int
+        If set, only trips ending at or before `end` are returned.
+        Trips started before but not ended by `end` (latest snapshot
+        if not set) are returned as open trips (end -1).
+
+    Return
+    ======
+    dict : Trips, see `calculate_trips()` and `calculate_open_trips()`.
+    """
+    x     = load_intervals(bikes, end = end)
+    until = bikes.latest_entry() if end is None else end
+    res   = calculate_trips(*x)
+    if until is not None:
+        res = concat_trips(res, calculate_open_trips(*x, until))
+    if start is not None:
+        idx = (res["end_time"] >= start) | (res["end_time"] < 0)
+        res = {k: v[idx] for k, v in res.items()}
+    return res
+
+
+# -------------------------------------------------------------------
+# Incremental trip extraction
+# -------------------------------------------------------------------
+class TripExtractor:
+
+    def __init__(self, bikes):
+        """TripExtractor(bikes)
+
+        Incremental trip extraction. Keeps the latest interval of each bike
+        in memory; `update()` only loads the intervals which changed since
+        the last call and returns the new (closed) trips.
+
+        Params
+        ======
+        bikes : Bikes
+            Database handler for bikes.
+        """
+        if not isinstance(bikes, Bikes): raise TypeError("'bikes' must be a Bikes object")
+        self.bikes = bikes
+
+        # Latest interval of each bike (number, place_id, first_seen, last_seen)
+        self._last = [np.zeros(0, dtype = np.int64) for i in range(4)]
+        # Latest last_seen processed
+        self.watermark = None
+
+    def update(self):
+        """update()
+
+        Return
+        ======
+        dict : New trips since last call (all trips on the first call),
+        see `calculate_trips()`.
+        """
+        new = load_intervals(self.bikes, since = self.watermark)
+        if len(new[0]) == 0:
+            return concat_trips()
+
+        # Combining with the latest known interval of the bikes; the
+        # interval in 'new' replaces the known one if it was extended.
+        x = [np.concatenate((a, b)) for a, b in zip(self._last, new)]
+        key = np.stack((x[0], x[2]), axis = 1)
+        _, idx = np.unique(key[::-1], axis = 0, return_index = True)
+        x = [v[len(key) - 1 - idx] for v in x]
+
+        res = calculate_trips(*x)
+
+        # Keeping latest interval per bike
+        order = np.lexsort((x[2], x[0]))
+        x     = [v[order] for v in x]
+        last  = np.append(x[0][1:] != x[0][:-1], True)
+        self._last     = [v[last] for v in x]
+        self.watermark = int(new[3].max()) if self.watermark is None else \
+                         max(self.watermark, int(new[3].max()))
+        return res
+
+    def open_trips(self, until):
+        """open_trips(until)
+
+        Params
+        ======
+        until : int
+            Timestamp of the latest snapshot; bikes last seen
+            before are currently on a trip.
+
+        Return
+        ======
+        dict : Open trips (end unknown, -1), see `calculate_trips()`.
+        """
+        if not isinstance(until, int): raise TypeError("'until' must be int")
+        return calculate_open_trips(*self._last, until)
+
+
+# -------------------------------------------------------------------
+# Main part; writing trips to a csv file or (re)building the
+# 'trips' table in the database.
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+    from bikeconfig import bikeconfig
+    from bikedb import BikeDB, Places, Trips
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    parser = ArgumentParser("Calculating bike trips.")
+    parser.add_argument("-o", "--output", type = str, default = "trips.csv",
+                        help = "Name of the csv file to be written, defaults to 'trips.csv'")
+    parser.add_argument("--start", type = int, default = None,
+                        help = "Only trips ending at or after this timestamp")
+    parser.add_argument("--end", type = int, default = None,
+                        help = "Only trips ending at or before this timestamp (trips not " + \
+                               "ended by then are written as open trips, end -1)")
+    parser.add_argument("--rebuild", action = "store_true",
+                        help = "Rebuild the 'trips' table in the database (closed and open trips)")
+    args = parser.parse_args()
+
+    db    = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                   partitions = cnf.partitions)
+    Places(db)  # Required for the foreign keys
+    bikes = Bikes(db)
+    trips = Trips(db)
+    db.create_all()
+
+    if args.rebuild:
+        extractor = TripExtractor(bikes)
+        res  = concat_trips(extractor.update(), extractor.open_trips(bikes.latest_entry()))
+        rows = []
+        for i in range(len(res["number"])):
+            rec = {k: int(res[k][i]) for k in TRIP_COLUMNS if not k == "duration"}
+            if rec["end_time"] < 0: rec["end_time"] = rec["end_place_id"] = None
+            rows.append(rec)
+        print(f"Found {len(rows)} trips, rebuilding 'trips' table")
+        trips.replace_all(rows)
+    else:
+        res = get_trips(bikes, args.start, args.end)
+        print(f"Found {len(res['number'])} trips, writing {args.output}")
+        np.savetxt(args.output, np.stack([res[k] for k in TRIP_COLUMNS], axis = 1),
+                   fmt = "%d", delimiter = ",", header = ",".join(TRIP_COLUMNS), comments = "")
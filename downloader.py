@@ -6,9 +6,12 @@
 import sys
 import os
 import datetime as dt
+import bikejson
+import bikearchive
 from bikeconfig import bikeconfig
+from bikemetrics import metrics, SlowProfiler
 
-from requests import get
+from requests import Session
 import logging
 logging.basicConfig(stream = sys.stdout, level = logging.WARNING)
 
@@ -64,8 +67,9 @@ def get_jsonfilename(dir, domain, fileext = "json"):
     if not isinstance(dir, str):     raise TypeError("'dir' must be str")
     if not isinstance(domain, str):  raise TypeError("'domain' must be str")
     if not isinstance(fileext, str): raise TypeError("'fileext' must be str")
-    x = dt.datetime.now(dt.timezone.utc)
-    return os.path.join(get_dir_today(dir),
+    # Folder and timestamp from the same time (same day, see bikearchive)
+    x = dt.datetime.fromtimestamp(round(dt.datetime.now(dt.timezone.utc).timestamp()), dt.timezone.utc)
+    return os.path.join(dir, x.strftime("%Y"), x.strftime("%m"), x.strftime("%d"),
                         f"{x.timestamp():.0f}_{domain}.{fileext}")
 
 def archive_yesterday(indir, outdir, domain):
@@ -101,25 +105,272 @@ def archive_yesterday(indir, outdir, domain):
 
 
 
-if __name__ == "__main__":
-
-    cnf = bikeconfig("innsbruck.cnf")
+def download(cnf, session, domain = None, country = None):
+    """download(cnf, session, domain = None, country = None)
 
-    # Getting current time to build the output file name (before calling API)
-    jsonfile = get_jsonfilename(cnf.livedir, cnf.domain)
-    logging.info(f"JSON file name: {jsonfile}")
+    Params
+    ======
+    cnf : bikeconfig
+        Config used to build the API request.
+    session : requests.Session
+        Session used to call the API (keeps the connection alive).
+    domain : None, str
+        Domain to be downloaded, defaults to `cnf.domain`.
+    country : None, str
+        Country of the domain, defaults to `cnf.country`.
 
-    logging.info("Calling nextbike API")
-    req = get(cnf.baseurl, params = dict(domains = cnf.domain, countries = cnf.country))
+    Return
+    ======
+    str : Returns the content of the API response.
+    """
+    if domain is None:  domain  = cnf.domain
+    if country is None: country = cnf.country
+    logging.info(f"Calling nextbike API for {domain}")
+    with metrics.timer("api_request", domain = domain):
+        req = session.get(cnf.baseurl, params = dict(domains = domain, countries = country),
+                          timeout = cnf.timeout)
+    metrics.count("api_requests_total", domain = domain, status = req.status_code)
+    metrics.gauge("api_payload_bytes", len(req.content), domain = domain)
     if not req.status_code // 100 == 2:
-        raise Exception("API request was not successful")
+        raise Exception(f"API request for {domain} was not successful")
+    return req.text
 
-    # Else we can continue
-    logging.info("Request successful, writing to file")
+def download_all(cnf, sessions):
+    """download_all(cnf, sessions)
 
-    # Create folder structure (if needed)
-    today_dir     = get_dir_today(cnf.livedir)
-    logging.info(f"Today dir:      {today_dir}")
+    Downloads all domains in `cnf.domains` concurrently (asyncio); at most
+    one request per session at a time, each retried up to `cnf.retries`
+    times with exponential backoff. The duration of a request is limited
+    by the timeout of requests (`cnf.timeout`, see `download()`); no
+    thread is left running after a failed attempt.
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config used to build the API requests.
+    sessions : list of requests.Session
+        Sessions used to call the API (keep the connections alive); one
+        for each concurrent request (see `get_sessions()`), a session is
+        never used by two threads at the same time.
+
+    Return
+    ======
+    dict : Keys correspond to the domains, the items contain the content of the
+    API response or the exception raised by the last attempt.
+    """
+    import asyncio
+    if not isinstance(sessions, list) or len(sessions) == 0:
+        raise TypeError("'sessions' must be a non-empty list of requests.Session")
+
+    async def fetch(pool, domain, country):
+        for attempt in range(cnf.retries + 1):
+            session = await pool.get()
+            try:
+                res = await asyncio.to_thread(download, cnf, session, domain, country)
+                return domain, res
+            except Exception as e:
+                logging.warning(f"Download of {domain} failed (attempt {attempt + 1}): {e}")
+                if attempt == cnf.retries:
+                    metrics.count("api_failures_total", domain = domain)
+                    return domain, e
+                metrics.count("api_retries_total", domain = domain)
+            finally:
+                pool.put_nowait(session)
+            await asyncio.sleep(2**attempt)
+
+    async def fetch_all():
+        pool = asyncio.Queue()
+        for session in sessions: pool.put_nowait(session)
+        return await asyncio.gather(*[fetch(pool, d, c) for d, c in cnf.domains.items()])
+
+    return dict(asyncio.run(fetch_all()))
+
+
+def get_sessions(cnf):
+    """get_sessions(cnf)
+
+    Return
+    ======
+    list of requests.Session : One session for each concurrent request
+    (`cnf.concurrency`, at most one per domain), see `download_all()`.
+    """
+    return [Session() for i in range(min(cnf.concurrency, len(cnf.domains)))]
+
+def store_all(cnf, jsonfiles, contents):
+    """store_all(cnf, jsonfiles, contents)
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config used.
+    jsonfiles : dict
+        File name for each domain (see `get_jsonfilename()`).
+    contents : dict
+        Content for each domain as returned by `download_all()`.
+
+    Return
+    ======
+    Writes the files of all successful downloads. If `cnf.dedup` is set,
+    snapshots identical to the previous one of the same domain (and in the
+    same partition) are not written, only their timestamp is added to the
+    heartbeat file (see `is_duplicate()`). Returns the content of the main
+    domain (None if identical to the previous one), raises the exception
+    if the download of the main domain failed.
+    """
+    res = None
+    for domain, content in contents.items():
+        if isinstance(content, Exception):
+            logging.error(f"Download of {domain} failed: {content}")
+            continue
+        livedir   = cnf.get_livedir(domain)
+        timestamp = int(os.path.basename(jsonfiles[domain]).split("_")[0])
+        try:
+            hash = bikejson.fingerprint(bikejson.decode(content)) if cnf.dedup else None
+        except Exception:
+            hash = None # Stored as is
+        if hash is not None and is_duplicate(livedir, domain, hash, timestamp, cnf.partitions):
+            logging.info(f"Snapshot of {domain} unchanged, heartbeat only")
+            metrics.count("duplicate_snapshots_total", domain = domain)
+            write_heartbeat(jsonfiles[domain], domain)
+            continue
+        store_json(cnf, domain, jsonfiles[domain], content, hash)
+        if domain == cnf.domain: res = content
+
+    if isinstance(contents[cnf.domain], Exception):
+        raise contents[cnf.domain]
+    return res
+
+def store_json(cnf, domain, jsonfile, content, hash = None):
+    """store_json(cnf, domain, jsonfile, content, hash = None)
+
+    Writes the json file of one domain and, in streaming mode, appends
+    it to the archive of the day. The live file is kept until the archive
+    is finalized (see `archive_all()`). The fingerprint (if given) is
+    stored once the file is written (see `is_duplicate()`).
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config used.
+    domain : str
+        Name of the domain.
+    jsonfile : str
+        Name of the file to be written (see `get_jsonfilename()`).
+    content : str
+        Content of the API response.
+    hash : None, str
+        Fingerprint of the content (see `bikejson.fingerprint()`).
+    """
+    timestamp = int(os.path.basename(jsonfile).split("_")[0])
+    write_json(jsonfile, content)
+    if hash is not None:
+        write_fingerprint(cnf.get_livedir(domain), domain, hash, timestamp)
+
+    if cnf.archive_mode == "stream":
+        try:
+            with metrics.timer("archive_append", domain = domain):
+                bikearchive.append(cnf.archivedir, domain, timestamp, content)
+        except Exception as e:
+            logging.error(f"Appending {domain} to archive failed: {e}")
+
+def is_duplicate(livedir, domain, hash, timestamp, partitions = None):
+    """is_duplicate(livedir, domain, hash, timestamp, partitions = None)
+
+    Params
+    ======
+    livedir : str
+        Live folder of the domain; the fingerprint and timestamp of the
+        latest snapshot written are kept in '<livedir>/.<domain>.fingerprint'
+        (see `write_fingerprint()`).
+    domain : str
+        Name of the domain.
+    hash : str
+        Fingerprint of the current snapshot (see `bikejson.fingerprint()`).
+    timestamp : int
+        Timestamp of the current snapshot.
+    partitions : None, str
+        Partitioning of the database (see `BikeDB`); if 'monthly' the
+        first snapshot of a month is never a duplicate (intervals do not
+        span two months, see `alchemy.is_heartbeat()`).
+
+    Return
+    ======
+    bool : True if the content is identical to the latest snapshot written,
+    else False.
+    """
+    file = os.path.join(livedir, f".{domain}.fingerprint")
+    if not os.path.isfile(file): return False
+    with open(file, "r") as fid:
+        tmp = fid.read().split()
+    if len(tmp) == 0 or not tmp[0] == hash: return False
+    if partitions is not None:
+        month = lambda x: dt.datetime.fromtimestamp(x, dt.timezone.utc).strftime("%Y-%m")
+        if len(tmp) < 2 or not month(int(tmp[1])) == month(timestamp): return False
+    return True
+
+def write_fingerprint(livedir, domain, hash, timestamp):
+    """write_fingerprint(livedir, domain, hash, timestamp)
+
+    Stores fingerprint and timestamp of the latest snapshot written
+    (see `is_duplicate()`).
+    """
+    file = os.path.join(livedir, f".{domain}.fingerprint")
+    os.makedirs(livedir, exist_ok = True)
+    with open(file + ".tmp", "w") as fid: fid.write(f"{hash} {timestamp}")
+    os.replace(file + ".tmp", file)
+
+def write_heartbeat(jsonfile, domain):
+    """write_heartbeat(jsonfile, domain)
+
+    Appends the timestamp of `jsonfile` (see `get_jsonfilename()`; not
+    written) to the heartbeat file 'heartbeats_<domain>.txt' in the same
+    folder (archived with the json files, see `alchemy.get_json_files()`).
+    """
+    timestamp = os.path.basename(jsonfile).split("_")[0]
+    os.makedirs(os.path.dirname(jsonfile), exist_ok = True)
+    with open(os.path.join(os.path.dirname(jsonfile), f"heartbeats_{domain}.txt"), "a") as fid:
+        fid.write(f"{timestamp}\n")
+
+def archive_all(cnf):
+    """archive_all(cnf)
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config used.
+
+    Return
+    ======
+    Archives yesterdays data of all domains (if needed). In streaming
+    mode (see `bikearchive`) the archives of all completed days are only
+    finalized; rebuilt from the live folder if incomplete.
+    """
+    today = dt.datetime.now(dt.timezone.utc).date()
+    for domain in cnf.domains.keys():
+        livedir = cnf.get_livedir(domain)
+        if cnf.archive_mode == "stream":
+            days = bikearchive.list_open(cnf.archivedir, domain, today)
+            if os.path.isdir(get_dir_yesterday(livedir)) and not today - dt.timedelta(1) in days:
+                days.append(today - dt.timedelta(1))
+            for date in days:
+                logging.info(f"Finalizing archive of {date} ({domain})")
+                bikearchive.finalize(cnf.archivedir, domain, date, livedir)
+        elif os.path.isdir(get_dir_yesterday(livedir)):
+            archive_yesterday(livedir, cnf.archivedir, domain)
+
+def write_json(jsonfile, content):
+    """write_json(jsonfile, content)
+
+    Params
+    ======
+    jsonfile : str
+        Name of the file to be written (see `get_jsonfilename()`).
+        Directories are created if needed.
+    content : str
+        Content to be written.
+    """
+    if not isinstance(jsonfile, str): raise TypeError("'jsonfile' must be str")
+    if not isinstance(content, str):  raise TypeError("'content' must be str")
 
     # Make sure the directory where we try to store the data does exist
     if not os.path.isdir(os.path.dirname(jsonfile)):
@@ -130,15 +381,159 @@ if __name__ == "__main__":
 
     # Save data
     with open(jsonfile, "w") as fid:
-        fid.write(req.text)
+        fid.write(content)
+
+def run_daemon(cnf):
+    """run_daemon(cnf)
+
+    Long-running collector. Calls the API every `cnf.interval` seconds
+    (all domains, see `download_all()`), stores the json files and
+    processes the data of the main domain in-process, keeping the
+    HTTP sessions, database connection and bike states alive in between.
+    Runs until interrupted.
+
+    Params
+    ======
+    cnf : bikeconfig
+        Config to be used.
+    """
+    import time
+    from contextlib import nullcontext
+    from bikedb import BikeDB, Places, Rentals, Bikes, Trips, Snapshots
+    from alchemy import parse_json, process_snapshot, process_heartbeat, is_heartbeat
+    from bikecolumns import ColumnWriter
+
+    # Metrics; http endpoint and profiling of slow snapshots if configured
+    metrics.configure(statsd = cnf.metrics_statsd, log = cnf.metrics_log)
+    if cnf.metrics_port is not None: metrics.serve(cnf.metrics_port)
+    profiler = None if cnf.profile_threshold is None else \
+               SlowProfiler(cnf.profile_threshold, cnf.profile_dir)
+
+    sessions = get_sessions(cnf)
+    db      = BikeDB(cnf.connection_string, pragmas = cnf.sqlite_pragmas,
+                     partitions = cnf.partitions)
+    places  = Places(db, update_on_change = cnf.update_places)
+    rentals = Rentals(db, rollups = cnf.rollups)
+    bikes   = Bikes(db)
+    trips   = Trips(db)
+    snapshots = Snapshots(db)
+    db.create_all()
+
+    # Optional columnar storage of the snapshots
+    columns = None if cnf.columnardir is None else ColumnWriter(cnf.columnardir, cnf.domain)
+
+    latest_entry = bikes.latest_entry()
+    reload       = False
+
+    while True:
+        # Sleeping until next full interval
+        time.sleep(cnf.interval - time.time() % cnf.interval)
+
+        try:
+            # In-memory states out of sync with the database after an error
+            # (partially written snapshot); reloaded (see BikeDB.batch()).
+            if reload:
+                places.get_known_places(reload = True)
+                rentals.get_previous_records(reload = True)
+                bikes.get_previous_records(reload = True)
+                trips.get_open_trips(reload = True)
+                snapshots.latest(reload = True)
+                latest_entry = bikes.latest_entry()
+                reload       = False
+
+            jsonfiles = {d: get_jsonfilename(cnf.get_livedir(d), d) for d in cnf.domains.keys()}
+            timestamp = int(os.path.basename(jsonfiles[cnf.domain]).split("_")[0])
+            if not latest_entry is None and latest_entry >= timestamp:
+                raise Exception(f"Timestamp {timestamp} not newer than latest processed data ({latest_entry})")
+
+            contents = download_all(cnf, sessions)
+            content  = store_all(cnf, jsonfiles, contents)
+
+            # Processing main domain; heartbeat only if unchanged
+            # (not stored, see store_all()).
+            latest = snapshots.latest()
+            if content is None and latest is not None and \
+                    is_heartbeat(db, snapshots, latest[1], timestamp, latest_entry):
+                stages = process_heartbeat(timestamp, latest_entry, rentals, bikes)
+                snapshots.add(timestamp, latest[1], duplicate = True)
+                metrics.event("snapshot", timestamp = timestamp, duplicate = True, stages = stages)
+                latest_entry = timestamp
+            else:
+                # Not stored but cannot be processed as heartbeat (e.g., snapshot
+                # before not processed); storing it first (json preferred over
+                # the heartbeat when replaying, see alchemy.get_json_files()).
+                if content is None:
+                    content = contents[cnf.domain]
+                    store_json(cnf, cnf.domain, jsonfiles[cnf.domain], content)
+                with (profiler.profile(str(timestamp)) if profiler is not None else nullcontext()):
+                    x = parse_json(content)
+                    stages = process_snapshot(x, timestamp, places, rentals, bikes, trips)
+                if cnf.dedup: snapshots.add(timestamp, bikejson.fingerprint(x))
+                metrics.event("snapshot", timestamp = timestamp, places = len(x.places),
+                              bikes = len(x.bikes), duplicate = False, stages = stages)
+                if columns is not None: columns.append(x, timestamp)
+                latest_entry = timestamp
+
+            # Archiving data (if needed)
+            archive_all(cnf)
+        # Log and keep on running; retry on next interval
+        except Exception as e:
+            metrics.count("cycle_errors_total")
+            logging.exception(e)
+            reload = True
+
+        if cnf.metrics_file is not None:
+            metrics.write_prometheus(cnf.metrics_file)
+
+
+if __name__ == "__main__":
+
+    cnf = bikeconfig("innsbruck.cnf")
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser("Downloading (and processing) nextbike data.")
+    parser.add_argument("-d", "--daemon", action = "store_true",
+                        help = "Run as long-running collector calling the API every 'interval' seconds")
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon(cnf)
+        sys.exit(0)
+
+    # Metrics (statsd, structured log); written to the Prometheus text
+    # file on exit (also on failure), adding to the counters of the
+    # previous runs.
+    metrics.configure(statsd = cnf.metrics_statsd, log = cnf.metrics_log)
+    if cnf.metrics_file is not None:
+        import atexit
+        atexit.register(metrics.write_prometheus, cnf.metrics_file, accumulate = True)
+
+    # Getting current time to build the output file names (before calling API)
+    jsonfiles = {d: get_jsonfilename(cnf.get_livedir(d), d) for d in cnf.domains.keys()}
+    jsonfile  = jsonfiles[cnf.domain]
+    logging.info(f"JSON file name: {jsonfile}")
+
+    sessions = get_sessions(cnf)
+    contents = download_all(cnf, sessions)
+
+    # Else we can continue
+    logging.info("Request successful, writing to file")
+
+    # Create folder structure (if needed)
+    today_dir     = get_dir_today(cnf.livedir)
+    logging.info(f"Today dir:      {today_dir}")
+
+    # Save data; None if identical to the previous snapshot (not stored)
+    content = store_all(cnf, jsonfiles, contents)
 
     # ---------------------------------------------------------------
-    # Process that file
+    # Process that file (or heartbeat)
     # ---------------------------------------------------------------
     import subprocess as sub
     logging.info("Processing the file we just downloaded ...")
-    p = sub.Popen(["python", "alchemy.py", "-f", jsonfile],
-                  stdout = sub.PIPE, stderr = sub.PIPE)
+    cmd = ["python", "alchemy.py", "-f", jsonfile] if content is not None else \
+          ["python", "alchemy.py", "--heartbeat", os.path.basename(jsonfile).split("_")[0]]
+    p = sub.Popen(cmd, stdout = sub.PIPE, stderr = sub.PIPE)
     out,err = p.communicate()
     print(out.decode())
 
@@ -148,12 +543,5 @@ if __name__ == "__main__":
     # ---------------------------------------------------------------
     yesterday_dir = get_dir_yesterday(cnf.livedir)
     logging.info(f"Yesterday dir:  {yesterday_dir}")
-
-    if os.path.isdir(yesterday_dir):
-        archive_yesterday(cnf.livedir, cnf.archivedir, cnf.domain)
-
-
-
-
-
+    archive_all(cnf)
 
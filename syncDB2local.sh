@@ -2,4 +2,18 @@
 
 
 # 'stadtrad' configured via .ssh/config
-rsync -va stadtrad:~/stadtrad/stadtrad.db .
+# Consistent exports created on the server (see bikeexport.py); full
+# copy on first use, afterwards only rows changed since the latest
+# local data are transferred and merged into the local database.
+set -e
+if [ ! -f stadtrad.db ]; then
+    ssh stadtrad "cd ~/stadtrad && python bikeexport.py backup export.db.gz"
+    rsync -va stadtrad:~/stadtrad/export.db.gz .
+    gunzip -c export.db.gz > stadtrad.db
+else
+    SINCE=$(python bikeexport.py latest)
+    ssh stadtrad "cd ~/stadtrad && python bikeexport.py export export.db.gz --since ${SINCE}"
+    rsync -va stadtrad:~/stadtrad/export.db.gz .
+    python bikeexport.py import export.db.gz
+fi
+rm export.db.gz
@@ -0,0 +1,66 @@
+# -------------------------------------------------------------------
+# Decoding snapshots (see bikejson.decode()); all backends (msgspec,
+# orjson, json) and the streaming parser return the same records and
+# raise the same errors.
+# -------------------------------------------------------------------
+
+import io
+import json
+import pytest
+
+import bikejson
+
+
+CONTENT = json.dumps(dict(
+    countries = [dict(name = "Austria", cities = [dict(uid = 1, places = [])])],
+    places    = [dict(uid = 10, name = "Station", lng = 11.4, lat = 47.3, bikes = 2,
+                      bikes_available_to_rent = 1, spot = True),
+                 dict(uid = 11, name = "BIKE 1234", lng = 11.5, lat = 47.2, bikes = 1,
+                      bikes_available_to_rent = 1, spot = False)],
+    bikes     = [dict(number = "1234", bike_type = 15, active = True, state = "ok", place_id = 11),
+                 dict(number = 5678, bike_type = 15, active = False, state = "defect", place_id = 10)]
+))
+
+INVALID = ["{\"places\": [", "[]", "{\"places\": []}",
+           "{\"places\": [{\"uid\": 1}], \"bikes\": []}"]
+
+
+def get_backends():
+    res = ["json"]
+    for name in ["orjson", "msgspec"]:
+        try:
+            __import__(name)
+            res.append(name)
+        except ImportError:
+            pass
+    return res
+
+
+@pytest.fixture(params = get_backends())
+def backend(request, monkeypatch):
+    """Selects the backend used by bikejson.decode()"""
+    if request.param == "msgspec" and not bikejson.BACKEND == "msgspec":
+        pytest.skip("msgspec backend selected on import only")
+    monkeypatch.setattr(bikejson, "BACKEND", request.param)
+    if not request.param == "msgspec":
+        monkeypatch.setattr(bikejson, "loads", __import__(request.param).loads)
+    return request.param
+
+
+def test_decode(backend):
+    x   = bikejson.decode(CONTENT)
+    ref = bikejson.stream(io.StringIO(CONTENT))
+    assert isinstance(x, bikejson.Snapshot)
+    assert all([type(rec) is bikejson.Place for rec in x.places])
+    assert all([type(rec) is bikejson.Bike for rec in x.bikes])
+    assert x == ref
+    assert x.bikes[0] == (1234, 15, True, "ok", 11)
+    assert bikejson.fingerprint(x) == bikejson.fingerprint(ref)
+
+
+@pytest.mark.parametrize("content", INVALID)
+def test_invalid(backend, content):
+    with pytest.raises(Exception) as e:
+        bikejson.decode(content)
+    assert type(e.value) is Exception
+    assert str(e.value).startswith("invalid json data")
@@ -0,0 +1,80 @@
+# -------------------------------------------------------------------
+# Bulk writes (see bikedb.BulkWriter) of the places, bikes and rentals
+# handlers on SQLite and PostgreSQL; PostgreSQL uses COPY into a staging
+# table for COPY_THRESHOLD rows or more. The PostgreSQL tests require
+# an (empty, all tables are dropped) database given by the environment
+# variable BIKES_TEST_POSTGRESQL, e.g.:
+#   BIKES_TEST_POSTGRESQL=postgresql+psycopg2://user:pw@localhost/bikes_test python -m pytest
+# -------------------------------------------------------------------
+
+import os
+import pytest
+from sqlalchemy import select
+
+from bikedb import BikeDB, BulkWriter, Places, Rentals, Bikes
+
+
+POSTGRESQL = os.environ.get("BIKES_TEST_POSTGRESQL")
+
+# Below and above the threshold for COPY
+SIZES = [100, BulkWriter.COPY_THRESHOLD + 100]
+
+
+def write_all(connection_string, n):
+    """write_all(connection_string, n)
+
+    Writes `n` places, bikes and rentals (twice; inserts, ignored
+    duplicates, upserts, and new intervals) into a new database.
+
+    Return
+    ======
+    dict : Rows of each table, sorted.
+    """
+    db      = BikeDB(connection_string)
+    places  = Places(db)
+    rentals = Rentals(db)
+    bikes   = Bikes(db)
+    db.metadata.drop_all(db.engine)
+    db.create_all()
+
+    t0, t1 = 1700000000, 1700000060
+    # Stations (id < n) and free-floating bikes (id >= n)
+    rows = [dict(id = i, timestamp = None if i < n else t0, name = f"place \"{i}\", x",
+                 lon = 11 + i / 1e5, lat = 47 + i / 1e5) for i in range(2 * n)]
+    places.bulk_insert(rows[:n + n // 2])
+    places.bulk_insert(rows)
+
+    for t in [t0, t1]:
+        bikes.bulk_insert_or_update([dict(first_seen = t0 if i % 2 == 0 else t, last_seen = t,
+                                          number = i, bike_type = 1 + i % 3, place_id = i,
+                                          active = i % 5 > 0, state = "ok") for i in range(n)])
+        rentals.bulk_insert([dict(place_id = i, timestamp = t,
+                                  bikes = i % 7 if t == t0 or i % 2 == 0 else i % 5,
+                                  available = i % 7) for i in range(n)])
+
+    res = {}
+    with db.engine.connect() as con:
+        for table in [places.table, rentals.table, bikes.table]:
+            tmp = [tuple(round(v, 6) if isinstance(v, float) else v for v in x)
+                   for x in con.execute(select(table))]
+            res[table.name] = sorted(tmp)
+    db.metadata.drop_all(db.engine)
+    db.engine.dispose()
+    return res
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_sqlite(tmp_path, n):
+    res = write_all(f"sqlite+pysqlite:///{tmp_path / 'test.db'}", n)
+    assert len(res["places"]) == 2 * n
+    # All bikes at t0 (extended to t1 if even), odd ones again at t1
+    assert len(res["bikes"]) == n + n // 2
+    assert len([x for x in res["bikes"] if x[1] == 1700000060]) == n
+    # Unchanged (even) places extended, changed (odd) ones new intervals
+    assert len(res["rentals"]) == n + len([i for i in range(n) if i % 2 == 1 and not i % 7 == i % 5])
+
+
+@pytest.mark.skipif(POSTGRESQL is None, reason = "BIKES_TEST_POSTGRESQL not set")
+@pytest.mark.parametrize("n", SIZES)
+def test_postgresql(tmp_path, n):
+    assert write_all(POSTGRESQL, n) == write_all(f"sqlite+pysqlite:///{tmp_path / 'test.db'}", n)
@@ -0,0 +1,78 @@
+# -------------------------------------------------------------------
+# Incremental exports (see bikeexport.export()) merged into another
+# database (see bikeexport.import_export()) reproduce the source.
+# -------------------------------------------------------------------
+
+from sqlalchemy import select
+
+import gzip
+import shutil
+
+from bikedb import BikeDB, Places, Rentals, Bikes, Trips, Snapshots
+from bikeexport import backup, export, import_export
+from alchemy import is_heartbeat
+
+
+def create(file):
+    """create(file)
+
+    Return
+    ======
+    tuple : New SQLite database (BikeDB), places, trips and snapshots handler.
+    """
+    db     = BikeDB(f"sqlite+pysqlite:///{file}")
+    places = Places(db)
+    Rentals(db)
+    Bikes(db)
+    trips  = Trips(db)
+    snapshots = Snapshots(db)
+    db.create_all()
+    return db, places, trips, snapshots
+
+
+def get_rows(db, table):
+    with db.engine.connect() as con:
+        return sorted([tuple(x) for x in con.execute(select(table))])
+
+
+def test_open_trips(tmp_path):
+    src, places, trips, _ = create(tmp_path / "src.db")
+    dst, _, _, _          = create(tmp_path / "dst.db")
+    places.bulk_insert([dict(id = i, timestamp = None, name = f"place {i}", lon = 11, lat = 47) for i in [1, 2]])
+
+    # Bikes 1 and 2 disappear (open trips)
+    previous = {str(i): dict(number = i, place_id = 1, last_seen = 100) for i in [1, 2, 3]}
+    trips.update(previous, [dict(number = 3, place_id = 1)], 160)
+    export(src, str(tmp_path / "a.db"))
+    import_export(dst, str(tmp_path / "a.db"))
+    assert get_rows(dst, trips.table) == get_rows(src, trips.table)
+
+    # Bike 1 back at the same place (open trip deleted), bike 2 elsewhere
+    trips.update({}, [dict(number = 1, place_id = 1), dict(number = 2, place_id = 2),
+                      dict(number = 3, place_id = 1)], 220)
+    export(src, str(tmp_path / "b.db"), since = 160)
+    import_export(dst, str(tmp_path / "b.db"))
+    assert get_rows(dst, trips.table) == get_rows(src, trips.table) == [(2, 1, 100, 2, 220)]
+
+
+def test_restored_dedup(tmp_path):
+    src, _, _, snapshots = create(tmp_path / "src.db")
+    snapshots.add(100, "a" * 40)
+    snapshots.add(160, "b" * 40)
+
+    # Full backup, full and incremental export
+    backup(src, str(tmp_path / "backup.db.gz"))
+    with gzip.open(tmp_path / "backup.db.gz", "rb") as fin, open(tmp_path / "restored.db", "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+    db       = BikeDB(f"sqlite+pysqlite:///{tmp_path / 'restored.db'}")
+    restored = [Snapshots(db)]
+    for since in [None, 100]:
+        export(src, str(tmp_path / "export.db.gz"), since = since)
+        db, _, _, handler = create(tmp_path / f"import_{since}.db")
+        import_export(db, str(tmp_path / "export.db.gz"))
+        restored.append(handler)
+
+    # The next (identical) snapshot is a heartbeat
+    for handler in restored:
+        assert is_heartbeat(handler.db, handler, "b" * 40, 220, 160)
+        assert not is_heartbeat(handler.db, handler, "a" * 40, 220, 160)